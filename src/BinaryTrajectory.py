@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import zlib
+import bz2
+import lzma
+import struct
+import numpy as np
+
+
+MAGIC = b'MDTRAJ01'
+CODECS = {
+    None: (lambda data: data, lambda data: data),
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+CHUNK_HEADER = struct.Struct('<QI')  # 圧縮後のバイト数, フレーム数
+
+
+def get_frame_dtype(n_atoms, dtype, with_time=True):
+    # 1フレーム: ステップ数, 時刻 (s), 箱 (辺の長さ3つと原点3つ, Å), 位置 (Å), 速度 (m/s)
+    # 時刻のないファイル (header の 'time' が無いもの) も読めるようにしておく
+    fields = [('step', '<i8')]
+    if with_time:
+        fields.append(('time', '<f8'))
+    fields += [
+        ('box', '<f8', (6,)),
+        ('r', dtype, (n_atoms, 3)),
+        ('v', dtype, (n_atoms, 3)),
+    ]
+    return np.dtype(fields)
+
+
+def get_box(d1, d2):
+    return np.concatenate([(d2 - d1) * 1e10, d1 * 1e10])
+
+
+class BinaryTrajectoryWriter:
+    def __init__(self, filename, kinds, box, dtype='float32', compression=None, chunk_frames=100):
+        if compression not in CODECS:
+            raise ValueError(f"Unknown compression '{compression}'. Choose from {list(CODECS)}.")
+        self.filename_ = filename
+        self.header_ = {
+            'n_atoms': len(kinds),
+            'kinds': [str(kind) for kind in kinds],
+            'dtype': np.dtype(dtype).str,
+            'compression': compression,
+            'chunk_frames': chunk_frames,
+            'time': True,
+            'box': [float(x) for x in box],  # 書き始めたときの箱 (cellファイルと同じ a_x, b_y, c_z, o_x, o_y, o_z, Å)
+        }
+        self.frame_dtype_ = get_frame_dtype(len(kinds), self.header_['dtype'])
+        self.compress_, _ = CODECS[compression]
+        self.buffer_ = np.zeros(chunk_frames, dtype=self.frame_dtype_)
+        self.n_buffered_ = 0
+        self.bytes_written_ = 0
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            # restartのときは続きに書き足す
+            header = read_header(filename)[0]
+            if (header['n_atoms'] != self.header_['n_atoms'] or header['dtype'] != self.header_['dtype'] or header['compression'] != compression
+                    or not header.get('time', False)):
+                raise ValueError(f'{filename} was written with a different number of atoms, dtype, compression or frame layout.')
+            self.header_ = header
+            self.file_ = open(filename, 'ab')
+        else:
+            self.file_ = open(filename, 'wb')
+            header = json.dumps(self.header_).encode()
+            self.file_.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, step, time, box, r, v):
+        frame = self.buffer_[self.n_buffered_]
+        frame['step'] = step
+        frame['time'] = time
+        frame['box'] = box
+        frame['r'] = r * 1e10
+        frame['v'] = v
+        self.n_buffered_ += 1
+        if self.n_buffered_ == len(self.buffer_):
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered_ == 0:
+            return
+        data = self.buffer_[:self.n_buffered_].tobytes()
+        if self.header_['compression'] is None:
+            # 無圧縮なら固定長のフレームを並べるだけにして、memmapで読めるようにする
+            self.file_.write(data)
+            self.bytes_written_ += len(data)
+        else:
+            data = self.compress_(data)
+            self.file_.write(CHUNK_HEADER.pack(len(data), self.n_buffered_) + data)
+            self.bytes_written_ += CHUNK_HEADER.size + len(data)
+        self.file_.flush()
+        self.n_buffered_ = 0
+
+    def close(self):
+        self.flush()
+        self.file_.close()
+
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not a binary trajectory file.')
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size).decode())
+    return header, len(MAGIC) + 4 + size
+
+
+class BinaryTrajectoryReader:
+    def __init__(self, filename):
+        self.filename_ = filename
+        self.header_, self.offset_ = read_header(filename)
+        self.n_atoms_ = self.header_['n_atoms']
+        self.kinds_ = np.array(self.header_['kinds'])
+        self.frame_dtype_ = get_frame_dtype(self.n_atoms_, self.header_['dtype'], self.header_.get('time', False))
+        _, self.decompress_ = CODECS[self.header_['compression']]
+
+    def memmap(self):
+        # 無圧縮のファイルはコピーせずに全フレームを構造化配列として見る
+        if self.header_['compression'] is not None:
+            raise ValueError('Only uncompressed trajectories can be memory-mapped. Use iter_chunks() instead.')
+        n_frames = (os.path.getsize(self.filename_) - self.offset_) // self.frame_dtype_.itemsize
+        return np.memmap(self.filename_, dtype=self.frame_dtype_, mode='r', offset=self.offset_, shape=(n_frames,))
+
+    def iter_chunks(self):
+        if self.header_['compression'] is None:
+            frames = self.memmap()
+            chunk_frames = self.header_['chunk_frames']
+            for start in range(0, len(frames), chunk_frames):
+                yield np.array(frames[start:start + chunk_frames])
+            return
+        with open(self.filename_, 'rb') as f:
+            f.seek(self.offset_)
+            while True:
+                chunk_header = f.read(CHUNK_HEADER.size)
+                if len(chunk_header) < CHUNK_HEADER.size:
+                    break
+                size, n_frames = CHUNK_HEADER.unpack(chunk_header)
+                data = f.read(size)
+                if len(data) < size:
+                    break  # 書きかけのチャンクは読まない
+                yield np.frombuffer(self.decompress_(data), dtype=self.frame_dtype_, count=n_frames)
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            for frame in chunk:
+                yield frame
+
+    def read_frames(self):
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return np.zeros(0, dtype=self.frame_dtype_)
+        return np.concatenate(chunks)
+
+
+def to_xyz(filename, xyz_filename):
+    # Driver.write_trajectory と同じ形式のテキストに変換する
+    reader = BinaryTrajectoryReader(filename)
+    with open(xyz_filename, 'w') as f:
+        for frame in reader:
+            columns = np.column_stack([reader.kinds_, frame['r'].astype(np.double).astype(str), frame['v'].astype(np.double).astype(str)])
+            if 'time' in frame.dtype.names:
+                f.write(f'{reader.n_atoms_}\n#step {frame["step"]} time {frame["time"]}\n')
+            else:
+                f.write(f'{reader.n_atoms_}\n#step {frame["step"]}\n')
+            f.write(''.join(' '.join(row) + '\n' for row in columns))
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('usage: python BinaryTrajectory.py <binary trajectory> <xyz file>')
+        return
+    to_xyz(sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
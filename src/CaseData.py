@@ -1,57 +1,179 @@
 import os
 import json
 import numpy as np
+from Checkpoint import load_latest_checkpoint, list_checkpoints
 
 
 class CaseData:
-    def __init__(self, filename):
-        if not os.path.exists('./log'):
-            os.mkdir('./log')
+    def __init__(self, filename=None, case_dict=None):
+        if case_dict is None:
+            with open(filename, 'r') as f:
+                case_dict = json.load(f)
 
-        with open(filename, 'r') as f:
-            case_dict = json.load(f)
+        # 出力先のディレクトリを作っておく (複数のケースを並列に走らせても共有しない)
+        for key in ["restart_file", "out_file_traj", "out_file_energy", "out_file_cell", "out_file_stress", "metrics_file", "telemetry_file"]:
+            if case_dict.get(key) is not None:
+                os.makedirs(os.path.dirname(case_dict[key]) or '.', exist_ok=True)
 
         self.in_file_ = case_dict["in_file"]
         self.restart_ = case_dict["restart"]
         self.restart_file_ = case_dict["restart_file"]
+        self.checkpoint_interval_ = case_dict.get("checkpoint_interval", 0)  # steps between checkpoints (0: off)
+        self.checkpoint_minutes_ = case_dict.get("checkpoint_minutes", 0)  # wall-clock minutes between checkpoints (0: off)
+        self.checkpoint_keep_ = case_dict.get("checkpoint_keep", 3)  # number of checkpoint generations to keep
+        if self.checkpoint_keep_ < 1:
+            raise ValueError(f"'checkpoint_keep' must be at least 1 (got {self.checkpoint_keep_}).")
         self.out_file_traj_ = case_dict["out_file_traj"]
         self.out_file_energy_ = case_dict["out_file_energy"]
         self.out_file_cell_ = case_dict["out_file_cell"]
-
-        self.dt_ = case_dict["dt"]  # time step
+        self.out_file_stress_ = case_dict.get("out_file_stress")  # virial stress log (None: not written)
+        self.traj_format_ = case_dict.get("traj_format", "xyz")  # xyz or binary
+        self.traj_dtype_ = case_dict.get("traj_dtype", "float32")  # float32 or float64 (binary only)
+        self.traj_compression_ = case_dict.get("traj_compression")  # None, zlib, bz2 or lzma (binary only)
+        self.async_output_ = case_dict.get("async_output", False)  # write output in a background thread
+        self.output_queue_ = case_dict.get("output_queue", 64)  # max number of pending outputs (async only)
+        self.flush_interval_ = case_dict.get("flush_interval", 5.0)  # seconds between flushes (async only)
+        self.traj_chunk_ = case_dict.get("traj_chunk", 100)  # number of frames per chunk (binary only)
+        self.metrics_file_ = case_dict.get("metrics_file")  # run metrics (None: not collected)
+        self.metrics_interval_ = case_dict.get("metrics_interval", 1000)  # steps between metrics dumps
+        self.profile_steps_ = case_dict.get("profile_steps")  # [start, stop) steps profiled by cProfile (None: off)
+        self.profile_file_ = case_dict.get("profile_file")  # cProfile stats (default: <metrics_file>.prof)
+        if self.profile_steps_ is not None:
+            if self.metrics_file_ is None:
+                raise ValueError("'profile_steps' needs 'metrics_file'.")
+            if self.profile_file_ is None:
+                self.profile_file_ = self.metrics_file_ + '.prof'
+
+        self.telemetry_file_ = case_dict.get("telemetry_file")  # ring buffer of the output-step values for viewer --live (None: off)
+        self.telemetry_size_ = case_dict.get("telemetry_size", 1024)  # number of records in the ring buffer
+
+        self.precision_ = case_dict.get("precision", "double")  # double or single (positions, velocities, forces)
+        if self.precision_ not in ["double", "single"]:
+            raise ValueError(f"Unknown precision '{self.precision_}'. Choose from ['double', 'single'].")
+        self.dtype_ = np.float32 if self.precision_ == "single" else np.float64
+        self.dt_ = case_dict["dt"]  # time step (initial value when adaptive_dt)
+        self.adaptive_dt_ = case_dict.get("adaptive_dt", False)  # choose dt every step from max displacement and velocity change
+        self.dt_min_ = case_dict.get("dt_min", self.dt_ * 0.1)  # lower bound of adaptive dt
+        self.dt_max_ = case_dict.get("dt_max", self.dt_ * 5)  # upper bound of adaptive dt
+        self.max_displacement_ = case_dict.get("max_displacement", 2e-12)  # max displacement of an atom in a step [m]
+        self.max_velocity_change_ = case_dict.get("max_velocity_change", 50.0)  # max velocity change of an atom in a step [m/s]
+        self.dt_growth_ = case_dict.get("dt_growth", 1.05)  # max ratio of dt between consecutive steps
+        self.integrator_ = case_dict.get("integrator", "velocity_verlet")  # time integration scheme
         self.cutoff_ = case_dict["cutoff"]  # cut off radius
         self.n_loop_ = case_dict["n_loop"]  # number of loop iterations
         self.interval_ = case_dict["interval"]  # interval between output
         self.periodic_ = case_dict["periodic"]  # B.C x, y, z
+        self.neighbor_list_ = case_dict.get("neighbor_list", False)  # linked-cell + Verlet list
+        self.skin_ = case_dict.get("skin", 1e-10)  # skin distance of Verlet list
+        self.minimum_image_ = case_dict.get("minimum_image", False)  # periodic B.C. by minimum image convention
+        self.workers_ = case_dict.get("workers", 1)  # number of processes for the force calculation
+        self.domains_ = case_dict.get("domains")  # [nx, ny, nz] spatial domains, one process each (None: off)
+        self.params_file_ = case_dict.get("params_file")  # potential parameters of additional species
+        self.potential_table_ = case_dict.get("potential_table", 0)  # number of points of the potential table (0: analytic)
+        self.reorder_interval_ = case_dict.get("reorder_interval", 0)  # steps between sorting atoms along a space-filling curve (0: off)
+        self.reorder_curve_ = case_dict.get("reorder_curve", "hilbert")  # hilbert or morton
+
+        if self.domains_ is not None and (self.workers_ > 1 or case_dict.get("minimizer") is not None):
+            raise ValueError("'domains' cannot be combined with 'workers' or 'minimizer'.")
+        if self.precision_ == "single" and (self.workers_ > 1 or self.domains_ is not None):
+            # ワーカーの共有メモリとメッセージは倍精度なので、単精度を指定しても倍精度で計算されてしまう
+            raise ValueError("'precision': 'single' cannot be combined with 'workers' or 'domains'.")
+        if self.domains_ is not None and self.reorder_interval_ > 0:
+            # 領域ごとのワーカーが自分の原子を持っているので、主プロセスの並びを変えても意味がない
+            raise ValueError("'domains' cannot be combined with 'reorder_interval'.")
+        self.replicas_ = case_dict.get("replicas", 1)  # number of replicas advanced together (Replica.ReplicaDriver)
+        self.replica_temperature_ = case_dict.get("replica_temperature")  # temperature of the replica velocities (None: from in_file)
+        self.replica_seed_ = case_dict.get("replica_seed", 0)  # replica k draws its velocities with seed replica_seed + k
+        if self.replicas_ > 1:
+            defaults = {"workers": 1, "domains": None, "minimizer": None, "adaptive_dt": False,
+                        "async_output": False, "metrics_file": None, "telemetry_file": None, "checkpoint_interval": 0, "checkpoint_minutes": 0,
+                        "reorder_interval": 0}
+            unsupported = [key for key, value in defaults.items() if case_dict.get(key, value) != value]
+            if unsupported:
+                raise ValueError(f"'replicas' cannot be combined with {unsupported}.")
 
         self.margin_ = self.offsets_ = None
         if self.restart_:
-            with open(self.out_file_cell_, 'r') as f:
-                _, x, _, _, _, y, _, _, _, z, _, _, _ = f.readlines()[-1].split()  # cellファイルの最後の出力を読む
-                box_size = np.array([x, y, z]).astype(float) * 1e-10
+            checkpoint = load_latest_checkpoint(self.restart_file_)
+            if self.replicas_ > 1:
+                # レプリカごとの箱の大きさは Replica.ReplicaDriver がそれぞれのcellファイルから読む
+                box_size = np.array(case_dict["box_size"]).astype(float)
+            elif checkpoint is not None:
+                # バイナリのチェックポイントがあればそこから箱の大きさを取る
+                box_size = checkpoint['box_size']
+            else:
+                with open(self.out_file_cell_, 'r') as f:
+                    _, x, _, _, _, y, _, _, _, z, _, _, _ = f.readlines()[-1].split()  # cellファイルの最後の出力を読む
+                    box_size = np.array([x, y, z]).astype(float) * 1e-10
             self.set_box_size(box_size)
         else:
-            # reset the output file
-            with open(self.out_file_traj_, 'w') as f:
-                pass
-            with open(self.out_file_energy_, 'w') as f:
-                f.write('#step up uk temperature\n')
-            with open(self.out_file_cell_, 'w') as f:
-                f.write('#$LABELS step a_x a_y a_z b_x b_y b_z c_x c_y c_z o_x o_y o_z\n')
+            if self.replicas_ > 1:
+                for replica in range(self.replicas_):
+                    self.reset_output_files(replica)
+            else:
+                self.reset_output_files()
 
             self.set_box_size(np.array(case_dict["box_size"]).astype(float))
 
         self.relax_ = case_dict["relax"]  # structure relaxation
+        self.minimizer_ = case_dict.get("minimizer")  # fire or cg: minimize after each strain increment (None: wait for relaxation)
+        self.minimize_fmax_ = case_dict.get("minimize_fmax", 1.6e-11)  # converged when max force < fmax [N]
+        self.minimize_etol_ = case_dict.get("minimize_etol", 0.0)  # or when energy change per atom < etol [J] (0: off)
+        self.minimize_max_iter_ = case_dict.get("minimize_max_iter", 10000)  # max iterations per minimization
         self.stretch_eps_ = np.array(case_dict["stretch_eps"]).astype(float)  # distortion of stretch per step
         self.need_stretch_ = True if np.linalg.norm(self.stretch_eps_) > 0 else False
         self.stretch_eps_ += np.array([1, 1, 1]).astype(float)
 
+    def reset_output_files(self, replica=None):
+        # replica を指定したときは、そのレプリカの出力ファイル (get_replica_filename) を空にする
+        def get_filename(filename):
+            return filename if replica is None else get_replica_filename(filename, replica)
+
+        with open(get_filename(self.out_file_traj_), 'w') as f:
+            pass
+        with open(get_filename(self.out_file_energy_), 'w') as f:
+            f.write('#step up uk temperature time\n')
+        with open(get_filename(self.out_file_cell_), 'w') as f:
+            f.write('#$LABELS step a_x a_y a_z b_x b_y b_z c_x c_y c_z o_x o_y o_z\n')
+        if self.out_file_stress_ is not None:
+            with open(get_filename(self.out_file_stress_), 'w') as f:
+                f.write('#step s_xx s_yy s_zz s_yz s_xz s_xy\n')
+        if self.metrics_file_ is not None:
+            with open(get_filename(self.metrics_file_), 'w') as f:
+                pass
+        if replica is None:
+            # 前の実行のチェックポイントが残っていると、restartのときにそちらが読まれてしまう
+            for filename in list_checkpoints(self.restart_file_):
+                os.remove(filename)
+
     def set_box_size(self, box_size):
         self.box_size_ = np.array(box_size)
         self.margin_ = self.box_size_ * 0.05
+        self.check_cutoff()
         # periodic B.C.を計算する際に適用するオフセット
         self.set_offsets()
 
+    def check_cutoff(self):
+        # 周期方向の箱が小さすぎると、相互作用すべき像を取りこぼす
+        periodic = np.array(self.periodic_, dtype=bool)
+        if self.minimum_image_:
+            limit = self.box_size_ * 0.5
+            method = 'half of the box size for the minimum image convention'
+        elif self.neighbor_list_:
+            limit = self.box_size_ - self.skin_
+            method = 'the box size minus the skin for the neighbor list'
+        else:
+            limit = self.box_size_
+            method = 'the box size'
+        if np.any(periodic & (self.cutoff_ >= limit)):
+            raise ValueError(f'cutoff ({self.cutoff_}) must be smaller than {method} in periodic directions (box size: {self.box_size_}).')
+        if self.domains_ is not None:
+            # ゴーストは隣の領域からしか受け取らないので、領域の幅は cutoff + skin 以上必要
+            grid = np.array(self.domains_, dtype=int)
+            width = self.box_size_ / grid
+            if np.any((periodic | (grid > 1)) & (self.cutoff_ + self.skin_ > width)):
+                raise ValueError(f'cutoff + skin ({self.cutoff_ + self.skin_}) must not exceed the domain width ({width}).')
+
     def set_offsets(self):
         d = [-1, 0, 1]
         combi = [[i, j, k] for i in d for j in d for k in d]
@@ -82,6 +204,12 @@ class CaseData:
         self.offsets_ *= self.box_size_
 
 
+def get_replica_filename(filename, replica):
+    # 例: ./log/energy_27.out -> ./log/energy_27_r3.out
+    root, ext = os.path.splitext(filename)
+    return f'{root}_r{replica}{ext}'
+
+
 def test_offsets(casedata: CaseData):
     pass
 
@@ -1,7 +1,8 @@
 import inspect
-from Params import Params
+from Params import Params, make_potential
 from CaseData import CaseData
 from Atom import Atom
+from NeighborList import NeighborList
 import numpy as np
 
 
@@ -10,97 +11,197 @@ class Cell:
         self.casedata_ = casedata
         self.d1_ = np.array([0, 0, 0])
         self.d2_ = np.array(casedata.box_size_)
-        self.atom_list_ = atom_list
-        self.n_atoms_ = len(self.atom_list_)
         self.up_ = self.uk_ = 0
-
-        self.params_ = Params()
+        self.virial_ = np.zeros((3, 3))  # Σ r_ij ⊗ f_ij (出力ステップのみ計算する)
+        self.kinetic_tensor_ = np.zeros((3, 3))  # Σ m v ⊗ v
+
+        self.params_ = Params(casedata.params_file_, casedata.dtype_)
+        self.potential_ = make_potential(self.params_, casedata.cutoff_, casedata.potential_table_)
+        self.neighbor_list_ = NeighborList(casedata) if casedata.neighbor_list_ else None
+        self.set_atoms(
+            np.array([atom.kind_ for atom in atom_list], dtype=str),
+            np.array([atom.r_ for atom in atom_list], dtype=np.double).reshape(len(atom_list), 3),
+            np.array([atom.v_ for atom in atom_list], dtype=np.double).reshape(len(atom_list), 3),
+        )
+
+    def set_atoms(self, kind, r, v, a=None):
+        self.n_atoms_ = len(kind)
+        # structure of arrays: i番目の行がi番目の原子に対応する
+        self.kind_ = np.array(kind, dtype=str)
+        # 単精度のときも原点は箱の角 (d1 = 0) なので、位置の有効桁は箱の大きさに対して決まる
+        dtype = self.casedata_.dtype_
+        self.r_ = np.array(r, dtype=dtype)
+        self.v_ = np.array(v, dtype=dtype)
+        self.a_ = np.zeros((self.n_atoms_, 3), dtype=dtype) if a is None else np.array(a, dtype=dtype)
+        # 原子種は整数IDにしておき、質量も原子ごとの配列で持つ
+        self.type_ = self.params_.get_types(self.kind_)
+        self.mass_ = self.params_.mass_[self.type_]
+        self.inv_mass_ = (1 / self.mass_).astype(dtype)
+        # 並べ替えても入力ファイルの順 (原子ID) で出力できるように、各行の原子IDを持っておく
+        self.id_ = np.arange(self.n_atoms_)
+        self.order_ = None  # 原子IDの順に戻す添字 (並べ替えていなければNone)
+        if self.neighbor_list_ is not None:
+            self.neighbor_list_.invalidate()
+
+    def reorder(self, order):
+        # 原子の行を order の順に並べ替える。他から参照されている配列もあるので、その場で書き換える
+        for name in ['kind_', 'r_', 'v_', 'a_', 'type_', 'mass_', 'inv_mass_', 'id_']:
+            array = getattr(self, name)
+            array[:] = array[order]
+        self.order_ = np.argsort(self.id_)
+        if self.neighbor_list_ is not None:
+            self.neighbor_list_.permute(order)
+
+    def set_ids(self, ids):
+        # 並べ替えた状態のチェックポイントから読んだとき、各行の原子IDを戻す
+        self.id_[:] = ids
+        self.order_ = None if np.array_equal(self.id_, np.arange(self.n_atoms_)) else np.argsort(self.id_)
+
+    def in_id_order(self, array):
+        return array if self.order_ is None else array[self.order_]
 
     def clear_force(self):
-        for atom in self.atom_list_:
-            atom.a_ = np.zeros(3).astype(float)
+        self.a_[:] = 0
 
     def calc_force(self):
         for i in range(self.n_atoms_):
             for j in range(i + 1, self.n_atoms_):
-                displacement = self.atom_list_[i].r_ - self.atom_list_[j].r_
+                displacement = self.r_[i] - self.r_[j]
                 r = np.linalg.norm(displacement)
                 if r > self.casedata_.cutoff_:
                     continue
-                acc = self.params_.Morse(r) * (displacement / r)
-                self.atom_list_[i].a_ -= acc
-                self.atom_list_[j].a_ += acc
+                force = self.potential_.Morse(r, self.type_[i], self.type_[j]) * (displacement / r)
+                self.a_[i] -= force * self.inv_mass_[i]
+                self.a_[j] += force * self.inv_mass_[j]
 
     def calc_force_with_surrounding(self, offset):
         for i in range(self.n_atoms_):
             for j in range(self.n_atoms_):
-                displacement = self.atom_list_[i].r_ - (self.atom_list_[j].r_ + offset)
+                displacement = self.r_[i] - (self.r_[j] + offset)
                 r = np.linalg.norm(displacement)
                 if r > self.casedata_.cutoff_:
                     continue
-                acc = self.params_.Morse(r) * (displacement / r)
-                self.atom_list_[i].a_ -= acc
+                force = self.potential_.Morse(r, self.type_[i], self.type_[j]) * (displacement / r)
+                self.a_[i] -= force * self.inv_mass_[i]
 
     def calc_force_and_up(self):
         self.up_ = 0
+        self.virial_ = np.zeros((3, 3))
         for i in range(self.n_atoms_):
             for j in range(i + 1, self.n_atoms_):
-                displacement = self.atom_list_[i].r_ - self.atom_list_[j].r_
+                displacement = self.r_[i] - self.r_[j]
                 r = np.linalg.norm(displacement)
                 if r > self.casedata_.cutoff_:
                     continue
-                acc, phi = self.params_.Morse_calc_up(r)
-                acc *= displacement / r
-                self.atom_list_[i].a_ -= acc
-                self.atom_list_[j].a_ += acc
+                force, phi = self.potential_.Morse_calc_up(r, self.type_[i], self.type_[j])
+                force *= displacement / r
+                self.a_[i] -= force * self.inv_mass_[i]
+                self.a_[j] += force * self.inv_mass_[j]
                 self.up_ += phi
+                self.virial_ -= np.outer(displacement, force)
 
     def calc_force_and_up_with_surrounding(self, offset):
         for i in range(self.n_atoms_):
             for j in range(self.n_atoms_):
-                displacement = self.atom_list_[i].r_ - (self.atom_list_[j].r_ + offset)
+                displacement = self.r_[i] - (self.r_[j] + offset)
                 r = np.linalg.norm(displacement)
                 if r > self.casedata_.cutoff_:
                     continue
-                acc, phi = self.params_.Morse_calc_up(r)
-                acc *= displacement / r
-                self.atom_list_[i].a_ -= acc
+                force, phi = self.potential_.Morse_calc_up(r, self.type_[i], self.type_[j])
+                force *= displacement / r
+                self.a_[i] -= force * self.inv_mass_[i]
                 self.up_ += phi * 0.5
+                self.virial_ -= np.outer(displacement, force) * 0.5
+
+    def calc_force_with_neighbor_list(self):
+        self.calc_pair_force(calc_up=False)
+
+    def calc_force_and_up_with_neighbor_list(self):
+        self.calc_pair_force(calc_up=True)
+
+    def calc_pair_force(self, calc_up):
+        # 周期境界の像も含めて、Verletリストに載っているペアだけを一度に計算する
+        self.neighbor_list_.update(self.r_, self.d1_, self.d2_)
+        displacement = self.neighbor_list_.get_displacement(self.r_, self.d1_, self.d2_)
+        r = np.sqrt(np.sum(displacement * displacement, axis=1))
+        within = r <= self.casedata_.cutoff_
+        displacement, r = displacement[within], r[within]
+        i, j = self.neighbor_list_.i_[within], self.neighbor_list_.j_[within]
+
+        # エネルギーとビリアルは出力ステップ (calc_up) だけ計算し、それ以外では前の値を残す
+        if calc_up:
+            force, phi = self.potential_.Morse_calc_up(r, self.type_[i], self.type_[j])
+        else:
+            force = self.potential_.Morse(r, self.type_[i], self.type_[j])
+        force = (force / r)[:, None] * displacement
+        for k in range(3):
+            total = np.bincount(j, weights=force[:, k], minlength=self.n_atoms_) - np.bincount(i, weights=force[:, k], minlength=self.n_atoms_)
+            self.a_[:, k] += total * self.inv_mass_
+        if calc_up:
+            # エネルギーとビリアルは単精度のときも倍精度で足し合わせる
+            self.up_ = np.sum(phi, dtype=np.double)
+            self.virial_ = -np.einsum('ia,ib->ab', displacement, force, dtype=np.double)
+
+    def calc_force_with_minimum_image(self):
+        self.calc_pair_force_minimum_image(calc_up=False)
+
+    def calc_force_and_up_with_minimum_image(self):
+        self.calc_pair_force_minimum_image(calc_up=True)
+
+    def calc_pair_force_minimum_image(self, calc_up, block_size=256):
+        # 周期方向は最も近い像とだけ相互作用させるので、1回のペアループで済む
+        periodic = np.array(self.casedata_.periodic_, dtype=bool)
+        box = np.array(self.d2_ - self.d1_, dtype=self.r_.dtype)
+        # エネルギーとビリアルは出力ステップ (calc_up) だけ計算し、それ以外では前の値を残す
+        if calc_up:
+            self.up_ = 0
+            self.virial_ = np.zeros((3, 3))
+        for lo in range(0, self.n_atoms_, block_size):
+            hi = min(lo + block_size, self.n_atoms_)
+            displacement = self.r_[lo:hi, None, :] - self.r_[None, lo:, :]
+            displacement -= np.where(periodic, box * np.round(displacement / box), 0)
+            r = np.sqrt(np.sum(displacement * displacement, axis=2))
+            # i < j のペアだけを数える
+            within = (np.arange(lo, hi)[:, None] < np.arange(lo, self.n_atoms_)[None, :]) & (r <= self.casedata_.cutoff_)
+            r = np.where(within, r, 1)
+            if calc_up:
+                force, phi = self.potential_.Morse_calc_up(r, self.type_[lo:hi, None], self.type_[None, lo:])
+            else:
+                force = self.potential_.Morse(r, self.type_[lo:hi, None], self.type_[None, lo:])
+            force = np.where(within, force / r, 0)[:, :, None] * displacement
+            self.a_[lo:hi] -= np.sum(force, axis=1) * self.inv_mass_[lo:hi, None]
+            self.a_[lo:] += np.sum(force, axis=0) * self.inv_mass_[lo:, None]
+            if calc_up:
+                self.up_ += np.sum(phi, where=within, dtype=np.double)
+                self.virial_ -= np.einsum('ija,ijb->ab', displacement, force, dtype=np.double)
 
     def update_velocity_half(self):
-        for atom in self.atom_list_:
-            atom.v_ += atom.a_ * self.casedata_.dt_ / 2
+        self.v_ += self.a_ * (self.casedata_.dt_ / 2)
 
     def update_velocity_half_and_calc_uk(self):
-        self.uk_ = 0
-        for atom in self.atom_list_:
-            atom.v_ += atom.a_ * self.casedata_.dt_ / 2
-            self.uk_ += 0.5 * self.params_.dict_params_['Al']['mass'] * np.dot(atom.v_, atom.v_)
+        self.update_velocity_half()
+        self.kinetic_tensor_ = (self.mass_[:, None] * self.v_).T @ self.v_
+        self.uk_ = 0.5 * np.trace(self.kinetic_tensor_)
 
     def update_position(self):
-        for atom in self.atom_list_:
-            atom.r_ += atom.v_ * self.casedata_.dt_
+        self.r_ += self.v_ * self.casedata_.dt_
 
     def migrate(self):
-        for atom in self.atom_list_:
-            for i in range(3):
-                if not self.casedata_.periodic_[i]:
-                    continue
-                if atom.r_[i] < self.d1_[i] - self.casedata_.margin_[i]:
-                    atom.r_[i] += self.d2_[i] - self.d1_[i]
-                elif atom.r_[i] >= self.d2_[i] + self.casedata_.margin_[i]:
-                    atom.r_[i] -= self.d2_[i] - self.d1_[i]
+        periodic = np.array(self.casedata_.periodic_, dtype=bool)
+        length = self.d2_ - self.d1_
+        lower = self.r_ < self.d1_ - self.casedata_.margin_
+        upper = self.r_ >= self.d2_ + self.casedata_.margin_
+        self.r_ += np.where(lower & periodic, length, 0)
+        self.r_ -= np.where(upper & periodic, length, 0)
 
     def relax(self):
-        for atom in self.atom_list_:
-            if np.dot(atom.v_, atom.a_) < 0:
-                atom.v_ = np.zeros(3).astype(float)
+        # 力に逆らって動いている原子を止め、止めた原子の数を返す
+        stop = np.einsum('ij,ij->i', self.v_, self.a_) < 0
+        self.v_[stop] = 0
+        return int(np.count_nonzero(stop))
 
     def is_relaxed(self):
-        avg_vel = 0
-        for atom in self.atom_list_:
-            avg_vel += np.linalg.norm(atom.v_)
-        avg_vel /= self.n_atoms_
+        avg_vel = np.linalg.norm(self.v_, axis=1).mean()
 
         if avg_vel < 1:  # 閾値は適切か？
             return True
@@ -113,33 +214,40 @@ class Cell:
 
     def stretch(self):
         self.update_box_size()
-        for atom in self.atom_list_:
-            atom.r_ *= self.casedata_.stretch_eps_
+        self.r_ *= self.casedata_.stretch_eps_
+        if self.neighbor_list_ is not None:
+            self.neighbor_list_.invalidate()
+
+    def get_stress(self):
+        # virial stress (引張りを正とする) = -(Σ m v ⊗ v + Σ r_ij ⊗ f_ij) / V
+        volume = np.prod(self.d2_ - self.d1_)
+        return -(self.kinetic_tensor_ + self.virial_) / volume
+
+    def get_atom(self, i):
+        return Atom(self.kind_[i], self.r_[i], self.v_[i])
 
     def get_trajectory(self):
-        trajectory_str = ''
-        for atom in self.atom_list_:
-            trajectory_str += atom.out_traj()
-        return trajectory_str
+        return format_atoms(self.in_id_order(self.kind_), self.in_id_order(self.r_) * 1e10, self.in_id_order(self.v_))
 
     def get_restart(self):
-        restart_str = ''
-        for atom in self.atom_list_:
-            restart_str += atom.out_restart()
-        return restart_str
+        return format_atoms(self.in_id_order(self.kind_), self.in_id_order(self.r_), self.in_id_order(self.v_))
+
+
+def format_atoms(kinds, r, v):
+    # 1行に1原子: kind x y z vx vy vz
+    columns = np.column_stack([kinds, r.astype(str), v.astype(str)])
+    return ''.join(' '.join(row) + '\n' for row in columns)
 
 
 def test_clear_force(cell: Cell):
     cell.calc_force()
-    for atom in cell.atom_list_:
-        if np.linalg.norm(atom.a_) == 0:
-            print(f'Failed in {inspect.currentframe().f_code.co_name}. There are some isolated atoms.')
-            return
+    if np.any(np.linalg.norm(cell.a_, axis=1) == 0):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. There are some isolated atoms.')
+        return
     cell.clear_force()
-    for atom in cell.atom_list_:
-        if np.linalg.norm(atom.a_) != 0:
-            print(f'Failed in {inspect.currentframe().f_code.co_name}. clear_force() is not properly working.')
-            return
+    if np.any(np.linalg.norm(cell.a_, axis=1) != 0):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. clear_force() is not properly working.')
+        return
     print(f'Succeed in {inspect.currentframe().f_code.co_name}')
 
 
@@ -157,6 +265,67 @@ def test_calc_force_and_up_with_surrounding():
     cell = Cell(casedata, atom_list)
 
 
+def read_atom_list(filename):
+    atom_list = []
+    with open(filename, 'r') as f:
+        for line in f:
+            kind, x, y, z, vx, vy, vz = line.split()
+            atom_list.append(Atom(kind, [x, y, z], [vx, vy, vz]))
+    return atom_list
+
+
+def make_test_cell(casedata: CaseData, atom_list=None, scale=0.1e-10):
+    # テスト用に in_file の原子から Cell を作る。完全な格子では力が打ち消し合ってしまうので、少しずらしておく
+    cell = Cell(casedata, read_atom_list(casedata.in_file_) if atom_list is None else atom_list)
+    cell.r_ += np.random.default_rng(0).normal(scale=scale, size=cell.r_.shape).astype(cell.r_.dtype)
+    return cell
+
+
+def matches_reference(cell: Cell, calc_force_and_up):
+    # calc_force_and_up() で計算した加速度、エネルギー、ビリアルが26個の像を回る参照ループと一致するか
+    cell.clear_force()
+    cell.calc_force_and_up()
+    for offset in cell.casedata_.offsets_:
+        cell.calc_force_and_up_with_surrounding(offset)
+    a_ref, up_ref, virial_ref = cell.a_.copy(), cell.up_, cell.virial_.copy()
+
+    cell.clear_force()
+    calc_force_and_up()
+    return (np.allclose(cell.a_, a_ref, rtol=1e-8, atol=1e-8 * np.abs(a_ref).max()) and np.isclose(cell.up_, up_ref, rtol=1e-10, atol=0)
+            and np.allclose(cell.virial_, virial_ref, rtol=1e-8, atol=1e-8 * np.abs(virial_ref).max()))
+
+
+def test_minimum_image():
+    casedata = CaseData('./data/case0.json')
+    casedata.minimum_image_ = True
+    cell = make_test_cell(casedata)
+    if not matches_reference(cell, cell.calc_force_and_up_with_minimum_image):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. up: {cell.up_}')
+        return
+    # 力だけの計算では直前のエネルギーとビリアルが残る
+    a, up, virial = cell.a_.copy(), cell.up_, cell.virial_.copy()
+    cell.clear_force()
+    cell.calc_force_with_minimum_image()
+    if not np.allclose(cell.a_, a, rtol=1e-12, atol=0) or cell.up_ != up or not np.array_equal(cell.virial_, virial):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. force-only call changed up: {up} -> {cell.up_}')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def test_multi_species():
+    casedata = CaseData('./data/case0.json')
+    casedata.params_file_ = './data/params_Ni.json'
+    casedata.minimum_image_ = True
+    atom_list = read_atom_list(casedata.in_file_)
+    for atom in atom_list[::4]:
+        atom.kind_ = 'Ni'
+    cell = make_test_cell(casedata, atom_list)
+    if not matches_reference(cell, cell.calc_force_and_up_with_minimum_image):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. up: {cell.up_}')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
 def update_velocity_half_and_calc_uk(cell: Cell):
     pass
 
@@ -173,7 +342,7 @@ def test_migrate():
     ]
     cell = Cell(casedata, atom_list)
     for _ in range(10):
-        print(cell.atom_list_[0].r_[0], end=', ')
+        print(cell.r_[0, 0], end=', ')
         cell.update_position()
         cell.migrate()
     print('...')
@@ -190,6 +359,8 @@ def main():
     test_clear_force(cell)
     test_calc_force_and_up_with_surrounding()
     test_migrate()
+    test_minimum_image()
+    test_multi_species()
 
 
 if __name__ == '__main__':
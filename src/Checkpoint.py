@@ -0,0 +1,61 @@
+import os
+import glob
+import time
+import zipfile
+import numpy as np
+
+
+def get_checkpoint_name(basename, step):
+    return f'{basename}.{step:012d}.npz'
+
+
+def list_checkpoints(basename):
+    # 古い順に並ぶ (ステップ数を0埋めしているので名前順でよい)
+    return sorted(glob.glob(glob.escape(basename) + '.' + '[0-9]' * 12 + '.npz'))
+
+
+def save_checkpoint(filename, state):
+    # 一時ファイルに書いてからrenameするので、書き込み中に落ちても前の世代は壊れない
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    with np.load(filename) as data:
+        return {key: data[key] for key in data.files}
+
+
+def load_latest_checkpoint(basename):
+    # 新しい世代から順に試し、読めなかったものは飛ばす
+    for filename in reversed(list_checkpoints(basename)):
+        try:
+            return load_checkpoint(filename)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            continue
+    return None
+
+
+class Checkpointer:
+    def __init__(self, basename, interval=0, minutes=0, keep=3):
+        self.basename_ = basename
+        self.interval_ = interval  # ステップ数ごと (0なら使わない)
+        self.seconds_ = minutes * 60  # 経過時間ごと (0なら使わない)
+        self.keep_ = keep  # 残しておく世代数
+        self.last_time_ = time.monotonic()
+
+    def is_due(self, step):
+        if self.interval_ > 0 and step % self.interval_ == 0:
+            return True
+        if self.seconds_ > 0 and time.monotonic() - self.last_time_ >= self.seconds_:
+            return True
+        return False
+
+    def save(self, state, step):
+        save_checkpoint(get_checkpoint_name(self.basename_, step), state)
+        self.last_time_ = time.monotonic()
+        for filename in list_checkpoints(self.basename_)[:-self.keep_]:
+            os.remove(filename)
@@ -0,0 +1,44 @@
+from collections import deque
+
+
+class Comm:
+    # ワーカー間の1対1通信。別の通信手段 (MPIなど) を使うときは send と recv を実装したクラスを作る
+    def __init__(self, rank, size):
+        self.rank_ = rank
+        self.size_ = size
+
+    def send(self, dest, tag, obj):
+        raise NotImplementedError
+
+    def recv(self, source, tag):
+        raise NotImplementedError
+
+    def allreduce(self, value, op=sum):
+        # rank 0 に集めて op で畳み込み、結果を全員に配る
+        if self.rank_ == 0:
+            values = [value] + [self.recv(source, 'allreduce') for source in range(1, self.size_)]
+            result = op(values)
+            for dest in range(1, self.size_):
+                self.send(dest, 'allreduce_result', result)
+            return result
+        self.send(0, 'allreduce', value)
+        return self.recv(0, 'allreduce_result')
+
+
+class QueueComm(Comm):
+    # 同じマシン上のプロセス間で、rankごとの multiprocessing.Queue を受信箱にする
+    def __init__(self, rank, size, queues):
+        super().__init__(rank, size)
+        self.queues_ = queues
+        self.pending_ = {}  # 先に届いた (source, tag) ごとのメッセージ
+
+    def send(self, dest, tag, obj):
+        self.queues_[dest].put((self.rank_, tag, obj))
+
+    def recv(self, source, tag):
+        # 同じ送り手からのメッセージは送った順に届くので、(source, tag) ごとに順番に取り出せばよい
+        key = (source, tag)
+        while not self.pending_.get(key):
+            message_source, message_tag, obj = self.queues_[self.rank_].get()
+            self.pending_.setdefault((message_source, message_tag), deque()).append(obj)
+        return self.pending_[key].popleft()
@@ -0,0 +1,372 @@
+import itertools
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import numpy as np
+from Params import Params, make_potential
+from NeighborList import NeighborList
+from Integrator import Integrator, TimestepController
+from Comm import Comm, QueueComm
+from CaseData import CaseData
+from Cell import Cell
+
+
+def get_owner(r, d1, d2, grid, periodic):
+    # 原子を持つ領域の格子座標。周期方向は箱の中に折り返して考え、非周期方向は箱の外の原子も端の領域が持つ
+    box = d2 - d1
+    x = np.where(periodic, np.mod(r - d1, box), r - d1)
+    return np.clip(np.floor(x / (box / grid)).astype(int), 0, grid - 1)
+
+
+def get_rank(coord, grid):
+    return int(np.ravel_multi_index(tuple(coord), tuple(grid)))
+
+
+class Domain:
+    # ワーカー側: 自分の領域の原子 (owned) と、隣の領域から受け取ったゴースト原子を持つ
+    def __init__(self, casedata: CaseData, comm: Comm):
+        self.casedata_ = casedata
+        self.comm_ = comm
+        self.grid_ = np.array(casedata.domains_, dtype=int)
+        self.coord_ = np.array(np.unravel_index(comm.rank_, self.grid_))
+        self.periodic_ = np.array(casedata.periodic_, dtype=bool)
+        self.r_list_ = casedata.cutoff_ + casedata.skin_
+        self.d1_ = np.zeros(3)
+        self.d2_ = np.array(casedata.box_size_, dtype=float)
+        params = Params(casedata.params_file_)
+        self.mass_table_ = params.mass_
+        self.potential_ = make_potential(params, casedata.cutoff_, casedata.potential_table_)
+        self.neighbor_list_ = NeighborList(casedata, periodic=[False, False, False])
+
+        self.ids_ = np.zeros(0, dtype=int)  # 元の原子番号
+        self.type_ = np.zeros(0, dtype=int)
+        self.r_ = np.zeros((0, 3))
+        self.v_ = np.zeros((0, 3))
+        self.a_ = np.zeros((0, 3))
+        self.ghost_type_ = np.zeros(0, dtype=int)
+        self.ghost_r_ = np.zeros((0, 3))
+        self.pair_i_ = np.zeros(0, dtype=int)
+        self.pair_j_ = np.zeros(0, dtype=int)
+        self.pair_weight_ = np.zeros(0)  # 2つの領域にまたがるペアは半分ずつ数える
+        self.send_index_ = []
+        self.r_last_ = None  # 最後にexchangeしたときの位置
+        self.set_routes()
+
+    def set_routes(self):
+        # 周囲26方向 (周期方向は箱を回り込む) の領域へのゴーストの送り先と受け取り元
+        self.sends_ = []  # (方向, 送り先, 送り先の像)
+        self.recvs_ = []  # (方向, 受け取り元)
+        for offset in itertools.product([-1, 0, 1], repeat=3):
+            if offset == (0, 0, 0):
+                continue
+            dest = self.coord_ + offset
+            if np.all(self.periodic_ | ((dest >= 0) & (dest < self.grid_))):
+                image = np.floor_divide(dest, self.grid_)
+                self.sends_.append((offset, get_rank(dest - image * self.grid_, self.grid_), image))
+            source = self.coord_ - offset
+            if np.all(self.periodic_ | ((source >= 0) & (source < self.grid_))):
+                self.recvs_.append((offset, get_rank(np.mod(source, self.grid_), self.grid_)))
+        self.neighbors_ = sorted({dest for _, dest, _ in self.sends_} - {self.comm_.rank_})
+
+    def set_atoms(self, d1, d2, ids, types, r, v, a):
+        self.d1_, self.d2_ = np.array(d1, dtype=float), np.array(d2, dtype=float)
+        self.ids_, self.type_ = np.array(ids, dtype=int), np.array(types, dtype=int)
+        self.r_, self.v_, self.a_ = np.array(r, dtype=float), np.array(v, dtype=float), np.array(a, dtype=float)
+        self.r_last_ = None
+
+    def needs_exchange(self):
+        # どこかの領域でskinの半分以上動いた原子があれば、全員で原子とゴーストを配り直す
+        if self.r_last_ is None or len(self.r_last_) != len(self.r_):
+            moved = True
+        else:
+            moved = bool(np.max(np.sum((self.r_ - self.r_last_) ** 2, axis=1), initial=0) > (0.5 * self.casedata_.skin_) ** 2)
+        return self.comm_.allreduce(moved, op=any)
+
+    def exchange(self):
+        box = self.d2_ - self.d1_
+        # 周期方向は箱の中に折り返してから、持ち主の領域に移す
+        self.r_ -= np.where(self.periodic_, np.floor((self.r_ - self.d1_) / box), 0) * box
+        owner = np.ravel_multi_index(get_owner(self.r_, self.d1_, self.d2_, self.grid_, self.periodic_).T, self.grid_)
+        if not np.all(np.isin(owner, self.neighbors_ + [self.comm_.rank_])):
+            raise RuntimeError('An atom moved across more than one domain between neighbor list updates.')
+        arrays = [self.ids_, self.type_, self.r_, self.v_, self.a_]
+        for neighbor in self.neighbors_:
+            move = owner == neighbor
+            self.comm_.send(neighbor, 'migrate', [array[move] for array in arrays])
+        keep = owner == self.comm_.rank_
+        arrays = [[array[keep]] for array in arrays]
+        for neighbor in self.neighbors_:
+            for array, received in zip(arrays, self.comm_.recv(neighbor, 'migrate')):
+                array.append(received)
+        self.ids_, self.type_, self.r_, self.v_, self.a_ = [np.concatenate(array) for array in arrays]
+
+        # 隣の領域 (から r_list 以内) にある原子をゴーストとして送る
+        w = box / self.grid_
+        self.send_index_ = []
+        for offset, dest, image in self.sends_:
+            target = self.coord_ + offset
+            lo = np.where(~self.periodic_ & (target == 0), -np.inf, self.d1_ + target * w)
+            hi = np.where(~self.periodic_ & (target == self.grid_ - 1), np.inf, self.d1_ + (target + 1) * w)
+            index = np.nonzero(np.all((self.r_ >= lo - self.r_list_) & (self.r_ < hi + self.r_list_), axis=1))[0]
+            self.send_index_.append(index)
+            self.comm_.send(dest, ('halo', offset), (self.type_[index], self.r_[index] - image * box))
+        ghosts = [self.comm_.recv(source, ('halo', offset)) for offset, source in self.recvs_]
+        self.ghost_type_ = np.concatenate([np.zeros(0, dtype=int)] + [types for types, _ in ghosts])
+        self.ghost_r_ = np.concatenate([np.zeros((0, 3))] + [r for _, r in ghosts])
+
+        # owned同士とowned-ゴーストのペアだけを残す (i < j なので i がownedならよい)
+        n_own = len(self.r_)
+        self.neighbor_list_.build(np.concatenate([self.r_, self.ghost_r_]), self.d1_, self.d2_)
+        own = self.neighbor_list_.i_ < n_own
+        self.pair_i_, self.pair_j_ = self.neighbor_list_.i_[own], self.neighbor_list_.j_[own]
+        self.pair_weight_ = np.where(self.pair_j_ < n_own, 1.0, 0.5)
+        self.r_last_ = self.r_.copy()
+
+    def forward(self):
+        # 配り直さないステップは、同じゴーストの位置だけを送る
+        box = self.d2_ - self.d1_
+        for (offset, dest, image), index in zip(self.sends_, self.send_index_):
+            self.comm_.send(dest, ('forward', offset), self.r_[index] - image * box)
+        self.ghost_r_ = np.concatenate([np.zeros((0, 3))] + [self.comm_.recv(source, ('forward', offset)) for offset, source in self.recvs_])
+
+    def update_ghosts(self):
+        if self.needs_exchange():
+            self.exchange()
+        else:
+            self.forward()
+
+    def calc_force(self, calc_up=False):
+        n_own = len(self.r_)
+        r = np.concatenate([self.r_, self.ghost_r_])
+        types = np.concatenate([self.type_, self.ghost_type_])
+        displacement = r[self.pair_i_] - r[self.pair_j_]
+        dist = np.sqrt(np.sum(displacement * displacement, axis=1))
+        within = dist <= self.casedata_.cutoff_
+        displacement, dist = displacement[within], dist[within]
+        i, j, weight = self.pair_i_[within], self.pair_j_[within], self.pair_weight_[within]
+
+        force, phi = self.potential_.Morse_calc_up(dist, types[i], types[j])
+        force = (force / dist)[:, None] * displacement
+        inv_mass = 1 / self.mass_table_[self.type_]
+        self.a_ = np.zeros((n_own, 3))
+        for k in range(3):
+            total = np.bincount(j, weights=force[:, k], minlength=len(r)) - np.bincount(i, weights=force[:, k], minlength=len(r))
+            self.a_[:, k] = total[:n_own] * inv_mass
+        if calc_up:
+            return np.sum(phi * weight), -(displacement * weight[:, None]).T @ force
+        return 0.0, np.zeros((3, 3))
+
+    def get_extremes(self):
+        v_max = np.sqrt(np.max(np.sum(self.v_ * self.v_, axis=1), initial=0))
+        a_max = np.sqrt(np.max(np.sum(self.a_ * self.a_, axis=1), initial=0))
+        return v_max, a_max
+
+    def step(self, dt, calc_energy, relax, force_valid):
+        # Cell + VelocityVerlet + Driver.relax と同じ順
+        if not force_valid:
+            self.update_ghosts()
+            self.calc_force()
+        self.v_ += self.a_ * (dt / 2)
+        self.r_ += self.v_ * dt
+        self.update_ghosts()
+        up, virial = self.calc_force(calc_energy)
+        self.v_ += self.a_ * (dt / 2)
+        result = {}
+        if calc_energy:
+            mass = self.mass_table_[self.type_]
+            result['up'] = up
+            result['virial'] = virial
+            result['kinetic_tensor'] = (mass[:, None] * self.v_).T @ self.v_
+        if relax:
+            stop = np.einsum('ij,ij->i', self.v_, self.a_) < 0
+            self.v_[stop] = 0
+            result['n_stopped'] = int(np.count_nonzero(stop))
+        result['v_max'], result['a_max'] = self.get_extremes()
+        return result
+
+    def stretch(self, d1, d2, eps):
+        self.d1_, self.d2_ = np.array(d1, dtype=float), np.array(d2, dtype=float)
+        self.r_ *= eps
+        self.r_last_ = None
+
+
+def worker_loop(conn, queues, rank, casedata):
+    domain = Domain(casedata, QueueComm(rank, len(queues), queues))
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        name, args = command
+        try:
+            if name == 'set_atoms':
+                domain.set_atoms(*args)
+                conn.send(None)
+            elif name == 'force':
+                domain.update_ghosts()
+                domain.calc_force()
+                conn.send(domain.get_extremes())
+            elif name == 'step':
+                conn.send(domain.step(*args))
+            elif name == 'gather':
+                conn.send((domain.ids_, domain.r_, domain.v_, domain.a_))
+            elif name == 'stretch':
+                domain.stretch(*args)
+                conn.send(None)
+            elif name == 'velocity':
+                conn.send((np.sum(np.linalg.norm(domain.v_, axis=1)), len(domain.v_)))
+        except Exception as e:
+            conn.send(e)
+
+
+class DomainDecomposition:
+    # 親プロセス側: 箱を casedata.domains_ の格子に分け、領域ごとのワーカーに原子を持たせて時間発展させる
+    def __init__(self, casedata: CaseData, cell: Cell):
+        self.casedata_ = casedata
+        self.grid_ = np.array(casedata.domains_, dtype=int)
+        self.n_workers_ = int(np.prod(self.grid_))
+        self.queues_ = [mp.Queue() for _ in range(self.n_workers_)]
+        self.conns_ = []
+        self.processes_ = []
+        for rank in range(self.n_workers_):
+            parent_conn, child_conn = mp.Pipe()
+            process = mp.Process(target=worker_loop, args=(child_conn, self.queues_, rank, casedata), daemon=True)
+            process.start()
+            self.conns_.append(parent_conn)
+            self.processes_.append(process)
+        self.scatter(cell)
+
+    def send(self, name, args_list):
+        for conn, args in zip(self.conns_, args_list):
+            conn.send((name, args))
+        # 1つのワーカーが失敗すると他は通信待ちで止まるので、全員を待たずに止める
+        replies = [None] * self.n_workers_
+        remaining = list(self.conns_)
+        while remaining:
+            for conn in wait(remaining):
+                reply = conn.recv()
+                remaining.remove(conn)
+                if isinstance(reply, Exception):
+                    self.terminate()
+                    raise reply
+                replies[self.conns_.index(conn)] = reply
+        return replies
+
+    def broadcast(self, name, *args):
+        return self.send(name, [args] * self.n_workers_)
+
+    def scatter(self, cell: Cell):
+        periodic = np.array(self.casedata_.periodic_, dtype=bool)
+        owner = np.ravel_multi_index(get_owner(cell.r_, cell.d1_, cell.d2_, self.grid_, periodic).T, self.grid_)
+        args_list = []
+        for rank in range(self.n_workers_):
+            ids = np.nonzero(owner == rank)[0]
+            args_list.append((cell.d1_, cell.d2_, ids, cell.type_[ids], cell.r_[ids], cell.v_[ids], cell.a_[ids]))
+        self.send('set_atoms', args_list)
+
+    def gather(self, cell: Cell):
+        for ids, r, v, a in self.broadcast('gather'):
+            cell.r_[ids] = r
+            cell.v_[ids] = v
+            cell.a_[ids] = a
+
+    def calc_force(self):
+        extremes = np.array(self.broadcast('force'))
+        return extremes[:, 0].max(), extremes[:, 1].max()
+
+    def step(self, dt, calc_energy, relax, force_valid):
+        return self.broadcast('step', dt, calc_energy, relax, force_valid)
+
+    def stretch(self, d1, d2, eps):
+        self.broadcast('stretch', d1, d2, eps)
+
+    def is_relaxed(self):
+        # Cell.is_relaxed と同じく、速さの平均で判定する
+        speeds = np.array(self.broadcast('velocity'))
+        return speeds[:, 0].sum() / max(speeds[:, 1].sum(), 1) < 1
+
+    def terminate(self):
+        for process in self.processes_:
+            process.terminate()
+        self.conns_ = []
+        self.processes_ = []
+
+    def close(self):
+        for conn in self.conns_:
+            conn.send(None)
+        for process in self.processes_:
+            process.join()
+        self.conns_ = []
+        self.processes_ = []
+
+
+class DomainIntegrator(Integrator):
+    # 力の計算と時間発展をワーカーに任せ、エネルギーを出力するステップだけ原子を集める
+    def __init__(self, cell: Cell, domains: DomainDecomposition, relax=False, timestep: TimestepController = None):
+        super().__init__(cell, None, timestep)
+        self.domains_ = domains
+        self.relax_ = relax  # relaxはワーカーがステップの最後に行う
+        self.n_stopped_ = 0
+        self.v_max_ = self.a_max_ = None
+
+    def step(self, calc_energy=False):
+        if self.timestep_ is not None:
+            if not self.force_valid_ or self.v_max_ is None:
+                self.v_max_, self.a_max_ = self.domains_.calc_force()
+                self.force_valid_ = True
+                self.n_force_calls_ += 1
+            self.timestep_.choose(self.v_max_, self.a_max_)
+        results = self.domains_.step(self.cell_.casedata_.dt_, calc_energy, self.relax_, self.force_valid_)
+        self.n_force_calls_ += 1 if self.force_valid_ else 2
+        self.force_valid_ = True
+        self.v_max_ = max(result['v_max'] for result in results)
+        self.a_max_ = max(result['a_max'] for result in results)
+        if self.relax_:
+            self.n_stopped_ = sum(result['n_stopped'] for result in results)
+        if calc_energy:
+            self.domains_.gather(self.cell_)
+            self.cell_.up_ = sum(result['up'] for result in results)
+            self.cell_.virial_ = sum(result['virial'] for result in results)
+            self.cell_.kinetic_tensor_ = sum(result['kinetic_tensor'] for result in results)
+            self.cell_.uk_ = 0.5 * np.trace(self.cell_.kinetic_tensor_)
+
+
+def test_domain_decomposition():
+    import os
+    import json
+    import inspect
+    from Driver import Driver
+    from gen_initial_state import FCCMaker
+
+    # 4 x 4 x 4 のfccを 2 x 2 x 1 に分け、1プロセスのVerletリストと比べる
+    with open('./data/case0.json', 'r') as f:
+        case_dict = json.load(f)
+    maker = FCCMaker(4.05e-10, [4, 4, 4], 'Al', 300, seed=0)
+    maker.make()
+    os.makedirs('./log', exist_ok=True)
+    maker.to_npz('./log/Al_fcc_64.npz')
+    case_dict.update({"in_file": "./log/Al_fcc_64.npz", "box_size": maker.get_box_size().tolist(), "n_loop": 100,
+                      "periodic": [True, True, False], "neighbor_list": True})
+    results = []
+    for domains in [None, [2, 2, 1]]:
+        case_dict["domains"] = domains
+        dr = Driver(CaseData(case_dict=case_dict))
+        dr.run()
+        dr.sync_cell()
+        results.append((dr.cell_.r_.copy(), dr.cell_.v_.copy(), dr.cell_.up_))
+
+    (r_ref, v_ref, up_ref), (r, v, up) = results
+    # 周期方向は折り返し方が違うので、最も近い像どうしで比べる
+    box = maker.get_box_size()
+    diff = r - r_ref
+    diff -= np.where(case_dict["periodic"], box * np.round(diff / box), 0)
+    if not np.allclose(diff, 0, rtol=0, atol=1e-15) or not np.allclose(v, v_ref, rtol=1e-6, atol=1e-6) or not np.isclose(up, up_ref, rtol=1e-10, atol=0):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. up: {up} (reference {up_ref})')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_domain_decomposition()
+
+
+if __name__ == '__main__':
+    main()
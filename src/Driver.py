@@ -1,7 +1,22 @@
 import os
+import time
+import inspect
+import tempfile
+import numpy as np
 from Atom import Atom
-from Cell import Cell
+from Cell import Cell, format_atoms
+from Integrator import TimestepController, make_integrator
+from Minimizer import make_minimizer
+from ParallelForce import ParallelForce
+from DomainDecomposition import DomainDecomposition, DomainIntegrator
+from BinaryTrajectory import BinaryTrajectoryWriter, get_box
+from OutputWriter import AsyncWriter
+from Checkpoint import Checkpointer, load_latest_checkpoint
+from Metrics import Metrics, load_metrics
+from Telemetry import TelemetryWriter
+from Reorder import get_order
 from CaseData import CaseData
+from gen_initial_state import FCCMaker
 from tqdm import tqdm
 from constant import *
 
@@ -10,32 +25,67 @@ class Driver:
     def __init__(self, casedata: CaseData):
         self.casedata_ = casedata
         self.cell_ = None
+        self.integrator_ = None
+        self.minimizer_ = None
+        self.parallel_force_ = None
+        self.domains_ = None
+        self.traj_writer_ = None
+        self.output_writer_ = None
+        self.checkpointer_ = None
+        self.metrics_ = None
+        self.telemetry_ = None
+        self.bytes_written_ = 0  # 同期出力とclose済みのwriterが書いたバイト数
         self.n_atoms_ = 0
         self.current_step_ = 0
+        self.time_ = 0.0  # simulated time [s]
         self.counter_ = 0  # for checking relaxation
+        self.n_stretch_ = 0  # このrunで箱を伸ばした回数
+        self.before_stretch_ = None  # 箱を伸ばす直前に呼ぶ関数 (run で指定する)
         self.load()
 
     def load(self):
         atom_list = []
+        checkpoint = initial = None
 
         # restartのとき
         if self.casedata_.restart_:
-            if not os.path.exists(self.casedata_.restart_file_):
+            checkpoint = load_latest_checkpoint(self.casedata_.restart_file_)
+            if checkpoint is None and not os.path.exists(self.casedata_.restart_file_):
                 raise ValueError("No restart file found. You must set the value 'restart' false.")
+        if checkpoint is not None:
+            self.current_step_ = int(checkpoint['step'])
+            self.counter_ = int(checkpoint['counter'])
+            if 'dt' in checkpoint:
+                self.casedata_.dt_ = float(checkpoint['dt'])
+            self.time_ = float(checkpoint['time']) if 'time' in checkpoint else self.current_step_ * self.casedata_.dt_
+            self.casedata_.n_loop_ += self.current_step_
+            self.n_atoms_ = len(checkpoint['kind'])
+        elif self.casedata_.restart_:
             with open(self.casedata_.restart_file_, 'r') as f:
                 for i, line in enumerate(f):
                     line.strip('\n')
                     if i == 0:
-                        self.current_step_ = int(line.split()[-1])
+                        # #step <step> time <time> dt <dt> (古いファイルは #step <step> だけ)
+                        words = line.split()
+                        header = dict(zip(words[::2], words[1::2]))
+                        self.current_step_ = int(header['#step'])
                         self.casedata_.n_loop_ += self.current_step_
+                        if 'dt' in header:
+                            self.casedata_.dt_ = float(header['dt'])
+                        self.time_ = float(header['time']) if 'time' in header else self.current_step_ * self.casedata_.dt_
                         continue
                     kind, x, y, z, vx, vy, vz = line.split()
                     a = Atom(kind, [x, y, z], [vx, vy, vz])
                     atom_list.append(a)
                     self.n_atoms_ += 1
-            with open(self.casedata_.restart_file_, 'w') as f:
-                pass
-            
+        elif self.casedata_.in_file_.endswith('.npz'):
+            # gen_initial_state.LatticeMaker.to_npz で作ったバイナリの入力
+            with np.load(self.casedata_.in_file_) as data:
+                initial = {key: data[key] for key in ['kind', 'r', 'v']}
+                if 'counter' in data:
+                    # 緩和を待っている途中の状態 (parallel_stretch の区間の初期状態) なら、待ったステップ数も引き継ぐ
+                    self.counter_ = int(data['counter'])
+            self.n_atoms_ = len(initial['kind'])
         else:
             with open(self.casedata_.in_file_, 'r') as f:
                 for line in f:
@@ -46,128 +96,500 @@ class Driver:
                     self.n_atoms_ += 1
 
         self.cell_ = Cell(self.casedata_, atom_list)
+        if checkpoint is not None:
+            self.cell_.set_atoms(checkpoint['kind'], checkpoint['r'], checkpoint['v'], checkpoint['a'])
+            if 'id' in checkpoint:
+                self.cell_.set_ids(checkpoint['id'])
+            if self.cell_.neighbor_list_ is not None:
+                self.cell_.neighbor_list_.set_state(checkpoint)
+        elif initial is not None:
+            self.cell_.set_atoms(initial['kind'], initial['r'], initial['v'])
+        if self.casedata_.traj_format_ == 'binary':
+            self.traj_writer_ = BinaryTrajectoryWriter(
+                self.casedata_.out_file_traj_, self.cell_.in_id_order(self.cell_.kind_), get_box(self.cell_.d1_, self.cell_.d2_),
+                self.casedata_.traj_dtype_, self.casedata_.traj_compression_, self.casedata_.traj_chunk_)
+        if self.casedata_.async_output_:
+            self.output_writer_ = AsyncWriter(self.casedata_.output_queue_, self.casedata_.flush_interval_)
+        if self.casedata_.workers_ > 1:
+            self.parallel_force_ = ParallelForce(self.casedata_, self.cell_.type_, self.casedata_.workers_)
+        if self.casedata_.telemetry_file_ is not None:
+            self.telemetry_ = TelemetryWriter(self.casedata_.telemetry_file_, self.casedata_.telemetry_size_, self.n_atoms_)
+        if self.casedata_.metrics_file_ is not None:
+            self.set_metrics()
+        calc_force = self.calc_force if self.metrics_ is None else self.calc_force_with_metrics
+        timestep = None
+        if self.casedata_.adaptive_dt_:
+            timestep = TimestepController(
+                self.casedata_, self.casedata_.dt_min_, self.casedata_.dt_max_,
+                self.casedata_.max_displacement_, self.casedata_.max_velocity_change_, self.casedata_.dt_growth_)
+        if self.casedata_.domains_ is not None:
+            # 時間発展は領域ごとのワーカーが行う
+            self.domains_ = DomainDecomposition(self.casedata_, self.cell_)
+            self.integrator_ = DomainIntegrator(self.cell_, self.domains_, self.casedata_.relax_, timestep)
+        else:
+            self.integrator_ = make_integrator(self.casedata_.integrator_, self.cell_, calc_force, timestep)
+        if self.casedata_.minimizer_ is not None:
+            self.minimizer_ = make_minimizer(
+                self.casedata_.minimizer_, self.cell_, calc_force, self.casedata_.dt_,
+                self.casedata_.minimize_fmax_, self.casedata_.minimize_etol_, self.casedata_.minimize_max_iter_)
+            if self.metrics_ is not None:
+                self.minimizer_.minimize = self.metrics_.wrap(self.minimizer_.minimize, 'minimize')
+        if checkpoint is not None:
+            # 保存時に加速度が有効だったなら、そのまま続きから使える
+            self.integrator_.force_valid_ = bool(checkpoint['force_valid'])
+        self.checkpointer_ = Checkpointer(
+            self.casedata_.restart_file_, self.casedata_.checkpoint_interval_,
+            self.casedata_.checkpoint_minutes_, self.casedata_.checkpoint_keep_)
 
-    def run(self):
-        for i in tqdm(range(self.casedata_.n_loop_ - self.current_step_)):
-            if self.current_step_ % self.casedata_.interval_ == 0:
-                self.do_step_with_output()
-                self.write_trajectory()
-                self.write_energy()
-                self.write_cell_state()
-            else:
-                self.do_step()
-            self.current_step_ += 1
+    def set_metrics(self):
+        # 計測しないときに余計な処理が入らないよう、計測するときだけメソッドを時間を測るものに置き換える
+        self.metrics_ = Metrics(self.casedata_.metrics_file_, self.casedata_.metrics_interval_,
+                                self.casedata_.profile_steps_, self.casedata_.profile_file_)
+        self.cell_.migrate = self.metrics_.wrap(self.cell_.migrate, 'migrate')
+        self.relax = self.metrics_.wrap(self.relax, 'relax')
+        self.reorder = self.metrics_.wrap(self.reorder, 'reorder')
+        self.stretch = self.metrics_.wrap(self.stretch, 'stretch')
+        for name in ['write_trajectory', 'write_energy', 'write_cell_state', 'write_stress', 'publish_telemetry']:
+            setattr(self, name, self.metrics_.wrap(getattr(self, name), 'output'))
+        for name in ['write_restart', 'write_checkpoint']:
+            setattr(self, name, self.metrics_.wrap(getattr(self, name), 'checkpoint'))
+
+    def run(self, max_stretch=None, before_stretch=None):
+        # max_stretch を指定したときは、その回数だけ箱を伸ばしたステップで止める
+        # before_stretch を指定したときは、箱を伸ばす直前 (そのステップの時間発展の後) に呼ぶ
+        self.before_stretch_ = before_stretch
+        try:
+            for i in tqdm(range(self.casedata_.n_loop_ - self.current_step_)):
+                if self.metrics_ is not None:
+                    self.metrics_.start_step(self.current_step_)
+                if self.casedata_.reorder_interval_ > 0 and self.current_step_ % self.casedata_.reorder_interval_ == 0:
+                    self.reorder()
+                if self.current_step_ % self.casedata_.interval_ == 0:
+                    self.do_step_with_output()
+                    self.write_trajectory()
+                    self.write_energy()
+                    self.write_cell_state()
+                    self.write_stress()
+                    self.publish_telemetry()
+                else:
+                    self.do_step()
+                self.current_step_ += 1
+                self.time_ += self.casedata_.dt_
+                if self.checkpointer_.is_due(self.current_step_):
+                    self.write_checkpoint()
+                if self.metrics_ is not None:
+                    self.metrics_.end_step(self.current_step_)
+                    if self.metrics_.is_due(self.current_step_):
+                        self.write_metrics()
+                if max_stretch is not None and self.n_stretch_ >= max_stretch:
+                    break
+
+            self.write_restart()
+            self.write_checkpoint()
+        finally:
+            self.close()
+            if self.metrics_ is not None:
+                # 書き込みスレッドが書き切った後のバイト数を残す
+                self.write_metrics()
+                self.metrics_.close()
 
-        self.write_restart()
+    def close(self):
+        # 書き込みスレッドを先に止めて、キューに残った出力を書き切ってから他を閉じる
+        try:
+            if self.output_writer_ is not None:
+                output_writer, self.output_writer_ = self.output_writer_, None
+                output_writer.close()
+                self.bytes_written_ += output_writer.bytes_written_
+        finally:
+            if self.parallel_force_ is not None:
+                self.parallel_force_.close()
+                self.parallel_force_ = None
+            if self.domains_ is not None:
+                self.domains_.close()
+                self.domains_ = None
+            if self.traj_writer_ is not None:
+                self.traj_writer_.close()
+                self.bytes_written_ += self.traj_writer_.bytes_written_
+                self.traj_writer_ = None
+            if self.telemetry_ is not None:
+                self.telemetry_.close()
+                self.telemetry_ = None
 
     def do_step(self):
-        self.calc_force()
-        self.update_velocity_half()
-        self.update_position()
-        self.migrate()
-        self.calc_force()
-        self.update_velocity_half()
+        self.integrator_.step()
         if self.casedata_.relax_:
             self.relax()
         if self.casedata_.need_stretch_:
             self.stretch()
 
     def do_step_with_output(self):
-        self.calc_force()
-        self.update_velocity_half()
-        self.update_position()
-        self.migrate()
-        self.calc_force_and_up()
-        self.update_velocity_half_and_calc_uk()
+        self.integrator_.step(calc_energy=True)
         if self.casedata_.relax_:
             self.relax()
         if self.casedata_.need_stretch_:
             self.stretch()
 
-    def calc_force(self):
+    def calc_force(self, calc_up=False):
         self.cell_.clear_force()
-        self.cell_.calc_force()
-        # periodic B.C.
-        for offset in self.casedata_.offsets_:
-            self.cell_.calc_force_with_surrounding(offset)
-
-    def calc_force_and_up(self):
-        self.cell_.clear_force()
-        self.cell_.calc_force_and_up()
-        # periodic B.C.
-        for offset in self.casedata_.offsets_:
-            self.cell_.calc_force_and_up_with_surrounding(offset)
-
-    def update_velocity_half(self):
-        self.cell_.update_velocity_half()
+        if self.parallel_force_ is not None:
+            self.parallel_force_.calc_force(self.cell_, calc_up)
+            return
+        if self.cell_.neighbor_list_ is not None:
+            if calc_up:
+                self.cell_.calc_force_and_up_with_neighbor_list()
+            else:
+                self.cell_.calc_force_with_neighbor_list()
+            return
+        if self.casedata_.minimum_image_:
+            if calc_up:
+                self.cell_.calc_force_and_up_with_minimum_image()
+            else:
+                self.cell_.calc_force_with_minimum_image()
+            return
+        if calc_up:
+            self.cell_.calc_force_and_up()
+            # periodic B.C.
+            for offset in self.casedata_.offsets_:
+                self.cell_.calc_force_and_up_with_surrounding(offset)
+        else:
+            self.cell_.calc_force()
+            # periodic B.C.
+            for offset in self.casedata_.offsets_:
+                self.cell_.calc_force_with_surrounding(offset)
 
-    def update_velocity_half_and_calc_uk(self):
-        self.cell_.update_velocity_half_and_calc_uk()
+    def calc_force_with_metrics(self, calc_up=False):
+        start = time.perf_counter()
+        self.calc_force(calc_up)
+        self.metrics_.add_force(time.perf_counter() - start, self.count_pair_evaluations())
 
-    def update_position(self):
-        self.cell_.update_position()
+    def count_pair_evaluations(self):
+        # 1回の力の計算で距離を評価するペアの数
+        n = self.n_atoms_
+        if self.cell_.neighbor_list_ is not None and self.parallel_force_ is None:
+            return len(self.cell_.neighbor_list_.i_)
+        if self.casedata_.minimum_image_:
+            return n * (n - 1) // 2
+        if self.parallel_force_ is not None:
+            # 像ごとに i < j のペアと、片方の向きの自分自身の像
+            n_images = 3 ** int(np.count_nonzero(self.casedata_.periodic_))
+            return n_images * n * (n - 1) // 2 + (n_images - 1) // 2 * n
+        return n * (n - 1) // 2 + len(self.casedata_.offsets_) * n * n
 
-    def migrate(self):
-        self.cell_.migrate()
+    def reorder(self):
+        # 空間的に近い原子がメモリ上でも近くに並ぶように、空間充填曲線に沿って並べ替える
+        # 加速度も一緒に並べ替えるので、力を計算し直す必要はない
+        self.cell_.reorder(get_order(self.cell_.r_, self.cell_.d1_, self.cell_.d2_, self.casedata_.reorder_curve_))
+        if self.parallel_force_ is not None:
+            self.parallel_force_.set_types(self.cell_.type_)
 
     def relax(self):
-        self.cell_.relax()
+        if self.domains_ is not None:
+            n_stopped = self.integrator_.n_stopped_  # ワーカーがステップの最後に止めている
+        else:
+            n_stopped = self.cell_.relax()
+        if self.metrics_ is not None:
+            self.metrics_.add_relax(n_stopped)
 
     def stretch(self):
         self.counter_ += 1
-        if self.counter_ < 50:  # ある程度時間が経たないと速度が出ず、緩和したかどうか判定できない
+        if self.minimizer_ is None:
+            if self.counter_ < 50:  # ある程度時間が経たないと速度が出ず、緩和したかどうか判定できない
+                return
+            if not (self.cell_.is_relaxed() if self.domains_ is None else self.domains_.is_relaxed()):
+                return
+        if self.before_stretch_ is not None:
+            self.before_stretch_()
+        new_box_size = self.casedata_.box_size_ * self.casedata_.stretch_eps_
+        # print('%05d (%03d) %.03e -> %.03e' % (self.current_step_, self.counter_, self.casedata_.box_size_[0], new_box_size[0]))
+        self.casedata_.set_box_size(new_box_size)
+        self.cell_.stretch()
+        if self.domains_ is not None:
+            self.domains_.stretch(self.cell_.d1_, self.cell_.d2_, self.casedata_.stretch_eps_)
+        if self.minimizer_ is not None:
+            # 緩和を待つ代わりに、ひずみを加えるたびにエネルギー最小の配置まで動かす
+            if not self.minimizer_.minimize():
+                tqdm.write(f'Minimization did not converge in {self.minimizer_.n_iter_} iterations at step {self.current_step_}.')
+        self.integrator_.invalidate()
+        self.counter_ = 0
+        self.n_stretch_ += 1
+        if self.metrics_ is not None:
+            self.metrics_.n_stretch_ += 1
+
+    def output(self, filename, func, *args):
+        # func(*args) の結果を filename に追記する。非同期出力のときは書き込みスレッドに任せる
+        if self.output_writer_ is not None:
+            self.output_writer_.put(filename, func, *args)
             return
-        if self.cell_.is_relaxed():
-            new_box_size = self.casedata_.box_size_ * self.casedata_.stretch_eps_
-            # print('%05d (%03d) %.03e -> %.03e' % (self.current_step_, self.counter_, self.casedata_.box_size_[0], new_box_size[0]))
-            self.casedata_.set_box_size(new_box_size)
-            self.cell_.stretch()
-            self.counter_ = 0
+        result = func(*args)
+        if filename is not None:
+            with open(filename, 'a') as f:
+                f.write(result)
+            self.bytes_written_ += len(result)
 
     def write_trajectory(self):
-        trajectory_str = ''
-        trajectory_str += f'{self.n_atoms_}\n'
-        trajectory_str += f'#step {self.current_step_}\n'
-        trajectory_str += self.cell_.get_trajectory()
-
-        with open(self.casedata_.out_file_traj_, 'a') as f:
-            f.write(trajectory_str)
+        if self.traj_writer_ is not None:
+            self.output(None, self.traj_writer_.write, self.current_step_, self.time_, get_box(self.cell_.d1_, self.cell_.d2_),
+                        self.cell_.in_id_order(self.cell_.r_), self.cell_.in_id_order(self.cell_.v_))
+            return
+        self.output(self.casedata_.out_file_traj_, format_trajectory, self.current_step_, self.time_,
+                    self.cell_.in_id_order(self.cell_.kind_), self.cell_.in_id_order(self.cell_.r_), self.cell_.in_id_order(self.cell_.v_))
 
     def write_energy(self):
-        up = uk = 0
-        up += self.cell_.up_
-        uk += self.cell_.uk_
-        temperature = uk / (1.5 * self.n_atoms_ * kB)
-
-        with open(self.casedata_.out_file_energy_, 'a') as f:
-            f.write(f'{self.current_step_} {up} {uk} {temperature}\n')
+        self.output(self.casedata_.out_file_energy_, format_energy, self.current_step_, self.cell_.up_, self.cell_.uk_, self.n_atoms_, self.time_)
 
     def write_cell_state(self):
-        cell_str = f'{self.current_step_} '
-        d1 = self.cell_.d1_ * 1e10
-        d2 = self.cell_.d2_ * 1e10
-        cell_str += f'{d2[0] - d1[0]} 0 0 '
-        cell_str += f'0 {d2[1] - d1[1]} 0 '
-        cell_str += f'0 0 {d2[2] - d1[2]} '
-        cell_str += ' '.join(d1.astype(str))
-        cell_str += '\n'
-        with open(self.casedata_.out_file_cell_, 'a') as f:
-            f.write(cell_str)
+        self.output(self.casedata_.out_file_cell_, format_cell_state, self.current_step_, self.cell_.d1_, self.cell_.d2_)
+
+    def write_stress(self):
+        if self.casedata_.out_file_stress_ is None:
+            return
+        self.output(self.casedata_.out_file_stress_, format_stress, self.current_step_, self.cell_.get_stress())
+
+    def publish_telemetry(self):
+        # ログと同じ値をリングバッファにも書く。ファイルに追記せず文字列にもしないので、監視のための負担はほぼない
+        if self.telemetry_ is None:
+            return
+        self.telemetry_.write(self.current_step_, self.time_, self.cell_.up_, self.cell_.uk_, get_temperature(self.cell_.uk_, self.n_atoms_),
+                              self.cell_.d2_ - self.cell_.d1_, to_voigt(self.cell_.get_stress()))
+
+    def sync_cell(self):
+        # 領域分割のときは、ワーカーが持っている最新の原子を集める
+        if self.domains_ is not None:
+            self.domains_.gather(self.cell_)
 
     def write_restart(self):
+        self.sync_cell()
         restart_str = ''
-        restart_str += f'#step {self.current_step_}\n'
+        restart_str += f'#step {self.current_step_} time {self.time_} dt {self.casedata_.dt_}\n'
         restart_str += self.cell_.get_restart()
 
-        with open(self.casedata_.restart_file_, 'a') as f:
+        # 書き込み中に落ちても前のrestartファイルが残るように、一時ファイルからrenameする
+        tmp_filename = self.casedata_.restart_file_ + '.tmp'
+        with open(tmp_filename, 'w') as f:
             f.write(restart_str)
+        os.replace(tmp_filename, self.casedata_.restart_file_)
+
+    def get_state(self):
+        self.sync_cell()
+        # 並べ替えた今の行の順のまま保存し、各行の原子IDも残す (続きの力の足し算の順を変えないため)
+        return {
+            'kind': self.cell_.kind_,
+            'r': self.cell_.r_,
+            'v': self.cell_.v_,
+            'a': self.cell_.a_,
+            'id': self.cell_.id_,
+            'box_size': self.casedata_.box_size_,
+            'd1': self.cell_.d1_,
+            'd2': self.cell_.d2_,
+            'step': self.current_step_,
+            'time': self.time_,
+            'dt': self.casedata_.dt_,
+            'counter': self.counter_,
+            'force_valid': self.integrator_.force_valid_,
+            **(self.cell_.neighbor_list_.get_state() if self.cell_.neighbor_list_ is not None else {}),
+        }
+
+    def write_checkpoint(self):
+        self.checkpointer_.save(self.get_state(), self.current_step_)
+
+    def get_bytes_written(self):
+        bytes_written = self.bytes_written_
+        if self.output_writer_ is not None:
+            bytes_written += self.output_writer_.bytes_written_
+        if self.traj_writer_ is not None:
+            bytes_written += self.traj_writer_.bytes_written_
+        return bytes_written
+
+    def write_metrics(self):
+        neighbor_list = self.cell_.neighbor_list_
+        self.metrics_.write(self.current_step_, {
+            'neighbor_builds': neighbor_list.n_build_ if neighbor_list is not None else 0,
+            'output_bytes': self.get_bytes_written(),
+            'steps_since_stretch': self.counter_,  # 緩和待ちで止まっていないかの目安
+            'minimizer_force_calls': self.minimizer_.n_force_calls_ if self.minimizer_ is not None else 0,
+            'box_size': self.casedata_.box_size_.tolist(),
+            'time': self.time_,
+            'dt': self.casedata_.dt_,
+        })
+
+
+def format_trajectory(step, time, kinds, r, v):
+    trajectory_str = ''
+    trajectory_str += f'{len(kinds)}\n'
+    trajectory_str += f'#step {step} time {time}\n'
+    trajectory_str += format_atoms(kinds, r * 1e10, v)
+    return trajectory_str
+
+
+def get_temperature(uk, n_atoms):
+    return uk / (1.5 * n_atoms * kB)
+
+
+def format_energy(step, up, uk, n_atoms, time):
+    temperature = get_temperature(uk, n_atoms)
+    return f'{step} {up} {uk} {temperature} {time}\n'
+
+
+def format_cell_state(step, d1, d2):
+    cell_str = f'{step} '
+    d1 = d1 * 1e10
+    d2 = d2 * 1e10
+    cell_str += f'{d2[0] - d1[0]} 0 0 '
+    cell_str += f'0 {d2[1] - d1[1]} 0 '
+    cell_str += f'0 0 {d2[2] - d1[2]} '
+    cell_str += ' '.join(d1.astype(str))
+    cell_str += '\n'
+    return cell_str
+
+
+def to_voigt(stress):
+    # Voigtの順 (xx, yy, zz, yz, xz, xy)
+    return stress[[0, 1, 2, 1, 0, 0], [0, 1, 2, 2, 2, 1]]
+
+
+def format_stress(step, stress):
+    # Pa
+    voigt = to_voigt(stress)
+    return f'{step} {" ".join(voigt.astype(str))}\n'
 
 
 def test_periodic(dr: Driver):
     dr.run()
 
 
+def test_reorder(n_steps=200):
+    # 入力の順をばらばらにした2種類の原子の系で、並べ替えありとなしの出力が原子IDの順で一致するか
+    maker = FCCMaker(4.05e-10, [3, 3, 3], 'Al', 300, seed=0)
+    maker.make()
+    rng = np.random.default_rng(0)
+    shuffle = rng.permutation(len(maker.lattice_))
+    kind = np.where(np.arange(len(shuffle)) % 4 == 0, 'Ni', 'Al')
+    with tempfile.TemporaryDirectory() as work_dir:
+        in_file = os.path.join(work_dir, 'initial.npz')
+        np.savez(in_file, kind=kind, r=maker.lattice_[shuffle], v=maker.vel_[shuffle])
+        results = {}
+        for name, options in [('reference', {}), ('hilbert', {'reorder_interval': 20}),
+                              ('morton', {'reorder_interval': 20, 'reorder_curve': 'morton', 'traj_format': 'binary'}),
+                              ('workers', {'reorder_interval': 20, 'workers': 2})]:
+            case_dir = os.path.join(work_dir, name)
+            os.makedirs(case_dir)
+            case_dict = {
+                "in_file": in_file,
+                "out_file_traj": os.path.join(case_dir, 'traj'),
+                "out_file_energy": os.path.join(case_dir, 'energy.out'),
+                "out_file_cell": os.path.join(case_dir, 'cell.out'),
+                "restart_file": os.path.join(case_dir, 'restart.tmp'),
+                "restart": False,
+                "dt": 1e-15,
+                "cutoff": 6e-10,
+                "n_loop": n_steps,
+                "interval": 50,
+                "box_size": maker.get_box_size().tolist(),
+                "periodic": [True, True, True],
+                "relax": False,
+                "stretch_eps": [0, 0, 0],
+                "neighbor_list": True,
+                "params_file": './data/params_Ni.json',
+            }
+            case_dict.update(options)
+            dr = Driver(CaseData(case_dict=case_dict))
+            dr.run()
+            with open(case_dict["restart_file"], 'r') as f:
+                restart = f.readlines()[1:]
+            results[name] = (np.array([line.split()[0] for line in restart]), np.array([line.split()[1:] for line in restart], dtype=float),
+                             np.loadtxt(case_dict["out_file_energy"])[:, 1], dr.cell_.order_)
+    kind_ref, atoms_ref, energy_ref, _ = results['reference']
+    for name, (kind, atoms, energy, order) in results.items():
+        if order is None and name != 'reference':
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {name} was not reordered')
+            return
+        if not np.array_equal(kind, kind_ref) or not np.allclose(atoms, atoms_ref, rtol=1e-6, atol=1e-16) or not np.allclose(energy, energy_ref, rtol=1e-8):
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {name}: max deviation {np.max(np.abs(atoms - atoms_ref))}')
+            return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def test_reorder_restart(n_steps=300):
+    # 並べ替えと Verlet リストを使っていても、チェックポイントから続けた計算は通しの計算とビット単位で一致する
+    maker = FCCMaker(4.05e-10, [4, 4, 4], 'Al', 300, seed=0)
+    maker.make()
+    shuffle = np.random.default_rng(0).permutation(len(maker.lattice_))
+    with tempfile.TemporaryDirectory() as work_dir:
+        in_file = os.path.join(work_dir, 'initial.npz')
+        np.savez(in_file, kind=np.full(len(shuffle), 'Al'), r=maker.lattice_[shuffle], v=maker.vel_[shuffle])
+
+        def run(name, n_loop, restart):
+            case_dir = os.path.join(work_dir, name)
+            case_dict = {
+                "in_file": in_file,
+                "out_file_traj": os.path.join(case_dir, 'traj.bin'),
+                "out_file_energy": os.path.join(case_dir, 'energy.out'),
+                "out_file_cell": os.path.join(case_dir, 'cell.out'),
+                "restart_file": os.path.join(case_dir, 'restart.tmp'),
+                "restart": restart,
+                "dt": 1e-15,
+                "cutoff": 6e-10,
+                "n_loop": n_loop,
+                "interval": 10,
+                "box_size": maker.get_box_size().tolist(),
+                "periodic": [True, True, True],
+                "relax": False,
+                "stretch_eps": [0, 0, 0],
+                "neighbor_list": True,
+                "reorder_interval": 20,
+                "checkpoint_interval": 50,
+                "traj_format": 'binary',
+            }
+            Driver(CaseData(case_dict=case_dict)).run()
+            with open(case_dict["out_file_energy"], 'r') as f:
+                return f.read()
+
+        uninterrupted = run('uninterrupted', n_steps, False)
+        run('resumed', n_steps // 2, False)
+        resumed = run('resumed', n_steps // 2, True)
+    if resumed != uninterrupted:
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. energy logs differ')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def test_metrics_phases(n_steps=30):
+    # 最小化の中の力の計算を force と stretch の両方に数えると、残りとして求める integration が負になる
+    with tempfile.TemporaryDirectory() as work_dir:
+        case_dict = {
+            "in_file": './data/Al_fcc_27.in',
+            "out_file_traj": os.path.join(work_dir, 'traj.xyz'),
+            "out_file_energy": os.path.join(work_dir, 'energy.out'),
+            "out_file_cell": os.path.join(work_dir, 'cell.out'),
+            "restart_file": os.path.join(work_dir, 'restart.tmp'),
+            "metrics_file": os.path.join(work_dir, 'metrics.jsonl'),
+            "restart": False,
+            "dt": 1e-15,
+            "cutoff": 6e-10,
+            "n_loop": n_steps,
+            "interval": 10,
+            "box_size": [12.15e-10, 12.15e-10, 12.15e-10],
+            "periodic": [True, True, True],
+            "relax": False,
+            "stretch_eps": [0.001, 0, 0],
+            "neighbor_list": True,
+            "minimizer": 'fire',
+        }
+        dr = Driver(CaseData(case_dict=case_dict))
+        dr.run()
+        summary = load_metrics(case_dict["metrics_file"])[-1]
+    phase_time = summary['phase_time']
+    total = summary['total_time']
+    if min(phase_time.values()) < 0 or not np.isclose(sum(phase_time.values()), total, rtol=1e-9) or phase_time['minimize'] <= 0:
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. {phase_time} (total {total})')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
 def main():
+    test_reorder()
+    test_reorder_restart()
+    test_metrics_phases()
     casedata = CaseData('./data/case0.json')
     dr = Driver(casedata)
     test_periodic(dr)
@@ -0,0 +1,124 @@
+import numpy as np
+from Cell import Cell
+
+
+class TimestepController:
+    # 1ステップでの最大変位と最大速度変化が上限を超えないようにdtを選ぶ
+    def __init__(self, casedata, dt_min, dt_max, max_displacement, max_velocity_change, growth=1.05):
+        self.casedata_ = casedata
+        self.dt_min_ = dt_min
+        self.dt_max_ = dt_max
+        self.max_displacement_ = max_displacement  # m
+        self.max_velocity_change_ = max_velocity_change  # m/s
+        self.growth_ = growth  # 1ステップで大きくできる割合 (小さくするのはすぐに行う)
+
+    def update(self, cell: Cell):
+        v_max = np.sqrt(np.max(np.sum(cell.v_ * cell.v_, axis=1), initial=0))
+        a_max = np.sqrt(np.max(np.sum(cell.a_ * cell.a_, axis=1), initial=0))
+        return self.choose(v_max, a_max)
+
+    def choose(self, v_max, a_max):
+        # 原子の速さと加速度の最大値からdtを決める
+        dt = self.dt_max_
+        if a_max > 0:
+            dt = min(dt, self.max_velocity_change_ / a_max)
+            # v dt + a dt^2 / 2 = max_displacement を解く
+            dt = min(dt, 2 * self.max_displacement_ / (v_max + np.sqrt(v_max * v_max + 2 * a_max * self.max_displacement_)))
+        elif v_max > 0:
+            dt = min(dt, self.max_displacement_ / v_max)
+        dt = min(dt, self.casedata_.dt_ * self.growth_)
+        self.casedata_.dt_ = max(dt, self.dt_min_)
+        return self.casedata_.dt_
+
+
+class Integrator:
+    def __init__(self, cell: Cell, calc_force, timestep: TimestepController = None):
+        self.cell_ = cell
+        self.calc_force_ = calc_force  # calc_force(calc_up) で加速度(とポテンシャルエネルギー)を計算する
+        self.timestep_ = timestep  # Noneならdtは固定
+        self.force_valid_ = False  # cell_.a_ が現在の位置での加速度になっているか
+        self.n_force_calls_ = 0
+
+    def invalidate(self):
+        # 箱の変形や原子の並べ替えなどで位置が変わったときに呼ぶ
+        self.force_valid_ = False
+
+    def update_force(self, calc_up=False):
+        self.calc_force_(calc_up)
+        self.force_valid_ = True
+        self.n_force_calls_ += 1
+
+    def step(self, calc_energy=False):
+        raise NotImplementedError
+
+
+class VelocityVerlet(Integrator):
+    def step(self, calc_energy=False):
+        # 前のステップの後半で計算した力がまだ使えるなら再計算しない
+        if not self.force_valid_:
+            self.update_force()
+        if self.timestep_ is not None:
+            # 現在の速度と加速度からこのステップのdtを決める
+            self.timestep_.update(self.cell_)
+        self.cell_.update_velocity_half()
+        self.cell_.update_position()
+        self.cell_.migrate()
+        self.update_force(calc_up=calc_energy)
+        if calc_energy:
+            self.cell_.update_velocity_half_and_calc_uk()
+        else:
+            self.cell_.update_velocity_half()
+
+
+INTEGRATORS = {
+    'velocity_verlet': VelocityVerlet,
+}
+
+
+def make_integrator(name, cell: Cell, calc_force, timestep: TimestepController = None):
+    if name not in INTEGRATORS:
+        raise ValueError(f"Unknown integrator '{name}'. Choose from {list(INTEGRATORS)}.")
+    return INTEGRATORS[name](cell, calc_force, timestep)
+
+
+def test_precision_drift(n_steps=2000, interval=10):
+    # 単精度と倍精度で同じNVEの計算をし、全エネルギーのずれ (1原子あたり, eV) を比べる
+    import inspect
+    from CaseData import CaseData
+    from Cell import make_test_cell
+
+    drift = {}
+    for precision in ['double', 'single']:
+        casedata = CaseData('./data/case0.json')
+        casedata.minimum_image_ = True
+        casedata.precision_ = precision
+        casedata.dtype_ = np.float32 if precision == 'single' else np.float64
+        cell = make_test_cell(casedata, scale=0)
+
+        def calc_force(calc_up=False):
+            cell.clear_force()
+            cell.calc_pair_force_minimum_image(calc_up)
+
+        integrator = make_integrator('velocity_verlet', cell, calc_force)
+        energy = []
+        for step in range(n_steps):
+            integrator.step(calc_energy=step % interval == 0)
+            if step % interval == 0:
+                energy.append(cell.up_ + cell.uk_)
+        energy = np.array(energy)
+        drift[precision] = np.max(np.abs(energy - energy[0])) / cell.n_atoms_ / 1.6e-19
+    print(f'energy drift per atom over {n_steps} steps: double {drift["double"]:.3e} eV, single {drift["single"]:.3e} eV')
+
+    # 単精度の丸め誤差は、速度Verletの時間刻みによる揺らぎと同程度に収まっていてほしい
+    if drift['single'] > 2 * drift['double'] + 1e-5:
+        print(f'Failed in {inspect.currentframe().f_code.co_name}')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_precision_drift()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import json
+import time
+import bisect
+import cProfile
+import numpy as np
+
+
+PHASES = ['force', 'integration', 'migrate', 'relax', 'reorder', 'stretch', 'minimize', 'output', 'checkpoint']
+# ステップ時間のヒストグラムのビンの上端 (s)。1 µsから100 sまで、1桁を10個に分ける
+STEP_TIME_BINS = np.logspace(-6, 2, 81).tolist()
+
+
+class Metrics:
+    def __init__(self, filename, interval=1000, profile_steps=None, profile_file=None):
+        self.filename_ = filename
+        self.interval_ = interval  # 何ステップごとに書き出すか
+        self.phase_time_ = dict.fromkeys(PHASES, 0.0)
+        self.step_hist_ = [0] * (len(STEP_TIME_BINS) + 1)  # 最後のビンは上限を超えたもの
+        self.step_time_ = 0.0
+        self.max_step_time_ = 0.0
+        self.n_steps_ = 0
+        self.n_force_calls_ = 0
+        self.n_pairs_ = 0  # 距離を評価した原子のペアの数
+        self.n_relax_ = 0
+        self.n_stopped_atoms_ = 0  # relaxで速度を0にした原子の数
+        self.n_stretch_ = 0
+        self.start_time_ = time.perf_counter()
+        self.step_start_ = 0.0
+        self.nested_time_ = 0.0  # 実行中のフェーズの中で、別のフェーズとして数えた時間
+        self.depth_ = 0  # 実行中のフェーズの入れ子の深さ
+        self.in_step_ = False
+        self.outside_time_ = 0.0  # ステップの外 (最後のrestartなど) で数えたフェーズの時間
+
+        # [start, stop) のステップをcProfileで測る
+        self.profile_steps_ = profile_steps
+        self.profile_file_ = profile_file
+        self.profiler_ = cProfile.Profile() if profile_steps is not None else None
+        self.profiling_ = False
+
+    def wrap(self, func, phase):
+        # func の実行時間を phase に足し込む関数を返す
+        # 中で呼ばれた別のフェーズ (stretch の中の minimize や force など) の時間は、二重に数えないように引く
+        def wrapper(*args, **kwargs):
+            outer_nested_time = self.nested_time_
+            self.nested_time_ = 0.0
+            self.depth_ += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.depth_ -= 1
+                self.phase_time_[phase] += elapsed - self.nested_time_
+                self.nested_time_ = outer_nested_time + elapsed
+                if not self.in_step_ and self.depth_ == 0:
+                    self.outside_time_ += elapsed
+        return wrapper
+
+    def add_force(self, elapsed, n_pairs):
+        self.phase_time_['force'] += elapsed
+        self.nested_time_ += elapsed
+        if not self.in_step_ and self.depth_ == 0:
+            self.outside_time_ += elapsed
+        self.n_force_calls_ += 1
+        self.n_pairs_ += n_pairs
+
+    def add_relax(self, n_stopped):
+        self.n_relax_ += 1
+        self.n_stopped_atoms_ += n_stopped
+
+    def start_step(self, step):
+        if self.profiler_ is not None and not self.profiling_ and self.profile_steps_[0] <= step < self.profile_steps_[1]:
+            self.profiler_.enable()
+            self.profiling_ = True
+        self.nested_time_ = 0.0
+        self.in_step_ = True
+        self.step_start_ = time.perf_counter()
+
+    def end_step(self, step):
+        # step は終わったステップの次のステップ番号
+        elapsed = time.perf_counter() - self.step_start_
+        self.in_step_ = False
+        self.nested_time_ = 0.0
+        self.step_time_ += elapsed
+        self.max_step_time_ = max(self.max_step_time_, elapsed)
+        self.step_hist_[bisect.bisect_left(STEP_TIME_BINS, elapsed)] += 1
+        self.n_steps_ += 1
+        if self.profiling_ and step >= self.profile_steps_[1]:
+            self.stop_profile()
+
+    def is_due(self, step):
+        return self.interval_ > 0 and step % self.interval_ == 0
+
+    def stop_profile(self):
+        self.profiler_.disable()
+        self.profiler_.dump_stats(self.profile_file_)
+        self.profiling_ = False
+        self.profiler_ = None
+
+    def get_summary(self, step, extra):
+        # 積分の時間は、ステップ全体 (とステップの外で数えたフェーズ) から他のフェーズを引いた残り
+        phase_time = dict(self.phase_time_)
+        total_time = self.step_time_ + self.outside_time_
+        phase_time['integration'] = total_time - sum(t for phase, t in phase_time.items() if phase != 'integration')
+        summary = {
+            'step': step,
+            'wall_time': time.perf_counter() - self.start_time_,
+            'n_steps': self.n_steps_,
+            'steps_per_sec': self.n_steps_ / self.step_time_ if self.step_time_ > 0 else 0.0,
+            'phase_time': phase_time,
+            'total_time': total_time,  # phase_time の和
+            'mean_step_time': self.step_time_ / self.n_steps_ if self.n_steps_ > 0 else 0.0,
+            'max_step_time': self.max_step_time_,
+            # [ビンの上端 (s), 回数] の組。回数が0のビンは省く
+            'step_time_hist': [[STEP_TIME_BINS[i] if i < len(STEP_TIME_BINS) else None, n] for i, n in enumerate(self.step_hist_) if n > 0],
+            'force_calls': self.n_force_calls_,
+            'pair_evaluations': self.n_pairs_,
+            'relax_calls': self.n_relax_,
+            'stopped_atoms': self.n_stopped_atoms_,
+            'stretch_events': self.n_stretch_,
+        }
+        summary.update(extra)
+        return summary
+
+    def write(self, step, extra):
+        # 1行に1つのJSONとして追記する (累積値)
+        with open(self.filename_, 'a') as f:
+            f.write(json.dumps(self.get_summary(step, extra)) + '\n')
+
+    def close(self):
+        if self.profiling_:
+            self.stop_profile()
+
+
+def load_metrics(filename):
+    with open(filename, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
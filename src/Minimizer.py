@@ -0,0 +1,201 @@
+import inspect
+import numpy as np
+from Cell import Cell, make_test_cell
+from CaseData import CaseData
+
+
+class Minimizer:
+    def __init__(self, cell: Cell, calc_force, fmax=1.6e-11, etol=0.0, max_iter=10000):
+        self.cell_ = cell
+        self.calc_force_ = calc_force  # calc_force(calc_up) で加速度(とポテンシャルエネルギー)を計算する
+        self.fmax_ = fmax  # 原子にかかる力の最大値がこれを下回ったら収束 (N)
+        self.etol_ = etol  # 1原子あたりのエネルギー変化がこれを下回ったら収束 (J, 0なら使わない)
+        self.max_iter_ = max_iter
+        self.n_iter_ = 0  # 直前の minimize で繰り返した回数
+        self.n_force_calls_ = 0
+
+    def get_force(self):
+        # 加速度に質量を掛けて力に戻す
+        self.calc_force_(True)
+        self.n_force_calls_ += 1
+        return self.cell_.a_ * self.cell_.mass_[:, None]
+
+    def is_force_converged(self, force):
+        return np.max(np.linalg.norm(force, axis=1)) < self.fmax_
+
+    def is_converged(self, force, up, up_old):
+        if self.is_force_converged(force):
+            return True
+        return self.etol_ > 0 and abs(up - up_old) < self.etol_ * self.cell_.n_atoms_
+
+    def minimize(self):
+        # 収束したら True を返す。原子の速度は0にする
+        raise NotImplementedError
+
+
+class FIRE(Minimizer):
+    # Bitzek et al., PRL 97, 170201 (2006)
+    def __init__(self, cell: Cell, calc_force, dt, fmax=1.6e-11, etol=0.0, max_iter=10000,
+                 dt_max_ratio=10.0, n_min=5, f_inc=1.1, f_dec=0.5, alpha_start=0.1, f_alpha=0.99):
+        super().__init__(cell, calc_force, fmax, etol, max_iter)
+        self.dt_start_ = dt
+        self.dt_max_ = dt * dt_max_ratio
+        self.n_min_ = n_min
+        self.f_inc_ = f_inc
+        self.f_dec_ = f_dec
+        self.alpha_start_ = alpha_start
+        self.f_alpha_ = f_alpha
+
+    def minimize(self):
+        cell = self.cell_
+        dt = self.dt_start_
+        alpha = self.alpha_start_
+        n_positive = 0  # 最後に P <= 0 になってからのステップ数
+        v = np.zeros_like(cell.r_)
+        force = self.get_force()
+        up = cell.up_
+        converged = False
+        for self.n_iter_ in range(1, self.max_iter_ + 1):
+            power = np.sum(force * v)
+            if power > 0:
+                # 速度を力の向きに少し曲げる
+                v = (1 - alpha) * v + alpha * np.linalg.norm(v) / np.linalg.norm(force) * force
+                n_positive += 1
+                if n_positive > self.n_min_:
+                    dt = min(dt * self.f_inc_, self.dt_max_)
+                    alpha *= self.f_alpha_
+            elif self.n_iter_ > 1:
+                # 登り坂に入ったら止まってやり直す (最初は速度が0なので P = 0 でも登り坂ではない)
+                v[:] = 0
+                n_positive = 0
+                dt *= self.f_dec_
+                alpha = self.alpha_start_
+            # semi-implicit Euler
+            v += force * cell.inv_mass_[:, None] * dt
+            cell.r_ += v * dt
+            cell.migrate()
+            up_old = up
+            force = self.get_force()
+            up = cell.up_
+            if self.is_converged(force, up, up_old):
+                converged = True
+                break
+        cell.v_[:] = 0
+        return converged
+
+
+class ConjugateGradient(Minimizer):
+    # Polak-Ribière + バックトラッキングの直線探索
+    def __init__(self, cell: Cell, calc_force, fmax=1.6e-11, etol=0.0, max_iter=10000, max_move=1e-11, max_backtrack=20):
+        super().__init__(cell, calc_force, fmax, etol, max_iter)
+        self.max_move_ = max_move  # 直線探索の最初の一歩で原子が動く距離の上限 (m)
+        self.max_backtrack_ = max_backtrack
+
+    def minimize(self):
+        cell = self.cell_
+        force = self.get_force()
+        up = cell.up_
+        direction = force.copy()
+        converged = False
+        for self.n_iter_ in range(1, self.max_iter_ + 1):
+            slope = -np.sum(force * direction)  # 探索方向へのエネルギーの傾き
+            if slope >= 0:
+                # 下り方向でなくなったら最急降下方向からやり直す
+                direction = force.copy()
+                slope = -np.sum(force * force)
+            r_start = cell.r_.copy()
+            step = self.max_move_ / np.max(np.linalg.norm(direction, axis=1))
+            up_old = up
+            for _ in range(self.max_backtrack_):
+                cell.r_[:] = r_start + step * direction
+                cell.migrate()
+                force_new = self.get_force()
+                up = cell.up_
+                if up <= up_old + 1e-4 * step * slope:  # Armijo条件
+                    break
+                step *= 0.5
+            else:
+                # 十分下がる点が見つからなければ元の位置に戻して終わる
+                # エネルギーは動いていないので変化で判定せず、力だけで収束したかを見る
+                cell.r_[:] = r_start
+                force = self.get_force()
+                converged = self.is_force_converged(force)
+                break
+            beta = max(0.0, np.sum(force_new * (force_new - force)) / np.sum(force * force))
+            force = force_new
+            direction = force + beta * direction
+            if self.is_converged(force, up, up_old):
+                converged = True
+                break
+        cell.v_[:] = 0
+        return converged
+
+
+MINIMIZERS = {
+    'fire': FIRE,
+    'cg': ConjugateGradient,
+}
+
+
+def make_minimizer(name, cell: Cell, calc_force, dt, fmax, etol, max_iter):
+    if name not in MINIMIZERS:
+        raise ValueError(f"Unknown minimizer '{name}'. Choose from {list(MINIMIZERS)}.")
+    if name == 'fire':
+        return FIRE(cell, calc_force, dt, fmax, etol, max_iter)
+    return MINIMIZERS[name](cell, calc_force, fmax, etol, max_iter)
+
+
+def test_minimizer():
+    casedata = CaseData('./data/case0.json')
+    casedata.minimum_image_ = True
+    r_start = make_test_cell(casedata).r_
+
+    fmax = 1.6e-12
+    results = {}
+    for name in MINIMIZERS:
+        cell = make_test_cell(casedata)
+
+        def calc_force(calc_up=False):
+            cell.clear_force()
+            cell.calc_pair_force_minimum_image(calc_up)
+
+        calc_force(True)
+        up_start = cell.up_
+        minimizer = make_minimizer(name, cell, calc_force, casedata.dt_, fmax, 0.0, 10000)
+        converged = minimizer.minimize()
+        calc_force(True)
+        results[name] = cell.up_
+        if not converged or np.max(np.linalg.norm(cell.a_ * cell.mass_[:, None], axis=1)) >= fmax or cell.up_ >= up_start:
+            print(f'Failed in {inspect.currentframe().f_code.co_name} ({name}). up: {up_start} -> {cell.up_}')
+            return
+        print(f'{name}: {minimizer.n_iter_} iterations, {minimizer.n_force_calls_} force calls')
+
+    # FIRE の最初の一歩は、設定した dt のまま進む
+    cell = make_test_cell(casedata)
+    calc_force()
+    expected = r_start + cell.a_ * casedata.dt_ ** 2
+    make_minimizer('fire', cell, calc_force, casedata.dt_, fmax, 0.0, 1).minimize()
+    if not np.allclose(cell.r_, expected, rtol=1e-12, atol=1e-22):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. first FIRE step is not dt')
+        return
+
+    # 直線探索で下がる点が見つからないときは、etol を指定していても収束したことにしない
+    cell = make_test_cell(casedata)
+    minimizer = ConjugateGradient(cell, calc_force, fmax, 1e-30, 10000, max_move=1e-9, max_backtrack=1)
+    if minimizer.minimize() or minimizer.n_iter_ != 1 or not np.array_equal(cell.r_, r_start):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. failed line search reported as converged')
+        return
+
+    # どちらも同じ極小に落ちるはず
+    if not np.isclose(results['fire'], results['cg'], rtol=1e-8, atol=0):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. up: {results}')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_minimizer()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import itertools
+import numpy as np
+from CaseData import CaseData
+
+
+class NeighborList:
+    def __init__(self, casedata: CaseData, periodic=None):
+        self.casedata_ = casedata
+        self.skin_ = casedata.skin_
+        # 領域分割のように、ゴースト原子で周期境界を表す場合は periodic を全てFalseにする
+        self.periodic_ = np.array(casedata.periodic_ if periodic is None else periodic, dtype=bool)
+        # ペア(i, j)と周期境界を跨ぐ像のインデックス: r_i - r_j - image * box が実際の変位
+        self.i_ = np.zeros(0, dtype=int)
+        self.j_ = np.zeros(0, dtype=int)
+        self.image_ = np.zeros((0, 3), dtype=int)
+        self.r_last_ = None
+        self.n_build_ = 0
+
+    def invalidate(self):
+        self.r_last_ = None
+
+    def get_state(self):
+        # チェックポイントに保存する。続きから同じ順にペアを足せるように、作り直さずにそのまま戻す
+        if self.r_last_ is None:
+            return {}
+        return {'nl_i': self.i_, 'nl_j': self.j_, 'nl_image': self.image_, 'nl_r_last': self.r_last_}
+
+    def set_state(self, state):
+        if 'nl_r_last' not in state:
+            return
+        self.i_, self.j_, self.image_ = state['nl_i'], state['nl_j'], state['nl_image']
+        self.r_last_ = state['nl_r_last']
+
+    def permute(self, order):
+        # 原子が order の順に並べ替えられたら、作り直さずにペアの番号を付け替える
+        if self.r_last_ is None:
+            return
+        new_index = np.empty(len(order), dtype=int)
+        new_index[order] = np.arange(len(order))
+        i, j = new_index[self.i_], new_index[self.j_]
+        # ペアも新しい番号の順に並べておくと、位置を集めるときも力を足し込むときもメモリを順に読める
+        pairs = np.argsort(i * len(order) + j)
+        self.i_, self.j_, self.image_ = i[pairs], j[pairs], self.image_[pairs]
+        self.r_last_ = self.r_last_[order]
+
+    def needs_update(self, r):
+        if self.r_last_ is None or len(r) != len(self.r_last_):
+            return True
+        # どれかの原子がskinの半分以上動いたらリストを作り直す
+        max_disp = np.sqrt(np.max(np.sum((r - self.r_last_) ** 2, axis=1), initial=0))
+        return max_disp > 0.5 * self.skin_
+
+    def update(self, r, d1, d2):
+        if self.needs_update(r):
+            self.build(r, d1, d2)
+
+    def build(self, r, d1, d2):
+        periodic = self.periodic_
+        r_list = self.casedata_.cutoff_ + self.skin_
+        box = np.array(d2 - d1, dtype=float)
+        if np.any(periodic & (box < r_list)):
+            raise ValueError(f'cutoff + skin ({r_list}) must not exceed the periodic box size ({box}).')
+
+        # 周期方向は箱の中に折り返して、どの像にいるかを覚えておく
+        image = np.where(periodic, np.floor((r - d1) / box), 0).astype(int)
+        r_wrap = r - image * box
+
+        # linked-cell: 一辺がr_list以上のセルに原子を振り分ける
+        lo = np.where(periodic, d1, r_wrap.min(axis=0, initial=np.inf))
+        hi = np.where(periodic, d2, r_wrap.max(axis=0, initial=-np.inf))
+        extent = np.maximum(hi - lo, 0)
+        n_cell = np.maximum(np.floor(extent / r_list).astype(int), 1)
+        cell_len = np.where(extent > 0, extent / n_cell, 1)
+        cell_idx = np.clip(np.floor((r_wrap - lo) / cell_len).astype(int), 0, n_cell - 1)
+        cell_id = np.ravel_multi_index(cell_idx.T, n_cell)
+
+        # セルごとの原子番号の表 (足りない所は-1で埋める)
+        n_cells = int(np.prod(n_cell))
+        order = np.argsort(cell_id, kind='stable')
+        counts = np.bincount(cell_id, minlength=n_cells)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        table = np.full((n_cells, max(counts.max(initial=0), 1)), -1, dtype=int)
+        table[cell_id[order], np.arange(len(order)) - starts[cell_id[order]]] = order
+
+        cells = np.array(np.unravel_index(np.arange(n_cells), n_cell)).T
+        i_list, j_list, image_list = [], [], []
+        for d in itertools.product([-1, 0, 1], repeat=3):
+            neighbor = cells + d
+            shift = np.where(periodic, np.floor_divide(neighbor, n_cell), 0)
+            neighbor -= shift * n_cell
+            valid = np.all((neighbor >= 0) & (neighbor < n_cell), axis=1)
+            if not np.any(valid):
+                continue
+            shift = shift[valid]
+            atoms_i = table[valid][:, :, None]
+            atoms_j = table[np.ravel_multi_index(neighbor[valid].T, n_cell)][:, None, :]
+            atoms_i, atoms_j = np.broadcast_arrays(atoms_i, atoms_j)
+            mask = (atoms_i >= 0) & (atoms_j >= 0)
+            cell_of_pair = np.nonzero(mask)[0]
+            i, j = atoms_i[mask], atoms_j[mask]
+            shift = shift[cell_of_pair]
+
+            # 同じペアを二重に数えないように、i < j、もしくは自分自身の像は片側だけを残す
+            half = (i < j) | ((i == j) & self.is_positive(shift))
+            i, j, shift = i[half], j[half], shift[half]
+            disp = r_wrap[i] - (r_wrap[j] + shift * box)
+            within = np.sum(disp * disp, axis=1) <= r_list * r_list
+            i, j, shift = i[within], j[within], shift[within]
+            i_list.append(i)
+            j_list.append(j)
+            image_list.append(image[i] - image[j] + shift)
+
+        self.i_ = np.concatenate(i_list) if i_list else np.zeros(0, dtype=int)
+        self.j_ = np.concatenate(j_list) if j_list else np.zeros(0, dtype=int)
+        self.image_ = np.concatenate(image_list) if image_list else np.zeros((0, 3), dtype=int)
+        self.r_last_ = r.copy()
+        self.n_build_ += 1
+
+    @staticmethod
+    def is_positive(shift):
+        # 辞書式順序で最初の非ゼロ成分が正であるか
+        first = np.argmax(shift != 0, axis=1)
+        return shift[np.arange(len(shift)), first] > 0
+
+    def get_displacement(self, r, d1, d2):
+        box = np.array(d2 - d1, dtype=r.dtype)
+        return r[self.i_] - r[self.j_] - self.image_ * box
+
+
+def test_neighbor_list():
+    from Cell import make_test_cell, matches_reference
+    casedata = CaseData('./data/case0.json')
+    cell = make_test_cell(casedata)
+    cell.neighbor_list_ = NeighborList(casedata)
+    if not matches_reference(cell, cell.calc_force_and_up_with_neighbor_list):
+        print(f'Failed in test_neighbor_list. up: {cell.up_}')
+        return
+    print(f'Succeed in test_neighbor_list ({len(cell.neighbor_list_.i_)} pairs)')
+
+
+def main():
+    test_neighbor_list()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import time
+import queue
+import threading
+import numpy as np
+
+
+class AsyncWriter:
+    # 出力の整形と書き込みを別スレッドで行う。ファイルは開いたままにして、まとめて書き込む
+    def __init__(self, max_queue=64, flush_interval=5.0):
+        self.queue_ = queue.Queue(maxsize=max_queue)
+        self.flush_interval_ = flush_interval
+        self.files_ = {}
+        self.error_ = None
+        self.bytes_written_ = 0
+        self.thread_ = threading.Thread(target=self.loop, daemon=True)
+        self.thread_.start()
+
+    def put(self, filename, func, *args):
+        # func(*args) の結果を filename に追記する。filename が None なら func を呼ぶだけ
+        # 配列はこの時点の値をコピーしておく
+        args = tuple(arg.copy() if isinstance(arg, np.ndarray) else arg for arg in args)
+        while True:
+            self.check_error()
+            try:
+                # キューが一杯なら書き込みが追いつくまで待つ
+                self.queue_.put((filename, func, args), timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def check_error(self):
+        if self.error_ is not None:
+            raise RuntimeError('Failed to write output in the background writer.') from self.error_
+
+    def loop(self):
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                batch = [self.queue_.get(timeout=self.flush_interval_)]
+            except queue.Empty:
+                batch = []
+            # キューに溜まっている分もまとめて処理する
+            while True:
+                try:
+                    batch.append(self.queue_.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    running = False
+                elif self.error_ is None:  # エラーの後は捨てるだけにして、呼び出し側を止めない
+                    try:
+                        self.process(item)
+                    except Exception as e:
+                        self.error_ = e
+            if not running or time.monotonic() - last_flush > self.flush_interval_:
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.error_ = self.error_ or e
+                last_flush = time.monotonic()
+        for f in self.files_.values():
+            f.close()
+        self.files_ = {}
+
+    def process(self, item):
+        filename, func, args = item
+        result = func(*args)
+        if filename is None:
+            return
+        if filename not in self.files_:
+            self.files_[filename] = open(filename, 'a')
+        self.files_[filename].write(result)
+        self.bytes_written_ += len(result)
+
+    def flush(self):
+        for f in self.files_.values():
+            f.flush()
+
+    def close(self):
+        if self.thread_.is_alive():
+            self.queue_.put(None)
+            self.thread_.join()
+        self.check_error()
@@ -0,0 +1,187 @@
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from Params import Params, make_potential
+from CaseData import CaseData
+
+
+def get_block_bounds(n_atoms, n_workers):
+    # i < j のペアを数えるので、i が小さいほど仕事が多い。ペア数がほぼ等しくなるように分ける
+    k = np.arange(n_workers + 1) / n_workers
+    bounds = np.round(n_atoms * (1 - np.sqrt(1 - k))).astype(int)
+    bounds[-1] = n_atoms
+    return bounds
+
+
+def get_image_shifts(periodic):
+    # 周期方向に隣接する像 (自分自身の箱を含む) の整数オフセット
+    d = [[-1, 0, 1] if p else [0] for p in periodic]
+    return np.array(list(itertools.product(*d)), dtype=float)
+
+
+def calc_block(r, box, lo, hi, acc_out, virial_out, periodic, minimum_image, cutoff, potential, types, inv_mass, block_size=256):
+    # [lo, hi) の原子と、それより番号が大きい原子 (と像) との相互作用を acc_out と virial_out に足し込む
+    n_atoms = len(r)
+    up = 0
+    if minimum_image:
+        shifts = np.zeros((1, 3))
+    else:
+        shifts = get_image_shifts(periodic)
+    for start in range(lo, hi, block_size):
+        end = min(start + block_size, hi)
+        index_i = np.arange(start, end)[:, None]
+        index_j = np.arange(start, n_atoms)[None, :]
+        for shift in shifts:
+            displacement = r[start:end, None, :] - (r[None, start:, :] + shift * box)
+            if minimum_image:
+                displacement -= np.where(periodic, box * np.round(displacement / box), 0)
+            dist = np.sqrt(np.sum(displacement * displacement, axis=2))
+            # 別の像にいる自分自身とのペアは、向きの片方だけを数える
+            nonzero = shift[shift != 0]
+            self_image = len(nonzero) > 0 and nonzero[0] > 0
+            pair = (index_j > index_i) | ((index_j == index_i) & self_image)
+            within = pair & (dist <= cutoff)
+            dist = np.where(within, dist, 1)
+            force, phi = potential.Morse_calc_up(dist, types[start:end, None], types[None, start:])
+            force = np.where(within, force / dist, 0)[:, :, None] * displacement
+            acc_out[start:end] -= np.sum(force, axis=1) * inv_mass[start:end, None]
+            acc_out[start:] += np.sum(force, axis=0) * inv_mass[start:, None]
+            up += np.sum(phi, where=within)
+            virial_out -= np.einsum('ija,ijb->ab', displacement, force)
+    return up
+
+
+def worker_loop(conn, names, n_atoms, n_workers, rank, lo, hi, periodic, minimum_image, cutoff, potential_table, params_file, types):
+    shm_r = shared_memory.SharedMemory(name=names['r'])
+    shm_box = shared_memory.SharedMemory(name=names['box'])
+    shm_acc = shared_memory.SharedMemory(name=names['acc'])
+    shm_up = shared_memory.SharedMemory(name=names['up'])
+    shm_virial = shared_memory.SharedMemory(name=names['virial'])
+    r = np.ndarray((n_atoms, 3), dtype=np.double, buffer=shm_r.buf)
+    box = np.ndarray((3,), dtype=np.double, buffer=shm_box.buf)
+    acc = np.ndarray((n_workers, n_atoms, 3), dtype=np.double, buffer=shm_acc.buf)
+    up = np.ndarray((n_workers,), dtype=np.double, buffer=shm_up.buf)
+    virial = np.ndarray((n_workers, 3, 3), dtype=np.double, buffer=shm_virial.buf)
+    params = Params(params_file)
+    potential = make_potential(params, cutoff, potential_table)
+    inv_mass = 1 / params.mass_[types]
+    try:
+        while True:
+            command = conn.recv()
+            if command is None:
+                break
+            if isinstance(command, tuple) and command[0] == 'types':
+                # 原子が並べ替えられたので、原子種の並びを差し替える
+                types = command[1]
+                inv_mass = 1 / params.mass_[types]
+                conn.send(None)
+                continue
+            try:
+                acc[rank] = 0
+                virial[rank] = 0
+                up[rank] = calc_block(r, box, lo, hi, acc[rank], virial[rank], periodic, minimum_image, cutoff, potential, types, inv_mass)
+                conn.send(None)
+            except Exception as e:
+                conn.send(e)
+    finally:
+        del r, box, acc, up, virial
+        for shm in [shm_r, shm_box, shm_acc, shm_up, shm_virial]:
+            shm.close()
+
+
+class ParallelForce:
+    def __init__(self, casedata: CaseData, types, n_workers):
+        self.casedata_ = casedata
+        n_atoms = len(types)
+        self.n_atoms_ = n_atoms
+        self.n_workers_ = n_workers
+
+        double = np.dtype(np.double).itemsize
+        self.shm_ = {
+            'r': shared_memory.SharedMemory(create=True, size=max(n_atoms * 3 * double, 1)),
+            'box': shared_memory.SharedMemory(create=True, size=3 * double),
+            'acc': shared_memory.SharedMemory(create=True, size=max(n_workers * n_atoms * 3 * double, 1)),
+            'up': shared_memory.SharedMemory(create=True, size=n_workers * double),
+            'virial': shared_memory.SharedMemory(create=True, size=n_workers * 9 * double),
+        }
+        self.r_ = np.ndarray((n_atoms, 3), dtype=np.double, buffer=self.shm_['r'].buf)
+        self.box_ = np.ndarray((3,), dtype=np.double, buffer=self.shm_['box'].buf)
+        self.acc_ = np.ndarray((n_workers, n_atoms, 3), dtype=np.double, buffer=self.shm_['acc'].buf)
+        self.up_ = np.ndarray((n_workers,), dtype=np.double, buffer=self.shm_['up'].buf)
+        self.virial_ = np.ndarray((n_workers, 3, 3), dtype=np.double, buffer=self.shm_['virial'].buf)
+
+        names = {key: shm.name for key, shm in self.shm_.items()}
+        periodic = np.array(casedata.periodic_, dtype=bool)
+        bounds = get_block_bounds(n_atoms, n_workers)
+        self.conns_ = []
+        self.processes_ = []
+        for rank in range(n_workers):
+            parent_conn, child_conn = mp.Pipe()
+            process = mp.Process(
+                target=worker_loop,
+                args=(child_conn, names, n_atoms, n_workers, rank, bounds[rank], bounds[rank + 1],
+                      periodic, casedata.minimum_image_, casedata.cutoff_, casedata.potential_table_,
+                      casedata.params_file_, types),
+                daemon=True,
+            )
+            process.start()
+            self.conns_.append(parent_conn)
+            self.processes_.append(process)
+
+    def calc_force(self, cell, calc_up=False):
+        self.r_[:] = cell.r_
+        self.box_[:] = cell.d2_ - cell.d1_
+        for conn in self.conns_:
+            conn.send('force')
+        errors = [conn.recv() for conn in self.conns_]
+        for error in errors:
+            if error is not None:
+                raise error
+        # 各ワーカーの部分和を足し合わせる
+        cell.a_ += np.sum(self.acc_, axis=0)
+        if calc_up:
+            cell.up_ = np.sum(self.up_)
+            cell.virial_ = np.sum(self.virial_, axis=0)
+
+    def set_types(self, types):
+        for conn in self.conns_:
+            conn.send(('types', types))
+        for conn in self.conns_:
+            conn.recv()
+
+    def close(self):
+        for conn in self.conns_:
+            conn.send(None)
+        for process in self.processes_:
+            process.join()
+        self.conns_ = []
+        self.processes_ = []
+        del self.r_, self.box_, self.acc_, self.up_, self.virial_
+        for shm in self.shm_.values():
+            shm.close()
+            shm.unlink()
+        self.shm_ = {}
+
+
+def test_parallel_force():
+    from Cell import make_test_cell, matches_reference
+    casedata = CaseData('./data/case0.json')
+    cell = make_test_cell(casedata)
+    parallel_force = ParallelForce(casedata, cell.type_, 2)
+    try:
+        matches = matches_reference(cell, lambda: parallel_force.calc_force(cell, calc_up=True))
+    finally:
+        parallel_force.close()
+    if not matches:
+        print(f'Failed in test_parallel_force. up: {cell.up_}')
+        return
+    print('Succeed in test_parallel_force')
+
+
+def main():
+    test_parallel_force()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,188 @@
+import json
+import inspect
 import numpy as np
 import matplotlib.pyplot as plt
 
 
 class Params:
-    def __init__(self):
+    def __init__(self, filename=None, dtype=np.double):
+        self.dtype_ = dtype  # ペアごとのパラメータの配列の型 (単精度のときは力も単精度で計算される)
         self.dict_params_ = {
             'Al': {
                 'mass': 1.67e-27 * 27,
                 'epsilon': 0.27 * 1.6e-19,  # eV -> J
-                'alpha': 1.16 * 1e10,  # Å-1 -> m-1
-                'r0': 3.25 * 1e-10  # Å -> m
+                'alpha': 1.16 * 1e10,  # Å-1 -> m-1
+                'r0': 3.25 * 1e-10  # Å -> m
                 }
         }
+        # 異種原子間のパラメータ (指定がなければ混合則で決める)
+        self.dict_pair_params_ = {}
+        if filename is not None:
+            self.load(filename)
         self.init_params()
 
+    def load(self, filename):
+        # ファイル中の単位は amu, eV, Å-1, Å
+        with open(filename, 'r') as f:
+            params_dict = json.load(f)
+        for kind, value in params_dict["species"].items():
+            self.dict_params_[kind] = self.to_si(value)
+        for pair, value in params_dict.get("pairs", {}).items():
+            kind_i, kind_j = pair.split('-')
+            self.dict_pair_params_[(kind_i, kind_j)] = self.to_si(value)
+
+    @staticmethod
+    def to_si(value):
+        value_si = {}
+        if 'mass' in value:
+            value_si['mass'] = 1.67e-27 * value['mass']  # amu -> kg
+        value_si['epsilon'] = value['epsilon'] * 1.6e-19  # eV -> J
+        value_si['alpha'] = value['alpha'] * 1e10  # Å-1 -> m-1
+        value_si['r0'] = value['r0'] * 1e-10  # Å -> m
+        return value_si
+
     def init_params(self):
-        for key, value in self.dict_params_.items():
-            self.dict_params_[key]['minus_alpha'] = -value['alpha']
-            self.dict_params_[key]['minus_2_alpha'] = -2 * value['alpha']
-            self.dict_params_[key]['minus_2_alpha_eps'] = -2 * value['alpha'] * value['epsilon']
+        # 原子種を整数のIDに対応させ、ペアごとのパラメータを (n_types, n_types) の配列にしておく
+        self.kinds_ = list(self.dict_params_)
+        self.type_id_ = {kind: i for i, kind in enumerate(self.kinds_)}
+        n_types = len(self.kinds_)
+        self.mass_ = np.array([self.dict_params_[kind]['mass'] for kind in self.kinds_])
+        self.epsilon_ = np.zeros((n_types, n_types))
+        self.alpha_ = np.zeros((n_types, n_types))
+        self.r0_ = np.zeros((n_types, n_types))
+        for i, kind_i in enumerate(self.kinds_):
+            for j, kind_j in enumerate(self.kinds_):
+                pair = self.get_pair_params(kind_i, kind_j)
+                self.epsilon_[i, j] = pair['epsilon']
+                self.alpha_[i, j] = pair['alpha']
+                self.r0_[i, j] = pair['r0']
+        self.minus_alpha_ = -self.alpha_
+        self.minus_2_alpha_eps_ = -2 * self.alpha_ * self.epsilon_
+        for name in ['epsilon_', 'alpha_', 'r0_', 'minus_alpha_', 'minus_2_alpha_eps_']:
+            setattr(self, name, getattr(self, name).astype(self.dtype_))
+
+    def get_pair_params(self, kind_i, kind_j):
+        if kind_i == kind_j:
+            return self.dict_params_[kind_i]
+        if (kind_i, kind_j) in self.dict_pair_params_:
+            return self.dict_pair_params_[(kind_i, kind_j)]
+        if (kind_j, kind_i) in self.dict_pair_params_:
+            return self.dict_pair_params_[(kind_j, kind_i)]
+        # 混合則: epsilonは幾何平均、alphaとr0は算術平均
+        params_i = self.dict_params_[kind_i]
+        params_j = self.dict_params_[kind_j]
+        return {
+            'epsilon': np.sqrt(params_i['epsilon'] * params_j['epsilon']),
+            'alpha': 0.5 * (params_i['alpha'] + params_j['alpha']),
+            'r0': 0.5 * (params_i['r0'] + params_j['r0']),
+        }
+
+    def get_types(self, kinds):
+        unknown = set(kinds) - set(self.kinds_)
+        if unknown:
+            raise ValueError(f'No parameters for {sorted(unknown)}. Known species: {self.kinds_}.')
+        return np.array([self.type_id_[kind] for kind in kinds], dtype=int)
+
+    def Morse(self, r, type_i, type_j):
+        # エネルギーが要らないときは力だけを計算する
+        e = np.exp(self.minus_alpha_[type_i, type_j] * (r - self.r0_[type_i, type_j]))
+        return self.minus_2_alpha_eps_[type_i, type_j] * (e * e - e)
+
+    def Morse_calc_up(self, r, type_i, type_j):
+        # 力 (dφ/dr) とエネルギーを同時に返す。加速度にするには各原子の質量で割る
+        # exp(-2a(r - r0)) = exp(-a(r - r0))^2 なので、expは1回で済む
+        e = np.exp(self.minus_alpha_[type_i, type_j] * (r - self.r0_[type_i, type_j]))
+        force = self.minus_2_alpha_eps_[type_i, type_j] * (e * e - e)
+        phi = self.epsilon_[type_i, type_j] * (e * e - 2 * e)
+        return force, phi
+
+
+class MorseTable:
+    # Morseポテンシャルのエネルギーを等間隔の表の3次エルミート補間で求め、力はその補間式の微分にする
+    # 力とエネルギーを別々に補間すると、力がエネルギーの微分と合わなくなりエネルギーがドリフトする
+    def __init__(self, params: Params, cutoff, n_points=10000, r_min=1e-10):
+        self.params_ = params
+        self.r_min_ = r_min
+        self.cutoff_ = cutoff
+        self.n_points_ = n_points
+        self.dr_ = (cutoff - r_min) / (n_points - 1)
+        self.inv_dr_ = 1 / self.dr_
+        # 種類のペアごとに n_points - 1 区間の3次式の係数を1次元に並べておく
+        # 区間 k では φ = c0 + c1 t + c2 t^2 + c3 t^3 (t = (r - r_k) / dr)。格子点での値と傾き (dφ/dr) は解析式と一致する
+        r = np.linspace(r_min, cutoff, n_points)
+        self.n_types_ = len(params.kinds_)
+        type_i, type_j = np.meshgrid(np.arange(self.n_types_), np.arange(self.n_types_), indexing='ij')
+        force, phi = params.Morse_calc_up(r, type_i[:, :, None], type_j[:, :, None])
+        phi0, phi1 = phi[:, :, :-1], phi[:, :, 1:]
+        slope0, slope1 = force[:, :, :-1] * self.dr_, force[:, :, 1:] * self.dr_
+        dtype = params.dtype_
+        self.c0_ = phi0.astype(dtype).ravel()
+        self.c1_ = slope0.astype(dtype).ravel()
+        self.c2_ = (3 * (phi1 - phi0) - 2 * slope0 - slope1).astype(dtype).ravel()
+        self.c3_ = (2 * (phi0 - phi1) + slope0 + slope1).astype(dtype).ravel()
+        self.inv_dr_typed_ = np.array(self.inv_dr_, dtype=dtype)
 
-    def Morse(self, r):
-        # TODO: Al以外の原子のとき
-        params = self.dict_params_['Al']
-        force = params['minus_2_alpha_eps'] * (np.exp(params['minus_2_alpha'] * (r - params['r0'])) - np.exp(params['minus_alpha'] * (r - params['r0'])))
-        return force / params['mass']
+    def get_interval(self, r, type_i, type_j):
+        # 各距離が入る区間の番号 (係数の配列の添字) と区間内の位置 t
+        # cutoffより遠い距離 (呼ぶ側で捨てる値) で3次式が発散しないように、表の範囲に収めてから補間する
+        x = np.clip((r - self.r_min_) * self.inv_dr_, 0, self.n_points_ - 1)
+        index = np.minimum(x.astype(int), self.n_points_ - 2)
+        t = (x - index).astype(r.dtype)
+        return index + (np.asarray(type_i) * self.n_types_ + type_j) * (self.n_points_ - 1), t
 
-    def Morse_calc_up(self, r):
-        # TODO: Al以外の原子のとき
-        params = self.dict_params_['Al']
-        force = params['minus_2_alpha_eps'] * (np.exp(params['minus_2_alpha'] * (r - params['r0'])) - np.exp(params['minus_alpha'] * (r - params['r0'])))
-        phi = params['epsilon'] * (np.exp(params['minus_2_alpha'] * (r - params['r0'])) - 2 * np.exp(params['minus_alpha'] * (r - params['r0'])))
-        return force / params['mass'], phi
+    def Morse(self, r, type_i, type_j):
+        r = np.asarray(r)
+        index, t = self.get_interval(r, type_i, type_j)
+        force = (self.c1_[index] + t * (2 * self.c2_[index] + t * (3 * self.c3_[index]))) * self.inv_dr_typed_
+        below = r < self.r_min_
+        if np.any(below):
+            force = np.array(force)
+            type_i, type_j = np.broadcast_to(type_i, r.shape), np.broadcast_to(type_j, r.shape)
+            force[below] = self.params_.Morse(r[below], type_i[below], type_j[below])
+        return force
+
+    def Morse_calc_up(self, r, type_i, type_j):
+        r = np.asarray(r)
+        index, t = self.get_interval(r, type_i, type_j)
+        c0, c1, c2, c3 = self.c0_[index], self.c1_[index], self.c2_[index], self.c3_[index]
+        phi = c0 + t * (c1 + t * (c2 + t * c3))
+        force = (c1 + t * (2 * c2 + t * (3 * c3))) * self.inv_dr_typed_
+        # 表より近い距離は解析式で計算する
+        below = r < self.r_min_
+        if np.any(below):
+            force, phi = np.array(force), np.array(phi)
+            type_i, type_j = np.broadcast_to(type_i, r.shape), np.broadcast_to(type_j, r.shape)
+            force_below, phi_below = self.params_.Morse_calc_up(r[below], type_i[below], type_j[below])
+            force[below] = force_below
+            phi[below] = phi_below
+        return force, phi
+
+    def accuracy_report(self, type_i=0, type_j=0):
+        # 補間の誤差が最も大きくなる、表の格子点の中点で解析式と比較する
+        r = self.r_min_ + (np.arange(self.n_points_ - 1) + 0.5) * self.dr_
+        force_ref, phi_ref = self.params_.Morse_calc_up(r, type_i, type_j)
+        force, phi = self.Morse_calc_up(r, type_i, type_j)
+        return {
+            'n_points': self.n_points_,
+            'dr': self.dr_,
+            'max_abs_error_force': np.max(np.abs(force - force_ref)),
+            'max_rel_error_force': np.max(np.abs(force - force_ref)) / np.max(np.abs(force_ref)),
+            'max_abs_error_phi': np.max(np.abs(phi - phi_ref)),
+            'max_rel_error_phi': np.max(np.abs(phi - phi_ref)) / np.max(np.abs(phi_ref)),
+        }
+
+
+def make_potential(params: Params, cutoff, n_points):
+    # n_points が0なら解析式をそのまま使う
+    if n_points:
+        return MorseTable(params, cutoff, n_points)
+    return params
 
 
 def test_Params():
     params = Params()
     r = np.linspace(2e-10, 7e-10, 100)
-    _, u = params.Morse_calc_up(r)
+    _, u = params.Morse_calc_up(r, 0, 0)
     plt.plot(r, u, color='k')
     min_u = u.min()
     min_r = r[np.where(u==min_u)][0]
@@ -46,9 +191,36 @@ def test_Params():
     plt.show()
 
 
+def test_MorseTable():
+    params = Params()
+    for n_points in [1000, 10000, 100000]:
+        report = MorseTable(params, 7e-10, n_points).accuracy_report()
+        print(', '.join(f'{key}: {value:.3e}' if isinstance(value, float) else f'{key}: {value}' for key, value in report.items()))
+
+    # 表の力は表のエネルギーの微分と一致する (一致しないとNVEでエネルギーがドリフトする)
+    table = MorseTable(params, 7e-10, 1000)
+    r = np.linspace(1.5e-10, 6.9e-10, 10000)
+    h = 1e-16
+    force, _ = table.Morse_calc_up(r, 0, 0)
+    _, phi_plus = table.Morse_calc_up(r + h, 0, 0)
+    _, phi_minus = table.Morse_calc_up(r - h, 0, 0)
+    error = np.max(np.abs(force - (phi_plus - phi_minus) / (2 * h))) / np.max(np.abs(force))
+    if error > 1e-8:
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. force differs from the derivative of the energy by {error:.3e}')
+        return
+    # 力だけの計算はエネルギーと一緒に計算した力と同じ値になる
+    r = np.linspace(0.5e-10, 6.9e-10, 1000)
+    for potential in [params, table]:
+        if not np.array_equal(potential.Morse(r, 0, 0), potential.Morse_calc_up(r, 0, 0)[0]):
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {type(potential).__name__}.Morse differs from Morse_calc_up')
+            return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
 def main():
+    test_MorseTable()
     test_Params()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,108 @@
+import inspect
+import numpy as np
+
+
+def get_grid_coords(r, d1, d2, bits):
+    # 箱 (箱の外に出ている原子も含む範囲) を 2^bits 個に区切った格子の座標
+    lo = np.minimum(d1, r.min(axis=0, initial=np.inf))
+    hi = np.maximum(d2, r.max(axis=0, initial=-np.inf))
+    n = 1 << bits
+    scale = n / np.where(hi > lo, hi - lo, 1)
+    return np.clip(((r - lo) * scale).astype(np.int64), 0, n - 1)
+
+
+def interleave(x, bits):
+    # x[0], x[1], x[2] のビットを上位から交互に並べる
+    key = np.zeros(x.shape[1], dtype=np.int64)
+    for b in range(bits - 1, -1, -1):
+        for axis in range(3):
+            key = (key << 1) | ((x[axis] >> b) & 1)
+    return key
+
+
+def morton_keys(coords, bits):
+    return interleave(coords.T, bits)
+
+
+def hilbert_keys(coords, bits):
+    # Skilling (2004) の AxestoTranspose を原子についてベクトル化したもの
+    x = coords.T.copy()
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = q - 1
+        for axis in range(3):
+            flip = (x[axis] & q) != 0
+            if axis == 0:
+                x[0] = np.where(flip, x[0] ^ p, x[0])
+                continue
+            t = (x[0] ^ x[axis]) & p
+            x[0] = np.where(flip, x[0] ^ p, x[0] ^ t)
+            x[axis] = np.where(flip, x[axis], x[axis] ^ t)
+        q >>= 1
+    # Gray code
+    for axis in range(1, 3):
+        x[axis] ^= x[axis - 1]
+    t = np.zeros(x.shape[1], dtype=np.int64)
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((x[2] & q) != 0, t ^ (q - 1), t)
+        q >>= 1
+    x ^= t
+    return interleave(x, bits)
+
+
+CURVES = {
+    'morton': morton_keys,
+    'hilbert': hilbert_keys,
+}
+
+
+def get_order(r, d1, d2, curve='hilbert', bits=10):
+    # 空間充填曲線に沿った原子の並び順 (近い原子ほど近い番号になる)
+    if curve not in CURVES:
+        raise ValueError(f'Unknown reorder curve: {curve}. Choose from {list(CURVES)}.')
+    keys = CURVES[curve](get_grid_coords(r, d1, d2, bits), bits)
+    return np.argsort(keys, kind='stable')
+
+
+def test_curves(bits=3):
+    n = 1 << bits
+    coords = np.array(np.meshgrid(*[np.arange(n)] * 3, indexing='ij')).reshape(3, -1).T
+    for name, func in CURVES.items():
+        keys = func(coords, bits)
+        if not np.array_equal(np.sort(keys), np.arange(n ** 3)):
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {name} keys are not a permutation')
+            return
+    # Hilbert曲線は隣り合う番号の格子点が必ず隣り合う
+    path = coords[np.argsort(hilbert_keys(coords, bits))]
+    if not np.all(np.sum(np.abs(np.diff(path, axis=0)), axis=1) == 1):
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. hilbert curve is not continuous')
+        return
+    if morton_keys(np.array([[1, 2, 3]]), 2)[0] != 0b011101:
+        print(f'Failed in {inspect.currentframe().f_code.co_name}. morton key {morton_keys(np.array([[1, 2, 3]]), 2)}')
+        return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def test_order():
+    rng = np.random.default_rng(0)
+    box = np.array([2e-9, 3e-9, 2e-9])
+    r = rng.random((1000, 3)) * box
+    for curve in CURVES:
+        order = get_order(r, np.zeros(3), box, curve)
+        # 並べ替えると、続く番号の原子どうしの距離がずっと短くなる
+        before = np.mean(np.linalg.norm(np.diff(r, axis=0), axis=1))
+        after = np.mean(np.linalg.norm(np.diff(r[order], axis=0), axis=1))
+        if not np.array_equal(np.sort(order), np.arange(len(r))) or after > before * 0.3:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {curve}: {before} -> {after}')
+            return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_curves()
+    test_order()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+import os
+import time
+import inspect
+import tempfile
+import numpy as np
+from Params import Params, make_potential
+from CaseData import CaseData, get_replica_filename
+from Integrator import make_integrator
+from NeighborList import NeighborList
+from BinaryTrajectory import BinaryTrajectoryWriter, get_box
+from Driver import Driver, format_trajectory, format_energy, format_cell_state, format_stress
+from Cell import format_atoms
+from gen_initial_state import get_vel_from_temp
+from tqdm import tqdm
+from constant import *
+
+
+class ReplicaCell:
+    # 同じ系のR個のレプリカを (R, N, 3) の配列にまとめ、1回の配列演算で全レプリカの力や位置を更新する
+    # Integrator からは Cell と同じように使える
+    def __init__(self, casedata: CaseData, kind, r, v, box_size):
+        self.casedata_ = casedata
+        self.n_replicas_, self.n_atoms_ = r.shape[:2]
+        # 箱はレプリカごとに持つ (R, 3)
+        self.box_size_ = np.array(box_size, dtype=float)
+        self.d1_ = np.zeros_like(self.box_size_)
+        self.d2_ = self.box_size_.copy()
+        self.up_ = np.zeros(self.n_replicas_)
+        self.uk_ = np.zeros(self.n_replicas_)
+        self.virial_ = np.zeros((self.n_replicas_, 3, 3))
+        self.kinetic_tensor_ = np.zeros((self.n_replicas_, 3, 3))
+
+        self.params_ = Params(casedata.params_file_, casedata.dtype_)
+        self.potential_ = make_potential(self.params_, casedata.cutoff_, casedata.potential_table_)
+        dtype = casedata.dtype_
+        self.kind_ = np.array(kind, dtype=str)
+        # calc_pair_force で (R * N, 3) として足し込むので、C順の連続した配列にしておく
+        self.r_ = np.array(r, dtype=dtype, order='C')
+        self.v_ = np.array(v, dtype=dtype, order='C')
+        self.a_ = np.zeros_like(self.r_)
+        self.type_ = self.params_.get_types(self.kind_)
+        self.mass_ = self.params_.mass_[self.type_]
+        self.inv_mass_ = (1 / self.mass_).astype(dtype)
+
+        self.periodic_ = np.array(casedata.periodic_, dtype=bool)
+        self.neighbor_list_ = NeighborList(casedata)
+        self.n_build_ = 0
+        self.check_cutoff()
+        self.invalidate()
+
+    def check_cutoff(self):
+        # ペアは NeighborList で作るので、CaseData.check_cutoff の neighbor_list と同じ条件をレプリカごとの箱で確かめる
+        if np.any(self.periodic_ & (self.casedata_.cutoff_ >= self.box_size_ - self.casedata_.skin_)):
+            raise ValueError(f'cutoff ({self.casedata_.cutoff_}) must be smaller than the box size minus the skin '
+                             f'for the box of every replica (box sizes: {self.box_size_}).')
+
+    def invalidate(self):
+        self.r_last_ = None
+
+    def needs_update(self):
+        # NeighborList.needs_update と同じく、どれかのレプリカのどれかの原子がskinの半分以上動いたら全レプリカのリストを作り直す
+        if self.r_last_ is None:
+            return True
+        return np.max(np.sum((self.r_ - self.r_last_) ** 2, axis=2)) > (0.5 * self.casedata_.skin_) ** 2
+
+    def build(self):
+        # レプリカごとに Cell と同じ linked-cell の Verlet リストを作り、(R * N, 3) に並べたときの原子の番号でまとめる
+        replica_list, i_list, j_list, offset_list = [], [], [], []
+        for k in range(self.n_replicas_):
+            self.neighbor_list_.build(self.r_[k], self.d1_[k], self.d2_[k])
+            i, j, image = self.neighbor_list_.i_, self.neighbor_list_.j_, self.neighbor_list_.image_
+            replica_list.append(np.full(len(i), k))
+            i_list.append(k * self.n_atoms_ + i)
+            j_list.append(k * self.n_atoms_ + j)
+            # j の像のずれ (m)。箱が変わるとリストも作り直すので、長さにしておく
+            offset_list.append(image * (self.d2_[k] - self.d1_[k]))
+        self.list_replica_ = np.concatenate(replica_list)
+        self.list_i_ = np.concatenate(i_list)
+        self.list_j_ = np.concatenate(j_list)
+        self.list_offset_ = np.concatenate(offset_list).astype(self.r_.dtype)
+        atom_i, atom_j = self.list_i_ - self.list_replica_ * self.n_atoms_, self.list_j_ - self.list_replica_ * self.n_atoms_
+        self.list_types_ = self.type_[atom_i], self.type_[atom_j]
+        self.r_last_ = self.r_.copy()
+        self.n_build_ += 1
+
+    def clear_force(self):
+        self.a_[:] = 0
+
+    def calc_force(self, calc_up=False):
+        # 全レプリカのリストのペアをまとめて計算し、(レプリカ, 原子) ごとに足し込む (Cell.calc_pair_force と同じ)
+        self.clear_force()
+        if self.needs_update():
+            self.build()
+        n = self.n_replicas_ * self.n_atoms_
+        r_all, a_all = self.r_.reshape(n, 3), self.a_.reshape(n, 3)
+        displacement = r_all[self.list_i_] - r_all[self.list_j_] - self.list_offset_
+        r = np.sqrt(np.sum(displacement * displacement, axis=1))
+        within = r <= self.casedata_.cutoff_
+        displacement, r = displacement[within], r[within]
+        replica, i, j = self.list_replica_[within], self.list_i_[within], self.list_j_[within]
+
+        force, phi = self.potential_.Morse_calc_up(r, self.list_types_[0][within], self.list_types_[1][within])
+        force = (force / r)[:, None] * displacement
+        inv_mass = np.tile(self.inv_mass_, self.n_replicas_)
+        for k in range(3):
+            total = np.bincount(j, weights=force[:, k], minlength=n) - np.bincount(i, weights=force[:, k], minlength=n)
+            a_all[:, k] += total * inv_mass
+        if calc_up:
+            # エネルギーとビリアルは単精度のときも倍精度で足し合わせる
+            self.up_ = np.bincount(replica, weights=phi, minlength=self.n_replicas_)
+            virial = -np.einsum('pa,pb->pab', displacement, force, dtype=np.double).reshape(-1, 9)
+            self.virial_ = np.stack([np.bincount(replica, weights=virial[:, k], minlength=self.n_replicas_) for k in range(9)], axis=1).reshape(-1, 3, 3)
+
+    def update_velocity_half(self):
+        self.v_ += self.a_ * (self.casedata_.dt_ / 2)
+
+    def update_velocity_half_and_calc_uk(self):
+        self.update_velocity_half()
+        self.kinetic_tensor_ = np.einsum('n,rna,rnb->rab', self.mass_, self.v_, self.v_, dtype=np.double)
+        self.uk_ = 0.5 * np.trace(self.kinetic_tensor_, axis1=1, axis2=2)
+
+    def update_position(self):
+        self.r_ += self.v_ * self.casedata_.dt_
+
+    def migrate(self):
+        length = (self.d2_ - self.d1_)[:, None, :]
+        margin = length * 0.05  # CaseData.margin_ と同じ
+        lower = self.r_ < self.d1_[:, None, :] - margin
+        upper = self.r_ >= self.d2_[:, None, :] + margin
+        self.r_ += np.where(lower & self.periodic_, length, 0)
+        self.r_ -= np.where(upper & self.periodic_, length, 0)
+
+    def relax(self):
+        # 力に逆らって動いている原子を止め、レプリカごとに止めた原子の数を返す
+        stop = np.einsum('rij,rij->ri', self.v_, self.a_) < 0
+        self.v_[stop] = 0
+        return np.count_nonzero(stop, axis=1)
+
+    def is_relaxed(self):
+        # Cell.is_relaxed と同じ判定をレプリカごとに行う
+        return np.linalg.norm(self.v_, axis=2).mean(axis=1) < 1
+
+    def stretch(self, replicas):
+        # replicas (bool, R) で選んだレプリカだけを引き伸ばす
+        eps = self.casedata_.stretch_eps_
+        self.box_size_[replicas] *= eps
+        self.d1_[replicas] = 0
+        self.d2_[replicas] = self.box_size_[replicas]
+        self.r_[replicas] *= eps
+        self.check_cutoff()
+        self.invalidate()
+
+    def get_stress(self):
+        volume = np.prod(self.d2_ - self.d1_, axis=1)
+        return -(self.kinetic_tensor_ + self.virial_) / volume[:, None, None]
+
+
+def read_atoms(filename, skip_header=False):
+    # 1行に1原子 (kind x y z vx vy vz) のテキストか、LatticeMaker.to_npz のバイナリを読む
+    if filename.endswith('.npz'):
+        with np.load(filename) as data:
+            return data['kind'], data['r'], data['v']
+    with open(filename, 'r') as f:
+        lines = f.readlines()[1 if skip_header else 0:]
+    columns = np.array([line.split() for line in lines if line.strip()])
+    return columns[:, 0], columns[:, 1:4].astype(float), columns[:, 4:7].astype(float)
+
+
+def read_restart_header(filename):
+    # #step <step> time <time> dt <dt>
+    with open(filename, 'r') as f:
+        words = f.readline().split()
+    return dict(zip(words[::2], words[1::2]))
+
+
+def read_box_size(cell_file):
+    # cellファイルの最後の出力 (CaseData と同じ)
+    with open(cell_file, 'r') as f:
+        _, x, _, _, _, y, _, _, _, z, _, _, _ = f.readlines()[-1].split()
+    return np.array([x, y, z]).astype(float) * 1e-10
+
+
+class ReplicaDriver:
+    # Driver と同じ手順で、replicas 個のレプリカを1つのプロセスでまとめて進める
+    # 出力ファイル、箱、緩和待ちのカウンタはレプリカごとに持つ
+    def __init__(self, casedata: CaseData):
+        self.casedata_ = casedata
+        self.n_replicas_ = casedata.replicas_
+        self.cell_ = None
+        self.integrator_ = None
+        self.traj_writers_ = None
+        self.n_atoms_ = 0  # 1レプリカあたりの原子数
+        self.current_step_ = 0
+        self.time_ = 0.0  # simulated time [s]
+        self.counter_ = np.zeros(self.n_replicas_, dtype=int)  # for checking relaxation
+        self.load()
+
+    def get_filename(self, filename, replica):
+        return get_replica_filename(filename, replica)
+
+    def load(self):
+        casedata = self.casedata_
+        if casedata.restart_:
+            # レプリカは同じステップで止まっているはず
+            headers = [read_restart_header(self.get_filename(casedata.restart_file_, k)) for k in range(self.n_replicas_)]
+            if len({header['#step'] for header in headers}) != 1:
+                raise ValueError('The restart files of the replicas were written at different steps.')
+            header = headers[0]
+            self.current_step_ = int(header['#step'])
+            casedata.n_loop_ += self.current_step_
+            if 'dt' in header:
+                casedata.dt_ = float(header['dt'])
+            self.time_ = float(header['time']) if 'time' in header else self.current_step_ * casedata.dt_
+            atoms = [read_atoms(self.get_filename(casedata.restart_file_, k), skip_header=True) for k in range(self.n_replicas_)]
+            kind = atoms[0][0]
+            r = np.stack([atom[1] for atom in atoms])
+            v = np.stack([atom[2] for atom in atoms])
+            box_size = np.stack([read_box_size(self.get_filename(casedata.out_file_cell_, k)) for k in range(self.n_replicas_)])
+        else:
+            kind, r0, v0 = read_atoms(casedata.in_file_)
+            params = Params(casedata.params_file_)
+            mass = params.mass_[params.get_types(kind)]
+            temperature = casedata.replica_temperature_
+            if temperature is None:
+                # in_file の速度と同じ温度にする
+                temperature = np.sum(mass[:, None] * v0 * v0) / (3 * len(kind) * kB)
+            r = np.broadcast_to(r0, (self.n_replicas_,) + r0.shape)
+            v = np.stack([get_vel_from_temp(np.random.default_rng(casedata.replica_seed_ + k), mass, temperature)
+                          for k in range(self.n_replicas_)])
+            box_size = np.tile(casedata.box_size_, (self.n_replicas_, 1))
+        self.n_atoms_ = len(kind)
+        self.cell_ = ReplicaCell(casedata, kind, r, v, box_size)
+        self.integrator_ = make_integrator(casedata.integrator_, self.cell_, self.cell_.calc_force)
+        if casedata.traj_format_ == 'binary':
+            self.traj_writers_ = [
+                BinaryTrajectoryWriter(self.get_filename(casedata.out_file_traj_, k), self.cell_.kind_,
+                                       get_box(self.cell_.d1_[k], self.cell_.d2_[k]),
+                                       casedata.traj_dtype_, casedata.traj_compression_, casedata.traj_chunk_)
+                for k in range(self.n_replicas_)]
+
+    def run(self):
+        try:
+            for i in tqdm(range(self.casedata_.n_loop_ - self.current_step_)):
+                if self.current_step_ % self.casedata_.interval_ == 0:
+                    self.do_step(calc_energy=True)
+                    self.write_outputs()
+                else:
+                    self.do_step()
+                self.current_step_ += 1
+                self.time_ += self.casedata_.dt_
+            self.write_restart()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.traj_writers_ is not None:
+            for writer in self.traj_writers_:
+                writer.close()
+            self.traj_writers_ = None
+
+    def do_step(self, calc_energy=False):
+        self.integrator_.step(calc_energy=calc_energy)
+        if self.casedata_.relax_:
+            self.cell_.relax()
+        if self.casedata_.need_stretch_:
+            self.stretch()
+
+    def stretch(self):
+        # Driver.stretch と同じ条件を、レプリカごとのカウンタで判定する
+        self.counter_ += 1
+        ready = (self.counter_ >= 50) & self.cell_.is_relaxed()
+        if not np.any(ready):
+            return
+        self.cell_.stretch(ready)
+        self.integrator_.invalidate()
+        self.counter_[ready] = 0
+
+    def append(self, filename, replica, text):
+        with open(self.get_filename(filename, replica), 'a') as f:
+            f.write(text)
+
+    def write_outputs(self):
+        casedata, cell = self.casedata_, self.cell_
+        stress = cell.get_stress() if casedata.out_file_stress_ is not None else None
+        for k in range(self.n_replicas_):
+            if self.traj_writers_ is not None:
+                self.traj_writers_[k].write(self.current_step_, self.time_, get_box(cell.d1_[k], cell.d2_[k]), cell.r_[k], cell.v_[k])
+            else:
+                self.append(casedata.out_file_traj_, k, format_trajectory(self.current_step_, self.time_, cell.kind_, cell.r_[k], cell.v_[k]))
+            self.append(casedata.out_file_energy_, k, format_energy(self.current_step_, cell.up_[k], cell.uk_[k], self.n_atoms_, self.time_))
+            self.append(casedata.out_file_cell_, k, format_cell_state(self.current_step_, cell.d1_[k], cell.d2_[k]))
+            if stress is not None:
+                self.append(casedata.out_file_stress_, k, format_stress(self.current_step_, stress[k]))
+
+    def write_restart(self):
+        for k in range(self.n_replicas_):
+            restart_str = f'#step {self.current_step_} time {self.time_} dt {self.casedata_.dt_}\n'
+            restart_str += format_atoms(self.cell_.kind_, self.cell_.r_[k], self.cell_.v_[k])
+            filename = self.get_filename(self.casedata_.restart_file_, k)
+            tmp_filename = filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                f.write(restart_str)
+            os.replace(tmp_filename, filename)
+
+
+def test_replica(n_replicas=4, n_steps=200):
+    # 各レプリカの結果は、同じ初速度から Driver で1つずつ計算したものと一致するはず
+    with tempfile.TemporaryDirectory() as work_dir:
+        case_dict = {
+            "in_file": './data/Al_fcc_8.in',
+            "out_file_traj": os.path.join(work_dir, 'traj.xyz'),
+            "out_file_energy": os.path.join(work_dir, 'energy.out'),
+            "out_file_cell": os.path.join(work_dir, 'cell.out'),
+            "restart_file": os.path.join(work_dir, 'restart.tmp'),
+            "restart": False,
+            "dt": 1e-15,
+            "cutoff": 7e-10,
+            "n_loop": n_steps,
+            "interval": 10,
+            "box_size": [8.1e-10, 8.1e-10, 8.1e-10],
+            "periodic": [True, False, False],
+            "relax": True,
+            "stretch_eps": [0.01, 0, 0],
+            "replicas": n_replicas,
+            "replica_temperature": 100,
+        }
+        start = time.perf_counter()
+        ReplicaDriver(CaseData(case_dict=case_dict)).run()
+        elapsed_replica = time.perf_counter() - start
+        elapsed_single = 0.0
+        kind, r, _ = read_atoms(case_dict["in_file"])
+        params = Params()
+        mass = params.mass_[params.get_types(kind)]
+        for k in range(n_replicas):
+            single_dict = dict(case_dict, replicas=1)
+            for key in ["out_file_traj", "out_file_energy", "out_file_cell", "restart_file"]:
+                single_dict[key] = os.path.join(work_dir, 'single', os.path.basename(case_dict[key]))
+            # レプリカと同じ初速度の入力ファイルを作る
+            v = get_vel_from_temp(np.random.default_rng(k), mass, 100)
+            single_dict["in_file"] = os.path.join(work_dir, f'in_{k}.npz')
+            with open(single_dict["in_file"], 'wb') as f:
+                np.savez(f, kind=kind, r=r, v=v)
+            # 速さは、この箱で使える単独の計算で最も速い Verlet リストと比べる (minimum image は箱が cutoff の2倍より小さいので使えない)
+            start = time.perf_counter()
+            Driver(CaseData(case_dict=dict(single_dict, neighbor_list=True))).run()
+            elapsed_single += time.perf_counter() - start
+            # 結果は参照ループ (direct) の計算と比べる
+            Driver(CaseData(case_dict=single_dict)).run()
+            energy = np.loadtxt(get_replica_filename(case_dict["out_file_energy"], k))
+            energy_ref = np.loadtxt(single_dict["out_file_energy"])
+            cell = np.loadtxt(get_replica_filename(case_dict["out_file_cell"], k))
+            cell_ref = np.loadtxt(single_dict["out_file_cell"])
+            if not np.allclose(energy, energy_ref, rtol=1e-8, atol=0) or not np.array_equal(cell, cell_ref):
+                print(f'Failed in {inspect.currentframe().f_code.co_name}. replica {k} differs from a single run.')
+                return
+    print(f'{n_replicas} replicas: {elapsed_replica:.2f} s together, {elapsed_single:.2f} s one by one with the neighbor list')
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_replica()
+
+
+if __name__ == '__main__':
+    main()
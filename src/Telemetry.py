@@ -0,0 +1,142 @@
+import os
+import time
+import inspect
+import tempfile
+import numpy as np
+
+
+MAGIC = b'MDTELE01'
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('capacity', '<i8'),
+    ('count', '<i8'),  # これまでに書いたレコードの数 (リングバッファの位置は count % capacity)
+    ('n_atoms', '<i8'),
+    ('run_id', '<i8'),  # 書き始めた時刻 (ns)。同じファイルに新しい実行が書き始めたことを読む側が知るため
+])
+# 1レコード: Driver.write_energy, write_cell_state, write_stress と同じ値 (箱はm、応力はPa)
+RECORD_DTYPE = np.dtype([
+    ('step', '<i8'),
+    ('time', '<f8'),
+    ('up', '<f8'),
+    ('uk', '<f8'),
+    ('temperature', '<f8'),
+    ('box', '<f8', (3,)),
+    ('stress', '<f8', (6,)),  # xx yy zz yz xz xy
+])
+
+
+class TelemetryWriter:
+    # 出力ステップの値を、メモリマップしたファイルの固定長のリングバッファに書く
+    # /dev/shm に置けばディスクには書かれず、読む側も解析なしに配列として見られる
+    def __init__(self, filename, capacity=1024, n_atoms=0):
+        self.filename_ = filename
+        size = HEADER_DTYPE.itemsize + capacity * RECORD_DTYPE.itemsize
+        if not (os.path.exists(filename) and os.path.getsize(filename) == size):
+            # 読んでいる側のマップを壊さないように、大きさが変わるときは新しいファイルに置き換える
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(filename)), delete=False) as f:
+                f.truncate(size)
+            os.replace(f.name, filename)
+        self.header_ = np.memmap(filename, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        self.records_ = np.memmap(filename, dtype=RECORD_DTYPE, mode='r+', offset=HEADER_DTYPE.itemsize, shape=(capacity,))
+        self.capacity_ = capacity
+        self.count_ = 0
+        self.header_['count'] = 0
+        self.header_['capacity'] = capacity
+        self.header_['n_atoms'] = n_atoms
+        self.header_['run_id'] = time.time_ns()
+        self.header_['magic'] = MAGIC
+
+    def write(self, step, sim_time, up, uk, temperature, box, stress):
+        # レコードを書き終えてから count を進めるので、読む側は count より前のレコードだけを読めばよい
+        record = self.records_[self.count_ % self.capacity_]
+        record['step'] = step
+        record['time'] = sim_time
+        record['up'] = up
+        record['uk'] = uk
+        record['temperature'] = temperature
+        record['box'] = box
+        record['stress'] = stress
+        self.count_ += 1
+        self.header_['count'] = self.count_
+
+    def close(self):
+        self.header_.flush()
+        self.records_.flush()
+        self.header_ = self.records_ = None
+
+
+class TelemetryReader:
+    # TelemetryWriter のリングバッファに別のプロセスから付いて、前回から増えたレコードだけを読む
+    def __init__(self, filename):
+        self.filename_ = filename
+        self.count_ = 0  # 読み終えたレコードの数
+        self.attach()
+
+    def attach(self):
+        self.inode_ = os.stat(self.filename_).st_ino
+        self.header_ = np.memmap(self.filename_, dtype=HEADER_DTYPE, mode='r', shape=(1,))
+        if self.header_['magic'][0] != MAGIC:
+            raise ValueError(f'{self.filename_} is not a telemetry buffer.')
+        self.capacity_ = int(self.header_['capacity'][0])
+        self.n_atoms_ = int(self.header_['n_atoms'][0])
+        self.run_id_ = int(self.header_['run_id'][0])
+        self.records_ = np.memmap(self.filename_, dtype=RECORD_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize, shape=(self.capacity_,))
+
+    def read_new(self):
+        # ファイルが置き換えられたり count が戻ったりしたら (新しい実行が始まったら)、最初から読み直す
+        if os.stat(self.filename_).st_ino != self.inode_:
+            self.attach()
+            self.count_ = 0
+        count = int(self.header_['count'][0])
+        if count < self.count_ or int(self.header_['run_id'][0]) != self.run_id_:
+            self.run_id_ = int(self.header_['run_id'][0])
+            self.count_ = 0
+        # 追い越されたレコードは読めないので、残っている最も古いものから読む
+        indices = np.arange(max(self.count_, count - self.capacity_), count)
+        records = np.array(self.records_[indices % self.capacity_])
+        # 読んでいる間に書き込みが進んで上書きされた (されているかもしれない) レコードは捨てる
+        # 次に書かれるレコードは最も古いレコードの場所を使うので、一周遅れたときは capacity - 1 個までしか読めない
+        count_after = int(self.header_['count'][0])
+        self.count_ = count
+        return records[indices > count_after - self.capacity_]
+
+
+def test_telemetry():
+    with tempfile.TemporaryDirectory() as work_dir:
+        filename = os.path.join(work_dir, 'telemetry.bin')
+        writer = TelemetryWriter(filename, capacity=8, n_atoms=108)
+        reader = TelemetryReader(filename)
+
+        def write(steps):
+            for step in steps:
+                writer.write(step, step * 1e-15, -step, step, 300.0, [1e-9, 1e-9, 1e-9], np.full(6, step))
+
+        write(range(5))
+        first = reader.read_new()
+        write(range(5, 25))  # 読まないうちに一周以上書く
+        second = reader.read_new()
+        third = reader.read_new()
+        if list(first['step']) != list(range(5)) or list(second['step']) != list(range(18, 25)) or len(third) != 0:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {first["step"]} {second["step"]} {third["step"]}')
+            return
+        if not np.array_equal(second['stress'][:, 0], second['step']) or reader.n_atoms_ != 108:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. broken records')
+            return
+
+        # 新しい実行が同じバッファに書き始めたら、最初から読み直す
+        writer.close()
+        writer = TelemetryWriter(filename, capacity=8)
+        write(range(100, 110))
+        if list(reader.read_new()['step']) != list(range(103, 110)):
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. after restart')
+            return
+        writer.close()
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    test_telemetry()
+
+
+if __name__ == '__main__':
+    main()
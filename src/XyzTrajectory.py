@@ -0,0 +1,247 @@
+import os
+import sys
+import mmap
+import inspect
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+
+def get_frame_dtype(n_atoms):
+    # 1フレーム: ステップ数, 時刻 (s, 古いファイルは nan), 原子の種類, 位置 (Å), 速度 (m/s)
+    return np.dtype([
+        ('step', '<i8'),
+        ('time', '<f8'),
+        ('kind', '<U8', (n_atoms,)),
+        ('r', '<f8', (n_atoms, 3)),
+        ('v', '<f8', (n_atoms, 3)),
+    ])
+
+
+def scan_frames(buffer, offset, end):
+    # buffer の [offset, end) にある書き終わったフレームを探し、(ステップ数, 時刻, 開始位置, 原子数) と読み終えた位置を返す
+    # 原子の行を1行ずつ数えずに、次の '#step' の行まで飛ばす
+    steps, times, offsets, n_atoms = [], [], [], []
+    while offset < end:
+        count_end = buffer.find(b'\n', offset, end)
+        header_end = buffer.find(b'\n', count_end + 1, end) if count_end >= 0 else -1
+        if header_end < 0:
+            break
+        header = buffer[count_end + 1:header_end].split()
+        if header[:1] != [b'#step'] or len(header) < 2:
+            raise ValueError(f'No frame header (#step) at byte {offset}.')
+        n = int(buffer[offset:count_end])
+        next_header = buffer.find(b'\n#step ', header_end, end)
+        if next_header >= 0:
+            frame_end = buffer.rfind(b'\n', header_end, next_header) + 1
+        else:
+            # 最後のフレームは、原子の行が n 行そろっていれば書き終わっている
+            lines = buffer[header_end + 1:end].split(b'\n', n)
+            if len(lines) <= n:
+                break  # 書きかけのフレームは次回に回す
+            frame_end = end - len(lines[-1])
+        steps.append(int(header[1]))
+        times.append(float(header[3]) if len(header) >= 4 and header[2] == b'time' else np.nan)
+        offsets.append(offset)
+        n_atoms.append(n)
+        offset = frame_end
+    return steps, times, offsets, n_atoms, offset
+
+
+class XyzTrajectoryReader:
+    # Driver.write_trajectory の xyz ファイルを、フレームの位置の索引を使って必要なフレームだけ読む
+    def __init__(self, filename, cache_size=32, index=True):
+        self.filename_ = filename
+        self.index_file_ = filename + '.index.npz' if index else None  # Noneなら索引を保存しない
+        self.cache_size_ = cache_size  # 復号したフレームを何個まで覚えておくか
+        self.cache_ = OrderedDict()
+        self.n_cache_hits_ = 0
+        self.steps_ = np.zeros(0, dtype=np.int64)
+        self.times_ = np.zeros(0)
+        self.offsets_ = np.zeros(0, dtype=np.int64)
+        self.n_atoms_ = np.zeros(0, dtype=np.int64)
+        self.end_ = 0  # 索引を作り終えた位置 (書き終わった最後のフレームの終わり)
+        self.head_ = np.zeros(0, dtype=np.uint8)
+        self.load_index()
+        self.update()
+
+    def load_index(self):
+        if self.index_file_ is None or not os.path.exists(self.index_file_):
+            return
+        with open(self.filename_, 'rb') as f:
+            head = np.frombuffer(f.read(256), dtype=np.uint8)
+        with np.load(self.index_file_) as data:
+            # ファイルが作り直されていたら (先頭が変わっていたり短くなっていたら) 索引は使わない
+            if data['end'] > os.path.getsize(self.filename_) or not np.array_equal(data['head'], head[:len(data['head'])]):
+                return
+            self.steps_, self.times_, self.offsets_, self.n_atoms_ = data['steps'], data['times'], data['offsets'], data['n_atoms']
+            self.end_ = int(data['end'])
+            self.head_ = data['head']
+
+    def save_index(self):
+        if self.index_file_ is None:
+            return
+        # 書いている途中で止まっても壊れた索引が残らないように、一時ファイルから置き換える
+        directory = os.path.dirname(os.path.abspath(self.index_file_))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+            np.savez(f, steps=self.steps_, times=self.times_, offsets=self.offsets_, n_atoms=self.n_atoms_, end=self.end_, head=self.head_)
+        os.replace(f.name, self.index_file_)
+
+    def update(self):
+        # 前回の索引の続きから、増えたフレームだけを読む (書き込み中のファイルにも使える)
+        size = os.path.getsize(self.filename_)
+        if size <= self.end_:
+            return 0
+        with open(self.filename_, 'rb') as f:
+            if len(self.head_) < 256:
+                self.head_ = np.frombuffer(f.read(256), dtype=np.uint8)
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+                steps, times, offsets, n_atoms, end = scan_frames(buffer, self.end_, size)
+        if not steps:
+            return 0
+        self.steps_ = np.concatenate([self.steps_, np.array(steps, dtype=np.int64)])
+        self.times_ = np.concatenate([self.times_, np.array(times)])
+        self.offsets_ = np.concatenate([self.offsets_, np.array(offsets, dtype=np.int64)])
+        self.n_atoms_ = np.concatenate([self.n_atoms_, np.array(n_atoms, dtype=np.int64)])
+        self.end_ = end
+        self.save_index()
+        return len(steps)
+
+    def __len__(self):
+        return len(self.steps_)
+
+    def find(self, step):
+        # step のフレームの番号。restartで同じステップが2回書かれていたら後のほう
+        indices = np.flatnonzero(self.steps_ == step)
+        if len(indices) == 0:
+            raise KeyError(f'No frame of step {step} in {self.filename_}.')
+        return int(indices[-1])
+
+    def read_frame(self, index):
+        index = range(len(self))[index]  # 負の番号も使えるようにする
+        if index in self.cache_:
+            self.cache_.move_to_end(index)
+            self.n_cache_hits_ += 1
+            return self.cache_[index]
+        end = self.offsets_[index + 1] if index + 1 < len(self) else self.end_
+        with open(self.filename_, 'rb') as f:
+            f.seek(self.offsets_[index])
+            data = f.read(end - self.offsets_[index])
+        n = int(self.n_atoms_[index])
+        columns = np.array(data.split(b'\n', 2)[2].split()).reshape(n, 7)
+        frame = np.zeros((), dtype=get_frame_dtype(n))
+        frame['step'] = self.steps_[index]
+        frame['time'] = self.times_[index]
+        frame['kind'] = columns[:, 0].astype(str)
+        frame['r'] = columns[:, 1:4].astype(float)
+        frame['v'] = columns[:, 4:7].astype(float)
+        self.cache_[index] = frame
+        if len(self.cache_) > self.cache_size_:
+            self.cache_.popitem(last=False)
+        return frame
+
+    def read_frames(self, indices):
+        indices = np.arange(len(self))[indices]
+        if len(indices) > 0 and np.any(self.n_atoms_[indices] != self.n_atoms_[indices[0]]):
+            raise ValueError('The selected frames have different numbers of atoms.')
+        frames = np.zeros(len(indices), dtype=get_frame_dtype(int(self.n_atoms_[indices[0]]) if len(indices) > 0 else 0))
+        for i, index in enumerate(indices):
+            frames[i] = self.read_frame(index)
+        return frames
+
+    def __getitem__(self, key):
+        # 整数ならフレーム1つ、スライスや番号の配列なら構造化配列
+        if isinstance(key, (int, np.integer)):
+            return self.read_frame(int(key))
+        return self.read_frames(key)
+
+    def select(self, step_range=None, stride=1):
+        # viewer.select_rows と同じく、ステップ数の範囲で絞って stride フレームごとに間引いて読む
+        mask = np.ones(len(self), dtype=bool)
+        if step_range is not None:
+            step_min, step_max = step_range
+            if step_min is not None:
+                mask &= self.steps_ >= step_min
+            if step_max is not None:
+                mask &= self.steps_ <= step_max
+        return self.read_frames(np.flatnonzero(mask)[::stride])
+
+    def to_npz(self, index, filename):
+        # そのフレームから計算をやり直せるように、Driver.load が読む .npz (SI単位) に書き出す
+        frame = self.read_frame(index)
+        with open(filename, 'wb') as f:
+            np.savez(f, kind=frame['kind'], r=frame['r'] * 1e-10, v=frame['v'])
+
+
+def test_xyz_trajectory_reader():
+    kinds = np.array(['Al', 'Al', 'Ni'])
+    rng = np.random.default_rng(0)
+    frames = [(step, step * 1e-15, rng.random((3, 3)) * 1e-9, rng.normal(size=(3, 3)) * 300) for step in range(0, 1000, 10)]
+
+    def write(f, step, time, r, v):
+        f.write(f'{len(kinds)}\n#step {step} time {time}\n')
+        for kind, position, velocity in zip(kinds, r * 1e10, v):
+            f.write(' '.join([kind] + [str(x) for x in position] + [str(x) for x in velocity]) + '\n')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        filename = os.path.join(work_dir, 'traj.xyz')
+        with open(filename, 'w') as f:
+            for frame in frames[:60]:
+                write(f, *frame)
+            # 書きかけのフレームは索引に入らない
+            f.write(f'{len(kinds)}\n#step 600 time 6e-13\nAl 0 0 0 0 0 0\n')
+        reader = XyzTrajectoryReader(filename, cache_size=4)
+        if len(reader) != 60:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {len(reader)} frames indexed before the file was finished.')
+            return
+
+        # 続きを書いたら、保存した索引から増えた分だけ読む
+        with open(filename, 'r+') as f:
+            f.truncate(reader.end_)
+            f.seek(reader.end_)
+            for frame in frames[60:]:
+                write(f, *frame)
+        reader = XyzTrajectoryReader(filename, cache_size=4)
+        if len(reader) != 100 or not os.path.exists(filename + '.index.npz'):
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. {len(reader)} frames indexed.')
+            return
+
+        for index in [40, -1, 0]:
+            step, time, r, v = frames[index]
+            frame = reader[reader.find(step)]
+            if (frame['step'] != step or frame['time'] != time or list(frame['kind']) != list(kinds)
+                    or not np.array_equal(frame['r'], r * 1e10) or not np.array_equal(frame['v'], v)):
+                print(f'Failed in {inspect.currentframe().f_code.co_name}. frame of step {step}')
+                return
+        selected = reader.select(step_range=(100, 500), stride=10)
+        if list(selected['step']) != [100, 200, 300, 400, 500] or list(reader[::25]['step']) != [0, 250, 500, 750]:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. selection {selected["step"]}')
+            return
+        if len(reader.cache_) != 4:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. cache size {len(reader.cache_)}')
+            return
+
+        # ファイルが作り直されたら索引も作り直す
+        with open(filename, 'w') as f:
+            for frame in frames[50:55]:
+                write(f, *frame)
+        reader = XyzTrajectoryReader(filename)
+        if list(reader.steps_) != [500, 510, 520, 530, 540]:
+            print(f'Failed in {inspect.currentframe().f_code.co_name}. steps after rewrite {reader.steps_}')
+            return
+    print(f'Succeed in {inspect.currentframe().f_code.co_name}')
+
+
+def main():
+    if len(sys.argv) < 2:
+        test_xyz_trajectory_reader()
+        return
+    # python XyzTrajectory.py <xyz file> [step npz_file]: 索引を作り、指定したステップのフレームを .npz に書き出す
+    reader = XyzTrajectoryReader(sys.argv[1])
+    print(f'{len(reader)} frames, steps {reader.steps_[0] if len(reader) else None} - {reader.steps_[-1] if len(reader) else None}')
+    if len(sys.argv) == 4:
+        reader.to_npz(reader.find(int(sys.argv[2])), sys.argv[3])
+
+
+if __name__ == '__main__':
+    main()
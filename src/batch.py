@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from CaseData import CaseData
+from Driver import Driver
+from Replica import ReplicaDriver
+
+
+OUTPUT_FILES = {
+    "out_file_traj": "traj.xyz",
+    "out_file_energy": "energy.out",
+    "out_file_cell": "cell.out",
+    "out_file_stress": "stress.out",
+    "restart_file": "restart.tmp",
+    "metrics_file": "metrics.jsonl",
+    "profile_file": "profile.prof",
+    "telemetry_file": "telemetry.bin",
+}
+# 指定したときだけ書き出すファイル
+OPTIONAL_OUTPUT_FILES = ["out_file_stress", "metrics_file", "profile_file", "telemetry_file"]
+
+
+def get_case_name(base_name, values):
+    # 例: case1_stretch_eps=0.02,0,0_cutoff=7e-10
+    name = base_name
+    for key, value in values.items():
+        if isinstance(value, list):
+            value = ','.join(str(x) for x in value)
+        name += f'_{key}={value}'
+    return name.replace('/', '-').replace(' ', '')
+
+
+def expand_sweep(sweep_file):
+    # {"base": case.json, "sweep": {key: [value, ...], ...}} を全組み合わせのケースに展開する
+    with open(sweep_file, 'r') as f:
+        sweep = json.load(f)
+    with open(sweep["base"], 'r') as f:
+        base = json.load(f)
+    base_name = os.path.splitext(os.path.basename(sweep["base"]))[0]
+    keys = list(sweep.get("sweep", {}))
+    cases = []
+    for combination in itertools.product(*[sweep["sweep"][key] for key in keys]):
+        values = dict(zip(keys, combination))
+        case_dict = dict(base)
+        case_dict.update(values)
+        cases.append((get_case_name(base_name, values), case_dict))
+    return cases
+
+
+def load_cases(case_files):
+    # ケース名はファイル名から取る。別のディレクトリに同じ名前のファイルがあるときは相対パスにする (例: a-case1, b-case1)
+    basenames = [os.path.splitext(os.path.basename(case_file))[0] for case_file in case_files]
+    cases = []
+    for case_file, name in zip(case_files, basenames):
+        if basenames.count(name) > 1:
+            name = os.path.splitext(os.path.relpath(case_file))[0].replace(os.sep, '-').replace('.', '_')
+        with open(case_file, 'r') as f:
+            cases.append((name, json.load(f)))
+    return cases
+
+
+def set_case_dir(case_dict, case_dir):
+    # 出力ファイルはケースごとのディレクトリに置く
+    case_dict = dict(case_dict)
+    for key, filename in OUTPUT_FILES.items():
+        if key in OPTIONAL_OUTPUT_FILES and case_dict.get(key) is None:
+            continue
+        if key == "out_file_traj" and case_dict.get("traj_format", "xyz") == "binary":
+            filename = "traj.bin"
+        case_dict[key] = os.path.join(case_dir, filename)
+    return case_dict
+
+
+def run_case(name, case_dict):
+    casedata = CaseData(case_dict=case_dict)
+    dr = ReplicaDriver(casedata) if casedata.replicas_ > 1 else Driver(casedata)
+    n_steps = casedata.n_loop_ - dr.current_step_
+    n_atoms = dr.n_atoms_ * casedata.replicas_  # レプリカのときは全レプリカの原子数
+    start = time.perf_counter()
+    dr.run()
+    elapsed = time.perf_counter() - start
+    return {
+        'name': name,
+        'n_atoms': n_atoms,
+        'n_steps': n_steps,
+        'elapsed': elapsed,
+        'steps_per_sec': n_steps / elapsed if elapsed > 0 else float('nan'),
+        'atom_steps_per_sec': n_atoms * n_steps / elapsed if elapsed > 0 else float('nan'),
+    }
+
+
+def load_status(status_file):
+    if not os.path.exists(status_file):
+        return {}
+    with open(status_file, 'r') as f:
+        return json.load(f)
+
+
+def save_status(status_file, status):
+    tmp_filename = status_file + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(status, f, indent=4)
+    os.replace(tmp_filename, status_file)
+
+
+def format_summary(results):
+    lines = ['name\tn_atoms\tn_steps\telapsed[s]\tsteps/s\tatom*steps/s']
+    for result in results:
+        lines.append(f"{result['name']}\t{result['n_atoms']}\t{result['n_steps']}\t{result['elapsed']:.3f}\t"
+                     f"{result['steps_per_sec']:.3f}\t{result['atom_steps_per_sec']:.3e}")
+    return '\n'.join(lines) + '\n'
+
+
+def run_batch(cases, log_dir, workers=1):
+    # 終わったケースは batch_status.json に記録しておき、やり直すときは飛ばす
+    # 同じ名前のケースは同じディレクトリに書き込み合ってしまう
+    names = [name for name, _ in cases]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Duplicate case names: {duplicates}.')
+    os.makedirs(log_dir, exist_ok=True)
+    status_file = os.path.join(log_dir, 'batch_status.json')
+    status = load_status(status_file)
+
+    pending = []
+    for name, case_dict in cases:
+        if status.get(name, {}).get('state') == 'finished':
+            continue
+        case_dir = os.path.join(log_dir, name)
+        case_dict = set_case_dir(case_dict, case_dir)
+        os.makedirs(case_dir, exist_ok=True)
+        with open(os.path.join(case_dir, 'case.json'), 'w') as f:
+            json.dump(case_dict, f, indent=4)
+        pending.append((name, case_dict))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_case, name, case_dict): name for name, case_dict in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                status[name] = {'state': 'finished', **future.result()}
+            except Exception as e:
+                status[name] = {'state': 'failed', 'error': repr(e)}
+                failed.append(name)
+            save_status(status_file, status)
+
+    results = [status[name] for name, _ in cases if status.get(name, {}).get('state') == 'finished']
+    summary = format_summary(results)
+    with open(os.path.join(log_dir, 'summary.tsv'), 'w') as f:
+        f.write(summary)
+    print(summary, end='')
+    if failed:
+        print(f'Failed cases: {failed}', file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many cases in a process pool.')
+    parser.add_argument('cases', nargs='*', help='case JSON files')
+    parser.add_argument('--sweep', help='sweep JSON: {"base": case.json, "sweep": {key: [values, ...]}}')
+    parser.add_argument('--log-dir', default='./log/batch', help='directory for the per-case outputs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of cases run at once')
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+    if args.sweep is not None:
+        cases += expand_sweep(args.sweep)
+    if not cases:
+        parser.error('no cases given')
+    run_batch(cases, args.log_dir, args.workers)
+
+
+if __name__ == '__main__':
+    main()
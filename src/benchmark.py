@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import argparse
+import itertools
+import tempfile
+import numpy as np
+from CaseData import CaseData
+from Driver import Driver
+from Metrics import load_metrics
+from gen_initial_state import FCCMaker
+
+
+BOUNDARIES = {
+    'periodic': [True, True, True],
+    'partial': [True, False, False],
+    'open': [False, False, False],
+}
+ENGINES = {
+    'direct': {},
+    'neighbor_list': {'neighbor_list': True},
+    'minimum_image': {'minimum_image': True},
+}
+
+
+def make_case(work_dir, n, boundary, engine, n_steps, interval, dt=1e-15, temperature=300, seed=0, reorder_interval=0, shuffle=False, **options):
+    # n x n x n のfcc単位胞のケースを作る
+    # shuffle: 長く流して原子の並びが空間的にばらばらになった状態の代わりに、入力の原子の順を混ぜておく
+    name = f'fcc{n}_{boundary}_{engine}' + ('_shuffled' if shuffle else '') + (f'_reorder{reorder_interval}' if reorder_interval > 0 else '')
+    maker = FCCMaker(4.05e-10, [n, n, n], 'Al', temperature, seed)
+    maker.make()
+    in_file = os.path.join(work_dir, f'fcc{n}_{seed}' + ('_shuffled' if shuffle else '') + '.npz')
+    if shuffle:
+        order = np.random.default_rng(seed).permutation(len(maker.lattice_))
+        maker.lattice_, maker.vel_ = maker.lattice_[order], maker.vel_[order]
+    if not os.path.exists(in_file):
+        maker.to_npz(in_file)
+    case_dict = {
+        "in_file": in_file,
+        "out_file_traj": os.path.join(work_dir, name, 'traj.xyz'),
+        "out_file_energy": os.path.join(work_dir, name, 'energy.out'),
+        "out_file_cell": os.path.join(work_dir, name, 'cell.out'),
+        "restart_file": os.path.join(work_dir, name, 'restart.tmp'),
+        "restart": False,
+        "dt": dt,
+        "cutoff": 6e-10,
+        "n_loop": n_steps,
+        "interval": interval,
+        "box_size": maker.get_box_size().tolist(),
+        "periodic": BOUNDARIES[boundary],
+        "relax": False,
+        "stretch_eps": [0, 0, 0],
+        "reorder_interval": reorder_interval,
+    }
+    case_dict.update(ENGINES[engine])
+    case_dict.update(options)
+    return name, case_dict
+
+
+def benchmark_case(name, case_dict, n_steps):
+    # Driver.run をそのまま走らせ、フェーズごとの時間は Metrics の集計を使う
+    case_dict = dict(case_dict, metrics_file=os.path.join(os.path.dirname(case_dict["out_file_energy"]), 'metrics.jsonl'), metrics_interval=0)
+    casedata = CaseData(case_dict=case_dict)
+    dr = Driver(casedata)
+    dr.run()
+    summary = load_metrics(casedata.metrics_file_)[-1]
+    energy = np.sum(np.loadtxt(casedata.out_file_energy_, usecols=(1, 2), ndmin=2), axis=1)
+    # 最後のrestartとチェックポイントはステップの外なので、ステップの時間だけで速さを出す
+    elapsed = summary['n_steps'] / summary['steps_per_sec']
+    return {
+        'name': name,
+        'n_atoms': dr.n_atoms_,
+        'n_steps': n_steps,
+        'elapsed': elapsed,
+        'phases': summary['phase_time'],
+        'steps_per_sec': summary['steps_per_sec'],
+        'atom_steps_per_sec': summary['steps_per_sec'] * dr.n_atoms_,
+        'ns_per_day': dr.time_ / elapsed * 1e9 * 86400,
+        'energy_drift': float((energy[-1] - energy[0]) / abs(energy[0])) if len(energy) > 1 else 0.0,
+        'energy': energy,
+    }
+
+
+def check_accuracy(work_dir, engine, boundary, n=2, n_steps=200, interval=10, **options):
+    # 小さな系で、元の Cell.calc_force_and_up のループ (direct) と全エネルギーの推移を比べる
+    _, case_ref = make_case(work_dir, n, boundary, 'direct', n_steps, interval)
+    _, case = make_case(work_dir, n, boundary, engine, n_steps, interval, **options)
+    reference = benchmark_case('reference', case_ref, n_steps)
+    result = benchmark_case(engine, case, n_steps)
+    return {
+        'engine': engine,
+        'boundary': boundary,
+        'n_atoms': result['n_atoms'],
+        'n_steps': n_steps,
+        'energy_drift': result['energy_drift'],
+        'reference_energy_drift': reference['energy_drift'],
+        'max_rel_energy_deviation': float(np.max(np.abs(result['energy'] - reference['energy']) / np.abs(reference['energy']))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stepping loop.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 3, 5, 8, 12, 20, 47], help='number of fcc unit cells per axis')
+    parser.add_argument('--boundaries', nargs='+', default=list(BOUNDARIES), choices=list(BOUNDARIES))
+    parser.add_argument('--engines', nargs='+', default=['neighbor_list'], choices=list(ENGINES))
+    parser.add_argument('--precision', default='double', choices=['double', 'single'])
+    parser.add_argument('--reorder-intervals', type=int, nargs='+', default=[0], help='reorder_interval values to compare (0: no reordering)')
+    parser.add_argument('--shuffle', action='store_true', help='start from atoms in random order instead of lattice order')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--accuracy-steps', type=int, default=200, help='steps of the energy drift check (0: skip)')
+    parser.add_argument('--out', help='JSON file for the results (default: stdout)')
+    args = parser.parse_args()
+
+    results = {'benchmarks': [], 'accuracy': []}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for engine in args.engines:
+            for boundary in args.boundaries:
+                if args.accuracy_steps > 0 and engine != 'direct':
+                    n = 3 if engine == 'minimum_image' else 2  # minimum imageは箱がcutoffの2倍より大きい必要がある
+                    results['accuracy'].append(check_accuracy(work_dir, engine, boundary, n, args.accuracy_steps, args.interval, precision=args.precision))
+                for n, reorder_interval in itertools.product(args.sizes, args.reorder_intervals):
+                    name, case_dict = make_case(work_dir, n, boundary, engine, args.steps, args.interval, reorder_interval=reorder_interval,
+                                                shuffle=args.shuffle, precision=args.precision)
+                    try:
+                        result = benchmark_case(name, case_dict, args.steps)
+                    except ValueError as e:
+                        # cutoffと箱の大きさが合わないなど
+                        results['benchmarks'].append({'name': name, 'skipped': str(e)})
+                        continue
+                    del result['energy']
+                    results['benchmarks'].append(result)
+                    print(f"{name}: {result['n_atoms']} atoms, {result['steps_per_sec']:.3f} steps/s, {result['ns_per_day']:.4f} ns/day", file=sys.stderr)
+
+    text = json.dumps(results, indent=4, default=float)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,91 @@
+import json
 import numpy as np
 from Params import Params
+from Cell import format_atoms
 from constant import *
 
 
-class FCCMaker:
-    def __init__(self, lattice_constant, num_lattice, kind, temperature):
-        first = np.array([0, 0, 0])
-        second = np.array([ 0.5,  0.5, 0])
-        third = np.array([ 0.5, 0,  0.5])
-        fourth = np.array([0,  0.5,  0.5])
-        self.my_atoms_ = [first, second, third, fourth]
+# 単位胞の中の原子の位置 (単位胞の辺の長さに対する割合)
+BASIS = {
+    'fcc': np.array([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]]),
+    'bcc': np.array([[0, 0, 0], [0.5, 0.5, 0.5]]),
+    # hcpは a x √3a x c の直方体の単位胞に4原子
+    'hcp': np.array([[0, 0, 0], [0.5, 0.5, 0], [0.5, 5 / 6, 0.5], [0, 1 / 3, 0.5]]),
+}
+
+
+class LatticeMaker:
+    def __init__(self, lattice_constant, num_lattice, kind, temperature, lattice='fcc', seed=None, c_over_a=np.sqrt(8 / 3)):
+        if lattice not in BASIS:
+            raise ValueError(f"Unknown lattice '{lattice}'. Choose from {list(BASIS)}.")
+        self.my_atoms_ = BASIS[lattice]
+        self.lattice_ = None
+        self.vel_ = None
         self.lattice_constant_ = lattice_constant
-        self.num_lattice_ = num_lattice
+        self.num_lattice_ = np.array(num_lattice, dtype=int)
         self.kind_ = kind
         self.temperature_ = temperature
+        self.rng_ = np.random.default_rng(seed)
+        if lattice == 'hcp':
+            self.cell_lengths_ = lattice_constant * np.array([1, np.sqrt(3), c_over_a])
+        else:
+            self.cell_lengths_ = lattice_constant * np.ones(3)
 
         self.params_ = Params()
 
+    def get_box_size(self):
+        return self.num_lattice_ * self.cell_lengths_
+
     def make(self):
-        self.lattice_ = []
-        self.vel_ = []
-        for ix in range(self.num_lattice_[0]):
-            for iy in range(self.num_lattice_[1]):
-                for iz in range(self.num_lattice_[2]):
-                    org = np.array([ix, iy, iz]) * self.lattice_constant_
-                    for atom in self.my_atoms_:
-                        self.lattice_.append(org + atom * self.lattice_constant_)
-                        self.vel_.append(self.get_vel_from_temp())
-
-    def to_xyz(self, filename):
+        # (ix, iy, iz) の順に単位胞を並べ、それぞれに基本構造の原子を置く
+        origins = np.indices(self.num_lattice_).reshape(3, -1).T
+        self.lattice_ = ((origins[:, None, :] + self.my_atoms_[None, :, :]) * self.cell_lengths_).reshape(-1, 3)
+        self.vel_ = self.get_vel_from_temp(len(self.lattice_))
+
+    def to_xyz(self, filename, chunk_atoms=100000):
+        # 大きな系でも文字列が大きくなりすぎないように、少しずつ書き出す
+        kinds = np.full(len(self.lattice_), self.kind_)
         with open(filename, 'w') as f:
-            for atom, vel in zip(self.lattice_, self.vel_):
-                f.write(f'{" ".join([self.kind_, *atom.astype(str), *vel.astype(str)])}\n')
+            for start in range(0, len(self.lattice_), chunk_atoms):
+                end = start + chunk_atoms
+                f.write(format_atoms(kinds[start:end], self.lattice_[start:end], self.vel_[start:end]))
+
+    def to_npz(self, filename):
+        # Driver.load は拡張子が .npz の入力ファイルをバイナリとして読む
+        with open(filename, 'wb') as f:
+            np.savez(f, kind=np.full(len(self.lattice_), self.kind_), r=self.lattice_, v=self.vel_)
+
+    def to_case(self, filename, in_file, template='./data/case0.json'):
+        with open(template, 'r') as f:
+            case_dict = json.load(f)
+        case_dict["in_file"] = in_file
+        case_dict["box_size"] = self.get_box_size().tolist()
+        with open(filename, 'w') as f:
+            json.dump(case_dict, f, indent=4)
+
+    def get_vel_from_temp(self, n_atoms):
+        mass = np.full(n_atoms, self.params_.dict_params_[self.kind_]['mass'])
+        return get_vel_from_temp(self.rng_, mass, self.temperature_)
+
+
+class FCCMaker(LatticeMaker):
+    def __init__(self, lattice_constant, num_lattice, kind, temperature, seed=None):
+        super().__init__(lattice_constant, num_lattice, kind, temperature, 'fcc', seed)
+
 
-    def get_vel_from_temp(self):
-        m = self.params_.dict_params_[self.kind_]['mass']
-        rand = np.array([(sum([np.random.rand() for _ in range(12)]) - 6) for _ in range(3)])
-        return np.sqrt(kB * self.temperature_ / m) * rand
+def get_vel_from_temp(rng, mass, temperature):
+    # Maxwell-Boltzmann分布から取り、重心の並進を除いてから目標温度にぴったり合わせる (mass は原子ごとの質量)
+    vel = rng.normal(scale=np.sqrt(kB * temperature / mass)[:, None], size=(len(mass), 3))
+    vel -= np.sum(mass[:, None] * vel, axis=0) / np.sum(mass)
+    current = np.sum(mass[:, None] * vel * vel) / (3 * len(mass) * kB)  # Driver.write_energy と同じ定義
+    if current > 0:
+        vel *= np.sqrt(temperature / current)
+    return vel
 
 
 def main():
     lattice_constant = 4.05e-10  # m
-    num_lattice = [2, 2, 2]  # x, y, z方向の格子の数 
+    num_lattice = [2, 2, 2]  # x, y, z方向の格子の数
     temperature = 100
 
     maker = FCCMaker(lattice_constant, num_lattice, 'Al', temperature)
@@ -1,10 +1,13 @@
+import sys
 from CaseData import CaseData
 from Driver import Driver
+from Replica import ReplicaDriver
 
 
 def main():
-    casedata = CaseData('./data/case1.json')
-    dr = Driver(casedata)
+    filename = sys.argv[1] if len(sys.argv) > 1 else './data/case1.json'
+    casedata = CaseData(filename)
+    dr = ReplicaDriver(casedata) if casedata.replicas_ > 1 else Driver(casedata)
     dr.run()
 
 
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from CaseData import CaseData
+from Driver import Driver
+from batch import set_case_dir, save_status
+
+
+LOG_FILES = ["out_file_energy", "out_file_cell", "out_file_stress"]
+
+
+def get_coarse_eps(stretch_eps, increments):
+    # 細かいひずみ increments 回分を1回で加える
+    return ((1 + np.array(stretch_eps, dtype=float)) ** increments - 1).tolist()
+
+
+def run_coarse(case_dict, n_segments, increments, coarse_dir):
+    # 粗いひずみで1本だけ流し、伸ばす直前 (緩和した状態) を各区間の初期状態として保存する
+    # 最初に伸ばすまでは細かいひずみの計算と同じ軌跡なので、その間のログはつないだログの先頭に使う
+    case_dict = set_case_dir(case_dict, coarse_dir)
+    case_dict["restart"] = False
+    case_dict["stretch_eps"] = get_coarse_eps(case_dict["stretch_eps"], increments)
+    os.makedirs(coarse_dir, exist_ok=True)
+    dr = Driver(CaseData(case_dict=case_dict))
+    states = []
+
+    def save_state():
+        # ステップ current_step_ の時間発展が終わり、箱を伸ばす直前の状態
+        dr.sync_cell()
+        cell = dr.cell_
+        states.append({
+            'kind': cell.in_id_order(cell.kind_).copy(),
+            'r': cell.in_id_order(cell.r_) - cell.d1_,
+            'v': cell.in_id_order(cell.v_).copy(),
+            'box_size': cell.d2_ - cell.d1_,
+            'step': dr.current_step_ + 1,
+            'time': dr.time_ + dr.casedata_.dt_,
+            'dt': dr.casedata_.dt_,
+            'counter': dr.counter_,
+        })
+
+    dr.run(max_stretch=n_segments, before_stretch=save_state)
+    if dr.n_stretch_ < n_segments:
+        raise RuntimeError(f'The coarse run stretched only {dr.n_stretch_} times in {dr.current_step_} steps. Increase n_loop.')
+    return case_dict, states
+
+
+def run_segment(index, case_dict, increments):
+    casedata = CaseData(case_dict=case_dict)
+    dr = Driver(casedata)
+    start = time.perf_counter()
+    dr.run(max_stretch=increments)
+    return {
+        'segment': index,
+        'n_steps': dr.current_step_,
+        'time': dr.time_,
+        'n_stretch': dr.n_stretch_,
+        'elapsed': time.perf_counter() - start,
+    }
+
+
+def make_segment_cases(case_dict, states, work_dir):
+    # 各区間は粗い計算で保存した状態から始める
+    cases = []
+    for index, state in enumerate(states):
+        segment_dir = os.path.join(work_dir, f'segment_{index:03d}')
+        os.makedirs(segment_dir, exist_ok=True)
+        segment = set_case_dir(case_dict, segment_dir)
+        segment["in_file"] = os.path.join(segment_dir, 'initial.npz')
+        segment["box_size"] = state['box_size'].tolist()
+        segment["dt"] = state['dt']
+        segment["restart"] = False
+        with open(segment["in_file"], 'wb') as f:
+            # 緩和を待ったステップ数も渡し、区間の最初でもう一度待たずにすぐ伸ばせるようにする
+            np.savez(f, kind=state['kind'], r=state['r'], v=state['v'], counter=state['counter'])
+        cases.append(segment)
+    return cases
+
+
+def shift_log(lines, step_offset, time_offset=None, step_end=None):
+    # 先頭の列のステップ数 (と、エネルギーのログなら最後の列の時刻) をずらす。step_end 以降の行は捨てる
+    shifted = []
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        words = line.split()
+        if step_end is not None and int(words[0]) >= step_end:
+            break
+        words[0] = str(int(words[0]) + step_offset)
+        if time_offset is not None:
+            words[-1] = str(float(words[-1]) + time_offset)
+        shifted.append(' '.join(words) + '\n')
+    return shifted
+
+
+def stitch_logs(case_dict, coarse_case, states, segment_cases, results):
+    # 最初に伸ばすまでの粗い計算のログに、区間ごとのログをステップ数と時刻が続くようにつなぐ
+    for key in LOG_FILES:
+        if case_dict.get(key) is None:
+            continue
+        with open(coarse_case[key], 'r') as f:
+            lines = f.readlines()
+        os.makedirs(os.path.dirname(os.path.abspath(case_dict[key])), exist_ok=True)
+        with open(case_dict[key], 'w') as out:
+            out.writelines(line for line in lines[:1] if line.startswith('#'))
+            # 伸ばしたステップの出力は粗いひずみの箱なので使わない
+            out.writelines(shift_log(lines, 0, step_end=states[0]['step'] - 1))
+            step_offset, time_offset = states[0]['step'], states[0]['time']
+            for segment, result in zip(segment_cases, results):
+                with open(segment[key], 'r') as f:
+                    out.writelines(shift_log(f.readlines(), step_offset, time_offset if key == "out_file_energy" else None))
+                step_offset += result['n_steps']
+                time_offset += result['time']
+
+
+def run_parallel_stretch(case_dict, n_segments, increments, work_dir, workers=1):
+    if case_dict.get("replicas", 1) > 1:
+        raise ValueError('parallel_stretch does not support replicas.')
+    os.makedirs(work_dir, exist_ok=True)
+    status_file = os.path.join(work_dir, 'segments.json')
+    start = time.perf_counter()
+    coarse_case, states = run_coarse(case_dict, n_segments, increments, os.path.join(work_dir, 'coarse'))
+    coarse_elapsed = time.perf_counter() - start
+
+    segment_cases = make_segment_cases(case_dict, states, work_dir)
+    results = [None] * len(segment_cases)
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_segment, index, segment, increments): index for index, segment in enumerate(segment_cases)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                results[index] = {'segment': index, 'error': repr(e)}
+                failed.append(index)
+    elapsed = time.perf_counter() - start
+    save_status(status_file, {'coarse_elapsed': coarse_elapsed, 'elapsed': elapsed, 'segments': results})
+    if failed:
+        raise RuntimeError(f'Failed segments: {sorted(failed)} (see {status_file})')
+
+    for result in results[:-1]:
+        if result['n_stretch'] < increments:
+            # n_loop ステップで区間の終わりまで伸ばしきれなかったので、次の区間との間でひずみが飛ぶ
+            print(f"Segment {result['segment']} stretched only {result['n_stretch']} of {increments} times. Increase n_loop.", file=sys.stderr)
+    stitch_logs(case_dict, coarse_case, states, segment_cases, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stretch with the strain range split into segments that run in parallel.')
+    parser.add_argument('case', help='case JSON file')
+    parser.add_argument('--segments', type=int, required=True, help='number of strain segments')
+    parser.add_argument('--increments', type=int, required=True, help='number of stretch_eps increments per segment')
+    parser.add_argument('--work-dir', default='./log/parallel_stretch', help='directory for the coarse run and the per-segment outputs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of segments run at once')
+    args = parser.parse_args()
+
+    with open(args.case, 'r') as f:
+        case_dict = json.load(f)
+    results = run_parallel_stretch(case_dict, args.segments, args.increments, args.work_dir, args.workers)
+    for result in results:
+        print(f"segment {result['segment']}: {result['n_steps']} steps, {result['n_stretch']} stretches, {result['elapsed']:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,169 @@
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
+from Telemetry import TelemetryReader
 
-def load_energy(filename):
-    step_list = []
-    up_list = []
-    uk_list = []
-    temperature_list = []
-    with open(filename, 'r') as f:
-        for line in f:
-            line.strip('\n')
-            step, up, uk, temperature = line.split()
-            if step == '#step':
+def read_columns(filename, n_columns, offset=0, chunk_bytes=1 << 24):
+    # offsetバイト目から読み、数値の表を (行数, n_columns) の配列にする。'#'で始まる行は飛ばす
+    chunks = []
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            if not lines[-1].endswith(b'\n'):
+                # 書きかけの行は次回に回す
+                lines.pop()
+                if not lines:
+                    break
+            offset += sum(len(line) for line in lines)
+            rows = [line for line in lines if not line.startswith(b'#') and line.strip()]
+            values = np.array(b''.join(rows).split(), dtype=float)
+            if len(values) == len(rows) * n_columns:
+                chunks.append(values.reshape(-1, n_columns))
                 continue
-            step_list.append(int(step))
-            up_list.append(float(up))
-            uk_list.append(float(uk))
-            temperature_list.append(float(temperature))
+            # 列の少ない行が混ざっている (古い形式のログにrestartで書き足したなど) ときは1行ずつ読み、足りない列はnanにする
+            table = np.full((len(rows), n_columns), np.nan)
+            for i, row in enumerate(rows):
+                words = row.split()
+                if len(words) > n_columns:
+                    raise ValueError(f'{filename}: a row has {len(words)} columns (expected at most {n_columns}).')
+                table[i, :len(words)] = np.array(words, dtype=float)
+            chunks.append(table)
+    table = np.concatenate(chunks) if chunks else np.zeros((0, n_columns))
+    return table, offset
 
-    return np.array(step_list), np.array(up_list), np.array(uk_list), np.array(temperature_list)
+
+def load_table(filename, n_columns, cache=True):
+    # 読み込んだ表をログの隣に .npz で保存しておき、次回は増えた分だけを読む
+    cache_file = filename + '.cache.npz'
+    with open(filename, 'rb') as f:
+        head = np.frombuffer(f.read(256), dtype=np.uint8)
+    table, offset = np.zeros((0, n_columns)), 0
+    if cache and os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            # ログが作り直されていたら (先頭が変わっていたり短くなっていたら) キャッシュは使わない
+            if (data['offset'] <= os.path.getsize(filename) and data['table'].shape[1] == n_columns
+                    and np.array_equal(data['head'], head[:len(data['head'])])):
+                table, offset = data['table'], int(data['offset'])
+    new_table, new_offset = read_columns(filename, n_columns, offset)
+    if len(new_table) > 0:
+        table = np.concatenate([table, new_table])
+        if cache:
+            with open(cache_file, 'wb') as f:
+                np.savez(f, table=table, offset=new_offset, head=head)
+    return table
+
+
+def select_rows(table, step_range=None, stride=1):
+    # 1列目のステップ数で範囲を絞り、stride行ごとに間引く
+    if step_range is not None:
+        step_min, step_max = step_range
+        mask = np.ones(len(table), dtype=bool)
+        if step_min is not None:
+            mask &= table[:, 0] >= step_min
+        if step_max is not None:
+            mask &= table[:, 0] <= step_max
+        table = table[mask]
+    return table[::stride]
+
+
+def load_energy(filename, step_range=None, stride=1, cache=True):
+    # step up uk temperature (time)
+    table = select_rows(load_table(filename, 5, cache), step_range, stride)
+    return table[:, 0].astype(int), table[:, 1], table[:, 2], table[:, 3]
+
+
+def load_time(filename, step_range=None, stride=1, cache=True):
+    # energyファイルの step と time (s)。時刻の列がない古い行は nan
+    table = select_rows(load_table(filename, 5, cache), step_range, stride)
+    if len(table) > 0 and np.all(np.isnan(table[:, 4])):
+        raise ValueError(f'{filename} has no time column.')
+    return table[:, 0].astype(int), table[:, 4]
 
 
 def calc_stress_strain(up_list, lx_list):
     stride = 50
-    sigma_list = []
-    epslion_list = []
-    for i, lx in enumerate(lx_list):
-        if i < stride or i >= len(up_list) - stride:
-            continue
-        sigma = (up_list[i + stride] - up_list[i - stride]) / (2 * stride)
-        epslion = (lx - lx_list[0]) / lx_list[0]
-        sigma_list.append(sigma)
-        epslion_list.append(epslion)
+    up_list = np.asarray(up_list)
+    lx_list = np.asarray(lx_list)
+    index = np.arange(stride, min(len(lx_list), len(up_list) - stride))
+    sigma_list = (up_list[index + stride] - up_list[index - stride]) / (2 * stride)
+    epslion_list = (lx_list[index] - lx_list[0]) / lx_list[0]
 
     return sigma_list, epslion_list
 
 
-def load_cell(filename):
-    box_sizes = []
-    with open(filename, 'r') as f:
-        for line in f:
-            line.strip('\n')
-            if line[0] == '#':
-                continue
-            _, x, _, _, _, y, _, _, _, z, _, _, _ = line.split()
-            box_size = [x, y, z]
-            box_sizes.append(box_size)
+def load_stress(filename, step_range=None, stride=1, cache=True):
+    # step s_xx s_yy s_zz s_yz s_xz s_xy (Pa, 引張りが正)
+    table = select_rows(load_table(filename, 7, cache), step_range, stride)
+    return table[:, 0].astype(int), table[:, 1:]
+
+
+def calc_stress_strain_from_virial(stress_list, lx_list, axis=0):
+    # virial stressはその場で出力されているので、差分を取らずにそのまま使える
+    n = min(len(stress_list), len(lx_list))
+    lx_list = np.asarray(lx_list)[:n]
+    sigma_list = np.asarray(stress_list)[:n, axis]
+    epslion_list = (lx_list - lx_list[0]) / lx_list[0]
+    return sigma_list, epslion_list
+
+
+def load_cell(filename, step_range=None, stride=1, cache=True):
+    # step a_x a_y a_z b_x b_y b_z c_x c_y c_z o_x o_y o_z
+    table = select_rows(load_table(filename, 13, cache), step_range, stride)
+    return table[:, [1, 5, 9]] * 1e-10
 
-    return np.array(box_sizes).astype(float) * 1e-10
+
+def live(filename, interval=1.0):
+    # Driver が telemetry_file に書いているリングバッファに付いて、増えたレコードだけを描き足す (ログは読まない)
+    reader = TelemetryReader(filename)
+    records = reader.read_new()
+    fig, axes = plt.subplots(2, 2, figsize=(10, 7))
+    lines = {
+        'up': axes[0, 0].plot([], [], color='r', label='Up')[0],
+        'uk': axes[0, 0].plot([], [], color='b', label='Uk')[0],
+        'total': axes[0, 0].plot([], [], color='k', label='Total')[0],
+        'temperature': axes[0, 1].plot([], [], color='k')[0],
+        'lx': axes[1, 0].plot([], [], color='b')[0],
+        'stress': axes[1, 1].plot([], [], color='k')[0],
+    }
+    axes[0, 0].set_ylabel('Energy')
+    axes[0, 0].legend()
+    axes[0, 1].set_ylabel('Temperature [K]')
+    axes[1, 0].set_ylabel('Lx')
+    axes[1, 1].set_ylabel('Stress xx [Pa]')
+    for ax in axes.flat:
+        ax.set_xlabel('Step')
+    plt.ion()
+    plt.show()
+    while plt.fignum_exists(fig.number):
+        new_records = reader.read_new()
+        if len(new_records) > 0:
+            if len(records) > 0 and new_records['step'][0] <= records['step'][-1]:
+                records = new_records  # 新しい実行が始まった
+            else:
+                records = np.concatenate([records, new_records])
+            step = records['step']
+            lines['up'].set_data(step, records['up'])
+            lines['uk'].set_data(step, records['uk'])
+            lines['total'].set_data(step, records['up'] + records['uk'])
+            lines['temperature'].set_data(step, records['temperature'])
+            lines['lx'].set_data(step, records['box'][:, 0])
+            lines['stress'].set_data(step, records['stress'][:, 0])
+            for ax in axes.flat:
+                ax.relim()
+                ax.autoscale_view()
+            fig.canvas.draw_idle()
+        plt.pause(interval)
 
 
 def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == '--live':
+        # python viewer.py --live <telemetry_file> [更新間隔 (s)]
+        live(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
+        return
     step_list, up_list, uk_list, temperature_list = load_energy('./log/energy_8.out')
 
     box_sizes = load_cell('./log/cell_8.out')